@@ -1,31 +1,37 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, send_file, Response
 from flask_cors import CORS
 from flask_jwt_extended import JWTManager, create_access_token, jwt_required
-from flask_sqlalchemy import SQLAlchemy
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import check_password_hash
 import os
-import uuid
-import sqlite3
-import threading
-import time
 import json
-import csv
-import zipfile
-import shutil
-from werkzeug.utils import secure_filename
-from PIL import Image
-from io import BytesIO
+import time
+import base64
+import logging
 from datetime import timedelta
+import db
+import converters
+import costs
+import jobs
+import cache
+import storage
+import stats
+import events
+import archives
+import media
+import metrics
+import settings
+import logs
 # from pydub import AudioSegment  # Disabled due to Python 3.13 compatibility
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'dev-secret-key'
 app.config['JWT_SECRET_KEY'] = 'jwt-secret-key'
 app.config['JWT_ACCESS_TOKEN_EXPIRES'] = timedelta(hours=24)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///app.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Let nginx/Apache stream downloads (and answer Range requests) themselves
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE') == '1'
+
+log = logging.getLogger(__name__)
 
-db = SQLAlchemy(app)
 jwt = JWTManager(app)
 CORS(app, origins="*", methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"], allow_headers=["*"])
 
@@ -36,144 +42,57 @@ def after_request(response):
     response.headers['Access-Control-Allow-Methods'] = 'GET,PUT,POST,DELETE,OPTIONS'
     return response
 
-# Create database
-def init_db():
-    conn = sqlite3.connect('app.db')
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS files (
-        id TEXT PRIMARY KEY,
-        filename TEXT,
-        status TEXT DEFAULT 'pending',
-        from_format TEXT,
-        to_format TEXT,
-        file_size INTEGER,
-        upload_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        download_count INTEGER DEFAULT 0,
-        error_message TEXT,
-        completion_date TIMESTAMP
-    )''')
-    
-    # Add missing columns if they don't exist
-    try:
-        c.execute('ALTER TABLE files ADD COLUMN upload_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP')
-    except sqlite3.OperationalError:
-        pass
-    try:
-        c.execute('ALTER TABLE files ADD COLUMN download_count INTEGER DEFAULT 0')
-    except sqlite3.OperationalError:
-        pass
-    
-    c.execute('''CREATE TABLE IF NOT EXISTS admin_users (
-        id TEXT PRIMARY KEY,
-        username TEXT UNIQUE NOT NULL,
-        password_hash TEXT NOT NULL,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )''')
-    
-    # Blog posts table
-    c.execute('''CREATE TABLE IF NOT EXISTS blog_posts (
-        id TEXT PRIMARY KEY,
-        title TEXT NOT NULL,
-        content TEXT NOT NULL,
-        excerpt TEXT,
-        author TEXT DEFAULT 'Admin',
-        category TEXT DEFAULT 'General',
-        tags TEXT,
-        featured BOOLEAN DEFAULT 0,
-        published BOOLEAN DEFAULT 1,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        views INTEGER DEFAULT 0
-    )''')
-    
-
-    
-    # Settings table
-    c.execute('''CREATE TABLE IF NOT EXISTS settings (
-        key TEXT PRIMARY KEY,
-        value TEXT NOT NULL,
-        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )''')
-    
-    # Create admin user
-    admin_id = str(uuid.uuid4())
-    password_hash = generate_password_hash('admin123')
-    c.execute('INSERT OR IGNORE INTO admin_users (id, username, password_hash) VALUES (?, ?, ?)',
-              (admin_id, 'admin', password_hash))
-    
-    # Insert default settings
-    default_settings = [
-        ('max_file_size', '100'),
-        ('allowed_file_types', 'PDF,DOCX,JPG,PNG,MP4,MP3,WAV,FLAC'),
-        ('image_quality', '95'),
-        ('audio_bitrate', '192')
-    ]
-    for key, value in default_settings:
-        c.execute('INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)', (key, value))
-    
-    # Insert sample blog posts
-    sample_posts = [
-        {
-            'id': str(uuid.uuid4()),
-            'title': 'Welcome to FormatFusion',
-            'content': 'FormatFusion is your go-to solution for file conversions...',
-            'excerpt': 'Learn about our powerful file conversion platform',
-            'category': 'Announcements',
-            'featured': 1
-        }
-    ]
-    for post in sample_posts:
-        c.execute('INSERT OR IGNORE INTO blog_posts (id, title, content, excerpt, category, featured) VALUES (?, ?, ?, ?, ?, ?)',
-                  (post['id'], post['title'], post['content'], post['excerpt'], post['category'], post['featured']))
-    
-
-    
-
-    
-    conn.commit()
-    conn.close()
-
 @app.route('/api/health')
 def health():
     return {'status': 'ok'}
 
+@app.route('/api/metrics')
+@jwt_required()
+def get_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/api/files/upload', methods=['POST'])
 def upload():
-    files = request.files.getlist('files')
-    from_format = request.form.get('fromFormat', '').upper()
-    to_format = request.form.get('toFormat', '').upper()
-    result = []
+    if request.mimetype != 'multipart/form-data' or 'boundary' not in request.mimetype_params:
+        return {'error': 'Expected a multipart/form-data upload'}, 400
     
-    conn = sqlite3.connect('app.db')
-    c = conn.cursor()
+    max_file_size = settings.number('max_file_size', 0) * 1024 * 1024
+    
+    # Files are streamed to disk as the body is read, never through request.files.
+    # No connection is held while the body arrives.
+    started = time.perf_counter()
     try:
-        c.execute('ALTER TABLE files ADD COLUMN from_format TEXT')
-        c.execute('ALTER TABLE files ADD COLUMN to_format TEXT')
-    except:
-        pass  # Columns already exist
+        fields, uploads = storage.stream_upload(request.stream, request.mimetype_params['boundary'].encode(), max_file_size)
+    except storage.UploadError as e:
+        return {'error': str(e)}, e.status
+    
+    from_format = fields.get('fromFormat', '').upper()
+    to_format = fields.get('toFormat', '').upper()
+    # Includes the time the client takes to send the body
+    metrics.observe_stage('upload_write', time.perf_counter() - started, from_format, to_format)
+    result = []
     
-    for file in files:
-        if file:
-            file_id = str(uuid.uuid4())
-            filename = secure_filename(file.filename)
-            
-            os.makedirs('uploads', exist_ok=True)
-            file.save(f'uploads/{file_id}_{filename}')
-            
-            file_size = os.path.getsize(f'uploads/{file_id}_{filename}')
-            c.execute('INSERT INTO files (id, filename, from_format, to_format, status, file_size) VALUES (?, ?, ?, ?, ?, ?)', 
-                     (file_id, filename, from_format, to_format, 'pending', file_size))
-            
-            result.append({
-                'id': file_id,
-                'filename': filename,
-                'originalFormat': from_format,
-                'convertedFormat': to_format,
-                'status': 'pending'
-            })
+    conn = db.connect()
+    c = conn.cursor()
+    for upload in uploads:
+        c.execute('INSERT INTO files (id, filename, original_filename, from_format, to_format, status, file_size, content_hash) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', 
+                 (upload.file_id, upload.filename, upload.filename, from_format, to_format, 'pending', upload.size, upload.content_hash))
+        storage.expire(c, upload.file_id, storage.ABANDONED_RETENTION)
+        storage.add_usage(upload.size, c)
+        stats.record(c, from_format, to_format, uploads=1, bytes_in=upload.size)
+        
+        result.append({
+            'id': upload.file_id,
+            'filename': upload.filename,
+            'originalFormat': from_format,
+            'convertedFormat': to_format,
+            'status': 'pending'
+        })
     
     conn.commit()
     conn.close()
+    for upload in uploads:
+        events.publish(upload.file_id, 'pending', 0, upload.filename)
     
     return {'files': result}
 
@@ -182,409 +101,420 @@ def convert():
     data = request.get_json()
     file_ids = data.get('fileIds', [])
     
-    for file_id in file_ids:
-        thread = threading.Thread(target=convert_file, args=(file_id,))
-        thread.start()
+    # Estimated cost orders the queue; see jobs.enqueue. Only the size is
+    # used here, the job estimator thread refines it (estimate_job)
+    estimates = {}
+    if file_ids:
+        conn = db.connect()
+        c = conn.cursor()
+        c.execute(f'''SELECT id, from_format, to_format, file_size FROM files
+                      WHERE id IN ({','.join('?' * len(file_ids))})''', file_ids)
+        rows = c.fetchall()
+        conn.close()
+        for file_id, from_format, to_format, file_size in rows:
+            estimates[file_id] = costs.quick_estimate(from_format, to_format, file_size)
+    
+    jobs.enqueue(file_ids, client=request.remote_addr or '', costs=estimates)
     
     return {'message': 'Conversion started'}
 
+def estimate_job(file_id):
+    conn = db.connect()
+    c = conn.cursor()
+    c.execute('''SELECT COALESCE(original_filename, filename), from_format, to_format, file_size
+                 FROM files WHERE id = ?''', (file_id,))
+    row = c.fetchone()
+    conn.close()
+    if not row:
+        return None
+    filename, from_format, to_format, file_size = row
+    return costs.estimate(f'uploads/{file_id}_{filename}', from_format, to_format, file_size)
+
+class Conversion:
+    # One file's conversion: start_conversion() claims the file and looks in
+    # the cache, the converter then runs alone (run_conversion) or in a batch
+    # (run_batch), and finish_conversion() records the outcome
+    def __init__(self, file_id, filename, from_format, to_format, content_hash, options):
+        self.file_id = file_id
+        self.filename = filename
+        self.from_format = from_format
+        self.to_format = to_format
+        self.content_hash = content_hash
+        self.options = options  # one snapshot for the cache key and the converter
+        self.input_path = f'uploads/{file_id}_{filename}'
+        self.output_filename = storage.output_filename_for(file_id, filename, to_format)
+        self.output_path = f'uploads/{self.output_filename}'
+        self.converter = None
+        self.key = None
+        self.output_hash = None  # set by a cache hit
+        self.result = None
+        self.error = None
+
+    def args(self):
+        return self.input_path, self.output_path, self.from_format, self.to_format
+
 def convert_file(file_id):
-    print(f"\n=== CONVERSION START for {file_id} ===")
-    conn = sqlite3.connect('app.db')
+    convert_files([file_id])
+
+def convert_files(file_ids):
+    # Small image conversions among file_ids (see jobs.start_workers) share
+    # one process pool task; everything else runs one after another
+    conversions = [conversion for conversion in map(start_conversion, file_ids) if conversion]
+    batches = {}
+    for conversion in conversions:
+        if conversion.error or conversion.output_hash:
+            continue
+        if len(conversions) > 1 and conversion.converter.name in converters.BATCHES:
+            batches.setdefault(conversion.converter.name, []).append(conversion)
+        else:
+            run_conversion(conversion)
+    for batch in batches.values():
+        run_batch(batch)
+    for conversion in conversions:
+        finish_conversion(conversion)
+
+def start_conversion(file_id):
+    # Keep write transactions short: nothing holds a connection while converting
+    conn = db.connect()
     c = conn.cursor()
-    c.execute('UPDATE files SET status = ? WHERE id = ?', ('processing', file_id))
+    c.execute('BEGIN IMMEDIATE')
+    c.execute('''SELECT from_format, to_format, status, completion_date, filename,
+                        COALESCE(original_filename, filename)
+                 FROM files WHERE id = ?''', (file_id,))
+    previous = c.fetchone()
+    if previous:
+        # A re-conversion replaces the file's earlier outcome in the stats,
+        # and its earlier output on disk
+        stats.retract(c, *previous[:4])
+        if previous[2] == 'completed':
+            storage.remove_file(f'uploads/{previous[4]}', c)
+        # Before the status commits, so a cancel that sees 'processing'
+        # always reaches the conversion; finish_conversion ends it
+        media.begin(f'uploads/{storage.output_filename_for(file_id, previous[5], previous[1])}')
+    # files.filename names the output once a conversion completes; the
+    # input is always the upload, under its original name
+    c.execute('UPDATE files SET status = ?, filename = COALESCE(original_filename, filename) WHERE id = ?',
+              ('processing', file_id))
     conn.commit()
     
-    c.execute('SELECT filename, from_format, to_format FROM files WHERE id = ?', (file_id,))
+    c.execute('SELECT filename, from_format, to_format, content_hash FROM files WHERE id = ?', (file_id,))
     result = c.fetchone()
-    print(f"Database result: {result}")
+    conn.close()
+    if not result:
+        log.warning('Conversion skipped: no such file', extra={'file_id': file_id})
+        return None
     
-    if result:
-        filename, from_format, to_format = result
-        input_path = f'uploads/{file_id}_{filename}'
-        print(f"Original filename: {filename}")
-        print(f"Input path: {input_path}")
-        print(f"Input file exists: {os.path.exists(input_path)}")
-        print(f"Converting: {from_format} -> {to_format}")
-        
-        # Convert file
-        base_name = os.path.splitext(filename)[0]
-        output_filename = f'{file_id}_{base_name}_converted.{to_format.lower()}'
-        output_path = f'uploads/{output_filename}'
-        download_name = f'{base_name}_converted.{to_format.lower()}'
-        print(f"Output filename: {output_filename}")
-        print(f"Output path: {output_path}")
+    conversion = Conversion(file_id, *result, settings.current())
+    events.publish(file_id, 'processing', 0, conversion.filename)
+    try:
+        conversion.converter = converters.get_converter(conversion.from_format, conversion.to_format)
+        log.debug('Converting', extra={'file_id': file_id, 'from_format': conversion.from_format,
+                                       'to_format': conversion.to_format, 'converter': conversion.converter.name,
+                                       'cost': conversion.converter.cost})
         
+        # Identical input + target + the encoder options this converter reads
+        # means identical output
+        keys = converters.encoder_settings(conversion.converter, *conversion.args())
+        conversion.key = cache.cache_key(conversion.content_hash or cache.hash_file(conversion.input_path),
+                                         conversion.converter.name, conversion.to_format,
+                                         settings.encoder_options(keys, conversion.options))
+        conversion.output_hash = cache.lookup(conversion.key, conversion.output_path)
+        if conversion.output_hash:
+            log.debug('Conversion served from cache', extra={'file_id': file_id, 'cache_key': conversion.key})
+    except Exception as e:
+        conversion.error = e
+    return conversion
+
+def run_conversion(conversion):
+    try:
+        conversion.result = jobs.run_converter(conversion.converter, *conversion.args(),
+                                               progress=events.Reporter(conversion.file_id),
+                                               options=conversion.options)
+    except Exception as e:
+        conversion.error = e
+
+def run_batch(conversions):
+    # Conversions by the same batchable converter, as one pool task
+    batch, make_task = converters.BATCHES[conversions[0].converter.name]
+    tasks = []
+    memory = 0
+    for conversion in conversions:
+        converter = conversion.converter
+        with settings.pinned(conversion.options):
+            tasks.append(make_task(*conversion.args()))
         try:
-            # IMAGE CONVERSIONS (including SVG)
-            if from_format in ['PNG', 'JPG', 'JPEG', 'BMP', 'TIFF', 'WEBP', 'GIF', 'SVG'] and to_format in ['PNG', 'JPG', 'JPEG', 'BMP', 'TIFF', 'WEBP', 'PDF', 'SVG']:
-                # Handle SVG conversions
-                if from_format == 'SVG' or to_format == 'SVG':
-                    if from_format == 'SVG' and to_format != 'SVG':
-                        # SVG to raster - use cairosvg if available, otherwise copy
-                        try:
-                            import cairosvg
-                            if to_format == 'PNG':
-                                cairosvg.svg2png(url=input_path, write_to=output_path)
-                            elif to_format in ['JPG', 'JPEG']:
-                                png_data = cairosvg.svg2png(url=input_path)
-                                img = Image.open(BytesIO(png_data))
-                                img = img.convert('RGB')
-                                img.save(output_path, 'JPEG', quality=95)
-                            else:
-                                shutil.copy2(input_path, output_path)
-                        except ImportError:
-                            shutil.copy2(input_path, output_path)
-                    else:
-                        shutil.copy2(input_path, output_path)
-                else:
-                    # Regular image conversions
-                    with Image.open(input_path) as img:
-                        if to_format in ['JPG', 'JPEG'] and img.mode in ['RGBA', 'LA']:
-                            background = Image.new('RGB', img.size, (255, 255, 255))
-                            background.paste(img, mask=img.split()[-1] if img.mode == 'RGBA' else None)
-                            img = background
-                        
-                        if to_format == 'PDF':
-                            if img.mode in ['RGBA', 'LA']:
-                                background = Image.new('RGB', img.size, (255, 255, 255))
-                                background.paste(img, mask=img.split()[-1] if img.mode == 'RGBA' else None)
-                                img = background
-                            img.save(output_path, 'PDF')
-                        elif to_format in ['JPG', 'JPEG']:
-                            img.save(output_path, 'JPEG', quality=95)
-                        else:
-                            img.save(output_path, to_format)
-            
-            # DOCUMENT CONVERSIONS (including RTF, ODT, PAGES)
-            elif (from_format in ['PDF', 'DOCX', 'TXT', 'RTF', 'ODT', 'PAGES'] and to_format in ['PDF', 'DOCX', 'TXT', 'RTF', 'ODT', 'PAGES']) or (from_format in ['HTML', 'CSS', 'JS'] and to_format == 'TXT'):
-                if to_format == 'TXT':
-                    try:
-                        # Try to extract text from various formats
-                        if from_format == 'PDF':
-                            import PyPDF2
-                            with open(input_path, 'rb') as f:
-                                reader = PyPDF2.PdfReader(f)
-                                text = ''
-                                for page in reader.pages:
-                                    text += page.extract_text() + '\n'
-                            with open(output_path, 'w', encoding='utf-8') as f:
-                                f.write(text)
-                        elif from_format == 'DOCX':
-                            try:
-                                from docx import Document
-                                doc = Document(input_path)
-                                text = ''
-                                for paragraph in doc.paragraphs:
-                                    text += paragraph.text + '\n'
-                                with open(output_path, 'w', encoding='utf-8') as f:
-                                    f.write(text)
-                            except ImportError:
-                                # Fallback to pandoc
-                                import subprocess
-                                subprocess.run(['pandoc', input_path, '-t', 'plain', '-o', output_path], check=True, capture_output=True)
-                        elif from_format in ['RTF', 'ODT', 'PAGES']:
-                            # For complex formats, try to read as text
-                            with open(input_path, 'r', encoding='utf-8', errors='ignore') as f:
-                                content = f.read()
-                            with open(output_path, 'w', encoding='utf-8') as f:
-                                f.write(f"Converted from {from_format}\n\n{content}")
-                        else:
-                            with open(input_path, 'r', encoding='utf-8', errors='ignore') as f:
-                                content = f.read()
-                            with open(output_path, 'w', encoding='utf-8') as f:
-                                f.write(f"Converted from {from_format}\n\n{content}")
-                    except Exception:
-                        # Fallback to simple copy
-                        shutil.copy2(input_path, output_path)
-                else:
-                    # For non-TXT conversions, handle DOCX specially
-                    if from_format == 'DOCX' or to_format == 'DOCX':
-                        try:
-                            import subprocess
-                            # Use pandoc for DOCX conversions
-                            if from_format == 'DOCX' and to_format == 'PDF':
-                                subprocess.run(['pandoc', input_path, '-o', output_path], check=True, capture_output=True)
-                            elif to_format == 'DOCX':
-                                subprocess.run(['pandoc', input_path, '-o', output_path], check=True, capture_output=True)
-                            else:
-                                subprocess.run(['pandoc', input_path, '-o', output_path], check=True, capture_output=True)
-                        except (subprocess.CalledProcessError, FileNotFoundError):
-                            # Fallback: try python-docx for text extraction
-                            if from_format == 'DOCX' and to_format == 'TXT':
-                                try:
-                                    from docx import Document
-                                    doc = Document(input_path)
-                                    text = ''
-                                    for paragraph in doc.paragraphs:
-                                        text += paragraph.text + '\n'
-                                    with open(output_path, 'w', encoding='utf-8') as f:
-                                        f.write(text)
-                                except ImportError:
-                                    shutil.copy2(input_path, output_path)
-                            else:
-                                shutil.copy2(input_path, output_path)
-                    else:
-                        # For other document conversions, use pandoc
-                        try:
-                            import subprocess
-                            subprocess.run(['pandoc', input_path, '-o', output_path], check=True, capture_output=True)
-                        except (subprocess.CalledProcessError, FileNotFoundError):
-                            shutil.copy2(input_path, output_path)
-            
-            # DATA CONVERSIONS
-            elif from_format == 'CSV' and to_format == 'JSON':
-                data = []
-                with open(input_path, 'r', encoding='utf-8') as csvfile:
-                    reader = csv.DictReader(csvfile)
-                    for row in reader:
-                        data.append(row)
-                with open(output_path, 'w', encoding='utf-8') as jsonfile:
-                    json.dump(data, jsonfile, indent=2)
-            
-            elif from_format == 'JSON' and to_format == 'CSV':
-                with open(input_path, 'r', encoding='utf-8') as jsonfile:
-                    data = json.load(jsonfile)
-                if data and isinstance(data, list) and isinstance(data[0], dict):
-                    with open(output_path, 'w', encoding='utf-8', newline='') as csvfile:
-                        writer = csv.DictWriter(csvfile, fieldnames=data[0].keys())
-                        writer.writeheader()
-                        writer.writerows(data)
-                else:
-                    shutil.copy2(input_path, output_path)
-            
-            # ARCHIVE CONVERSIONS (real extraction and compression)
-            elif from_format in ['ZIP', 'RAR', '7Z', 'TAR', 'GZ'] and to_format in ['ZIP', 'RAR', '7Z', 'TAR', 'GZ']:
-                import subprocess
-                import tempfile
-                
-                if from_format == to_format:
-                    shutil.copy2(input_path, output_path)
-                else:
-                    try:
-                        # Extract to temporary directory
-                        with tempfile.TemporaryDirectory() as temp_dir:
-                            # Extract archive
-                            if from_format == 'ZIP':
-                                with zipfile.ZipFile(input_path, 'r') as zip_ref:
-                                    zip_ref.extractall(temp_dir)
-                            elif from_format == 'RAR':
-                                subprocess.run(['unrar', 'x', input_path, temp_dir], check=True, capture_output=True)
-                            elif from_format == '7Z':
-                                subprocess.run(['7z', 'x', input_path, f'-o{temp_dir}'], check=True, capture_output=True)
-                            elif from_format in ['TAR', 'GZ']:
-                                subprocess.run(['tar', '-xf', input_path, '-C', temp_dir], check=True, capture_output=True)
-                            
-                            # Create new archive
-                            if to_format == 'ZIP':
-                                with zipfile.ZipFile(output_path, 'w') as zip_ref:
-                                    for root, dirs, files in os.walk(temp_dir):
-                                        for file in files:
-                                            file_path = os.path.join(root, file)
-                                            arc_path = os.path.relpath(file_path, temp_dir)
-                                            zip_ref.write(file_path, arc_path)
-                            elif to_format == '7Z':
-                                subprocess.run(['7z', 'a', output_path, f'{temp_dir}/*'], check=True, capture_output=True)
-                            elif to_format == 'TAR':
-                                subprocess.run(['tar', '-cf', output_path, '-C', temp_dir, '.'], check=True, capture_output=True)
-                            
-                    except (subprocess.CalledProcessError, FileNotFoundError):
-                        # Fallback: create zip with original file
-                        with zipfile.ZipFile(output_path, 'w') as zipf:
-                            zipf.write(input_path, os.path.basename(input_path))
-            
-            # AUDIO CONVERSIONS (using ffmpeg directly)
-            elif from_format in ['MP3', 'WAV', 'FLAC', 'AAC', 'OGG', 'M4A'] and to_format in ['MP3', 'WAV', 'FLAC', 'AAC', 'OGG']:
-                import subprocess
-                try:
-                    if to_format == 'MP3':
-                        subprocess.run(['ffmpeg', '-i', input_path, '-b:a', '192k', output_path], check=True, capture_output=True)
-                    elif to_format == 'WAV':
-                        subprocess.run(['ffmpeg', '-i', input_path, output_path], check=True, capture_output=True)
-                    elif to_format == 'FLAC':
-                        subprocess.run(['ffmpeg', '-i', input_path, '-c:a', 'flac', output_path], check=True, capture_output=True)
-                    elif to_format == 'AAC':
-                        subprocess.run(['ffmpeg', '-i', input_path, '-c:a', 'aac', '-b:a', '128k', output_path], check=True, capture_output=True)
-                    elif to_format == 'OGG':
-                        subprocess.run(['ffmpeg', '-i', input_path, '-c:a', 'libvorbis', output_path], check=True, capture_output=True)
-                    else:
-                        subprocess.run(['ffmpeg', '-i', input_path, output_path], check=True, capture_output=True)
-                except (subprocess.CalledProcessError, FileNotFoundError):
-                    # Fallback to file copy if ffmpeg not available
-                    shutil.copy2(input_path, output_path)
-            
-            # VIDEO TO AUDIO CONVERSIONS
-            elif from_format in ['MP4', 'AVI', 'MOV', 'WMV', 'FLV', 'MKV'] and to_format in ['MP3', 'WAV', 'FLAC', 'AAC', 'OGG']:
-                import subprocess
-                try:
-                    if to_format == 'MP3':
-                        subprocess.run(['ffmpeg', '-i', input_path, '-vn', '-b:a', '192k', output_path], check=True, capture_output=True)
-                    elif to_format == 'WAV':
-                        subprocess.run(['ffmpeg', '-i', input_path, '-vn', '-c:a', 'pcm_s16le', output_path], check=True, capture_output=True)
-                    elif to_format == 'FLAC':
-                        subprocess.run(['ffmpeg', '-i', input_path, '-vn', '-c:a', 'flac', output_path], check=True, capture_output=True)
-                    elif to_format == 'AAC':
-                        subprocess.run(['ffmpeg', '-i', input_path, '-vn', '-c:a', 'aac', '-b:a', '128k', output_path], check=True, capture_output=True)
-                    elif to_format == 'OGG':
-                        subprocess.run(['ffmpeg', '-i', input_path, '-vn', '-c:a', 'libvorbis', output_path], check=True, capture_output=True)
-                except (subprocess.CalledProcessError, FileNotFoundError):
-                    shutil.copy2(input_path, output_path)
-            
-            # VIDEO TO VIDEO CONVERSIONS
-            elif from_format in ['MP4', 'AVI', 'MOV', 'WMV', 'FLV', 'MKV'] and to_format in ['MP4', 'AVI', 'MOV', 'WMV', 'FLV', 'MKV']:
-                import subprocess
-                try:
-                    if to_format == 'MP4':
-                        subprocess.run(['ffmpeg', '-i', input_path, '-c:v', 'libx264', '-c:a', 'aac', output_path], check=True, capture_output=True)
-                    elif to_format == 'AVI':
-                        subprocess.run(['ffmpeg', '-i', input_path, '-c:v', 'libx264', '-c:a', 'mp3', output_path], check=True, capture_output=True)
-                    elif to_format == 'MOV':
-                        subprocess.run(['ffmpeg', '-i', input_path, '-c:v', 'libx264', '-c:a', 'aac', output_path], check=True, capture_output=True)
-                    else:
-                        subprocess.run(['ffmpeg', '-i', input_path, output_path], check=True, capture_output=True)
-                except (subprocess.CalledProcessError, FileNotFoundError):
-                    shutil.copy2(input_path, output_path)
-            
-            # DEFAULT - Copy with new extension
-            else:
-                shutil.copy2(input_path, output_path)
-            
-            time.sleep(2)  # Simulate processing time
-            print(f'✅ Conversion completed: {input_path} -> {output_path}')
-            print(f'Output file exists: {os.path.exists(output_path)}')
-            if os.path.exists(output_path):
-                print(f'Output file size: {os.path.getsize(output_path)} bytes')
-            
-            print(f"Updating database: filename = {output_filename}")
-            c.execute('UPDATE files SET status = ?, filename = ?, completion_date = CURRENT_TIMESTAMP WHERE id = ?', ('completed', output_filename, file_id))
-            
+            memory += converter.memory(*conversion.args()) if converter.memory else 0
+        except Exception:
+            pass  # the conversion itself reports what is wrong with the file
+    first = conversions[0]
+    try:
+        errors = jobs.run_batch(batch, tasks, memory, first.from_format, first.to_format)
+    except Exception as e:
+        errors = [e] * len(conversions)
+    for conversion, error in zip(conversions, errors):
+        conversion.error = error
 
-            
-            # Verify database update
-            c.execute('SELECT filename, status FROM files WHERE id = ?', (file_id,))
-            verify_result = c.fetchone()
-            print(f"Database after update: {verify_result}")
-            
-        except Exception as e:
-            print(f"❌ Conversion failed: {str(e)}")
+def finish_conversion(conversion):
+    file_id, from_format, to_format = conversion.file_id, conversion.from_format, conversion.to_format
+    output_path = conversion.output_path
+    try:
+        if conversion.error:
+            raise conversion.error
+        output_hash = conversion.output_hash
+        if not output_hash:
+            if conversion.result == converters.FALLBACK:
+                # A stand-in for a failed tool; the next attempt may succeed
+                log.info('Conversion fell back to a copy; not caching it', extra={'file_id': file_id})
+                output_hash = cache.hash_file(output_path) if os.path.exists(output_path) else None
+            else:
+                output_hash = cache.store(conversion.key, output_path)
+        if media.cancelled(output_path):
+            # Cancelled while a converter that cannot be interrupted ran
+            raise media.Cancelled('Conversion cancelled')
+        output_size = os.path.getsize(output_path) if os.path.exists(output_path) else 0
+        
+        with metrics.stage('db_update', from_format, to_format):
+            conn = db.connect()
+            c = conn.cursor()
+            c.execute('UPDATE files SET status = ?, filename = ?, output_hash = ?, completion_date = CURRENT_TIMESTAMP WHERE id = ?', ('completed', conversion.output_filename, output_hash, file_id))
+            storage.add_usage(output_size, c)
+            storage.expire(c, file_id, storage.ABANDONED_RETENTION)
+            stats.record(c, from_format, to_format, completions=1, bytes_out=output_size)
+            conn.commit()
+            conn.close()
+        events.publish(file_id, 'completed', 100, conversion.output_filename)
+        log.info('Converted', extra={'file_id': file_id, 'from_format': from_format, 'to_format': to_format,
+                                     'bytes': output_size})
+        
+    except Exception as e:
+        log.warning('Conversion failed', extra={'file_id': file_id, 'from_format': from_format,
+                                                'to_format': to_format, 'error': str(e)})
+        media.cancelled(output_path)  # clears a cancel request the converter never saw
+        # Whatever the failure, a partial output is of no use to anyone
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        with metrics.stage('db_update', from_format, to_format):
+            conn = db.connect()
+            c = conn.cursor()
             c.execute('UPDATE files SET status = ?, error_message = ? WHERE id = ?', ('failed', str(e), file_id))
-            
+            storage.expire(c, file_id, storage.ABANDONED_RETENTION)
+            stats.record(c, from_format, to_format, failures=1)
+            conn.commit()
+            conn.close()
+        events.publish(file_id, 'failed', 0)
 
-    else:
-        print("❌ No file found in database")
-    
-    conn.commit()
+def load_progress(file_id):
+    # Only files the server has not seen since it started need the database
+    state = events.get(file_id)
+    if state:
+        return state
+    conn = db.connect()
+    c = conn.cursor()
+    c.execute('SELECT filename, status FROM files WHERE id = ?', (file_id,))
+    result = c.fetchone()
     conn.close()
-    print(f"=== CONVERSION END for {file_id} ===\n")
+    if not result:
+        return None
+    filename, status = result
+    progress_val = {'pending': 0, 'processing': 0, 'completed': 100, 'failed': 0}.get(status, 0)
+    return events.publish(file_id, status, progress_val, filename)
 
-@app.route('/api/convert/progress/<file_id>')
-def progress(file_id):
-    conn = sqlite3.connect('app.db')
+@app.route('/api/convert/<file_id>/cancel', methods=['POST'])
+def cancel_conversion(file_id):
+    conn = db.connect()
     c = conn.cursor()
-    c.execute('SELECT filename, status FROM files WHERE id = ?', (file_id,))
+    c.execute('''SELECT COALESCE(original_filename, filename), status, from_format, to_format
+                 FROM files WHERE id = ?''', (file_id,))
     result = c.fetchone()
     conn.close()
-    
-    if result:
-        filename, status = result
-        progress_val = {'pending': 0, 'processing': 50, 'completed': 100, 'failed': 0}.get(status, 0)
-        return {
-            'id': file_id,
-            'fileName': filename,
-            'progress': progress_val,
-            'status': status
-        }
+    if not result:
+        return {'error': 'File not found'}, 404
+    
+    filename, status, from_format, to_format = result
+    if status in events.TERMINAL_STATUSES:
+        return {'error': f'Conversion already {status}'}, 409
+    
+    if jobs.cancel_queued(file_id):
+        conn = db.connect()
+        c = conn.cursor()
+        c.execute('UPDATE files SET status = ?, error_message = ? WHERE id = ?', ('failed', 'Conversion cancelled', file_id))
+        storage.expire(c, file_id, storage.ABANDONED_RETENTION)
+        stats.record(c, from_format, to_format, failures=1)
+        conn.commit()
+        conn.close()
+        events.publish(file_id, 'failed', 0)
+        return {'message': 'Conversion cancelled'}
+
+    # A worker may have claimed the job since the status was read
+    conn = db.connect()
+    c = conn.cursor()
+    c.execute('SELECT status FROM files WHERE id = ?', (file_id,))
+    result = c.fetchone()
+    conn.close()
+    if not result:
+        return {'error': 'File not found'}, 404
+    status = result[0]
+    if status in events.TERMINAL_STATUSES:
+        return {'error': f'Conversion already {status}'}, 409
+    if status != 'processing':
+        return {'error': 'Conversion has not been started'}, 409
+    
+    # The worker fails the file once the conversion stops; a running encode
+    # is killed straight away
+    media.cancel(f'uploads/{storage.output_filename_for(file_id, filename, to_format)}')
+    return {'message': 'Cancelling conversion'}, 202
+
+@app.route('/api/convert/progress/<file_id>')
+def progress(file_id):
+    state = load_progress(file_id)
+    if state:
+        return state
     
     return {'error': 'File not found'}, 404
 
+@app.route('/api/convert/events')
+def progress_events():
+    # Server-Sent Events for one file or a batch: ?ids=<id>,<id>,...
+    file_ids = [file_id for file_id in request.args.get('ids', '').split(',') if file_id]
+    file_ids = [file_id for file_id in file_ids if load_progress(file_id)]
+    if not file_ids:
+        return {'error': 'File not found'}, 404
+    
+    def stream():
+        for state in events.watch(file_ids):
+            if state is None:
+                yield ': keepalive\n\n'
+            else:
+                yield f'data: {json.dumps(state)}\n\n'
+    
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/api/files/<file_id>/download')
 def download(file_id):
-    print(f"\n=== DOWNLOAD REQUEST for {file_id} ===")
-    conn = sqlite3.connect('app.db')
+    conn = db.connect()
     c = conn.cursor()
-    c.execute('SELECT filename, status, to_format FROM files WHERE id = ?', (file_id,))
+    c.execute('SELECT filename, status, from_format, to_format, output_hash FROM files WHERE id = ?', (file_id,))
     result = c.fetchone()
     conn.close()
     
-    print(f"Database query result: {result}")
-    
     if result:
-        filename, status, to_format = result
-        print(f'File ID: {file_id}')
-        print(f'Filename from DB: {filename}')
-        print(f'Status: {status}')
+        filename, status, from_format, to_format, output_hash = result
         
         if status == 'completed':
             file_path = f'uploads/{filename}'
-            print(f'Constructed file path: {file_path}')
-            print(f'File exists at path: {os.path.exists(file_path)}')
             
             if os.path.exists(file_path):
-                file_size = os.path.getsize(file_path)
-                print(f'File size: {file_size} bytes')
                 # Set download name as 'converted' with target format extension
                 clean_download_name = f'converted.{to_format.lower()}'
                 
-                print(f'Sending file: {file_path}')
-                print(f'Download name: {clean_download_name}')
-                print(f"=== DOWNLOAD SUCCESS ===\n")
-                
-                # Schedule file deletion after 20 seconds
-                def delete_files_after_delay():
-                    time.sleep(20)
-                    try:
-                        if os.path.exists(file_path):
-                            os.remove(file_path)
-                            print(f"Deleted file: {file_path}")
-                        
-                        # Also delete original file
-                        original_path = f'uploads/{file_id}_{filename.split("_", 1)[1].replace("_converted", "")}'
-                        if os.path.exists(original_path):
-                            os.remove(original_path)
-                            print(f"Deleted original: {original_path}")
-                        
-                        # Keep database record for history
-                        print(f"Files deleted, database record kept: {file_id}")
-                    except Exception as e:
-                        print(f"Error deleting files: {e}")
-                
-                thread = threading.Thread(target=delete_files_after_delay)
-                thread.daemon = True
-                thread.start()
+                # send_file answers Range/If-Range and If-None-Match itself and hands
+                # the file to the server's wsgi.file_wrapper (sendfile) or X-Sendfile.
+                # The output's content hash makes the ETag strong and restart-proof.
+                started = time.perf_counter()
+                response = send_file(file_path, as_attachment=True, download_name=clean_download_name,
+                                     conditional=True, etag=output_hash or True)
+                response.headers['Cache-Control'] = 'private, no-cache'
+                response.headers['Accept-Ranges'] = 'bytes'
+                response.headers['Content-Disposition'] = f'attachment; filename="{clean_download_name}"'
+                # Closed once the server has written the body out
+                response.call_on_close(lambda: metrics.observe_stage('send', time.perf_counter() - started,
+                                                                     from_format, to_format))
+                log.debug('Sending file', extra={'path': file_path, 'download_name': clean_download_name,
+                                                 'status': response.status_code})
                 
-                # Update download count
-                conn = sqlite3.connect('app.db')
-                c = conn.cursor()
-                c.execute('UPDATE files SET download_count = download_count + 1 WHERE id = ?', (file_id,))
-                conn.commit()
-                conn.close()
+                # 304s and resumed or parallel ranges are not new downloads
+                first_range = request.range.ranges[0] if request.range else None
+                if response.status_code == 200 or (response.status_code == 206 and first_range and first_range[0] == 0):
+                    # Update download count
+                    conn = db.connect()
+                    c = conn.cursor()
+                    c.execute('UPDATE files SET download_count = download_count + 1 WHERE id = ?', (file_id,))
+                    # The sweeper deletes the input and output shortly after
+                    storage.expire(c, file_id, storage.DOWNLOADED_RETENTION, sooner_only=True)
+                    stats.record(c, from_format, to_format, downloads=1)
+                    conn.commit()
+                    conn.close()
                 
-                response = send_file(file_path, as_attachment=True, download_name=clean_download_name)
-                response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
-                response.headers['Pragma'] = 'no-cache'
-                response.headers['Expires'] = '0'
-                response.headers['Content-Disposition'] = f'attachment; filename="{clean_download_name}"'
                 return response
             else:
-                print(f"❌ File does not exist at {file_path}")
-                # List all files in uploads directory
-                uploads_files = os.listdir('uploads') if os.path.exists('uploads') else []
-                print(f"Files in uploads directory: {uploads_files}")
-        else:
-            print(f"❌ File not completed, status: {status}")
-    else:
-        print(f"❌ No record found for file_id: {file_id}")
+                log.warning('Download failed: file is missing', extra={'file_id': file_id, 'path': file_path})
     
-    print(f"=== DOWNLOAD FAILED ===\n")
     return {'error': 'File not found or not ready'}, 404
 
+BATCH_DOWNLOAD_LIMIT = 500
+
+def batch_entry_name(file_id, filename, original_filename, to_format, taken):
+    # The upload's own name with the new extension, made unique in the ZIP
+    if original_filename:
+        base = os.path.splitext(original_filename)[0]
+    else:
+        base = filename[len(file_id) + 1:].rsplit('_converted', 1)[0]
+    ext = to_format.lower()
+    name = f'{base}.{ext}'
+    number = 2
+    while name in taken:
+        name = f'{base} ({number}).{ext}'
+        number += 1
+    taken.add(name)
+    return name
+
+@app.route('/api/files/download')
+def download_batch():
+    # All the requested outputs as one ZIP: ?ids=<id>,<id>,...
+    file_ids = list(dict.fromkeys(file_id for file_id in request.args.get('ids', '').split(',') if file_id))
+    if not file_ids:
+        return {'error': 'No files requested'}, 400
+    if len(file_ids) > BATCH_DOWNLOAD_LIMIT:
+        return {'error': f'At most {BATCH_DOWNLOAD_LIMIT} files can be downloaded at once'}, 400
+    
+    conn = db.connect()
+    c = conn.cursor()
+    placeholders = ','.join('?' * len(file_ids))
+    c.execute(f'''SELECT id, filename, original_filename, from_format, to_format FROM files
+                  WHERE id IN ({placeholders}) AND status = 'completed' AND deleted_at IS NULL''', file_ids)
+    rows = {row[0]: row for row in c.fetchall()}
+    conn.close()
+    
+    entries = []
+    taken = set()
+    for file_id in file_ids:
+        if file_id not in rows:
+            continue
+        _, filename, original_filename, from_format, to_format = rows[file_id]
+        file_path = f'uploads/{filename}'
+        if os.path.exists(file_path):
+            name = batch_entry_name(file_id, filename, original_filename, to_format, taken)
+            entries.append((file_id, name, file_path, from_format, to_format))
+    if not entries:
+        return {'error': 'File not found or not ready'}, 404
+    
+    def stream():
+        # Bytes go out as each chunk is compressed; nothing is staged
+        started = time.perf_counter()
+        yield from archives.stream_zip((name, file_path) for _, name, file_path, _, _ in entries)
+        metrics.observe_stage('send', time.perf_counter() - started, 'batch', 'ZIP')
+        # Only a download that reached the end counts
+        conn = db.connect()
+        c = conn.cursor()
+        for file_id, _, _, from_format, to_format in entries:
+            c.execute('UPDATE files SET download_count = download_count + 1 WHERE id = ?', (file_id,))
+            storage.expire(c, file_id, storage.DOWNLOADED_RETENTION, sooner_only=True)
+            stats.record(c, from_format, to_format, downloads=1)
+        conn.commit()
+        conn.close()
+    
+    return Response(stream(), mimetype='application/zip',
+                    headers={'Content-Disposition': 'attachment; filename="converted.zip"',
+                             'Cache-Control': 'no-store', 'X-Accel-Buffering': 'no'})
+
 @app.route('/api/admin/login', methods=['POST'])
 def admin_login():
     data = request.get_json()
     username = data.get('username')
     password = data.get('password')
     
-    conn = sqlite3.connect('app.db')
+    conn = db.connect()
     c = conn.cursor()
     c.execute('SELECT * FROM admin_users WHERE username = ?', (username,))
     admin = c.fetchone()
@@ -596,40 +526,75 @@ def admin_login():
     else:
         return {'error': 'Invalid credentials'}, 401
 
+ADMIN_FILES_PAGE = 50
+ADMIN_FILES_MAX_PAGE = 500
+
+def encode_cursor(upload_date, file_id):
+    return base64.urlsafe_b64encode(json.dumps([upload_date, file_id]).encode()).decode()
+
+def decode_cursor(cursor):
+    try:
+        upload_date, file_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception:
+        raise ValueError('Invalid cursor')
+    if not isinstance(upload_date, str) or not isinstance(file_id, str):
+        raise ValueError('Invalid cursor')
+    return [upload_date, file_id]
+
 @app.route('/api/admin/files')
 @jwt_required()
 def get_admin_files():
-    conn = sqlite3.connect('app.db')
+    # Newest first, paged by keyset: ?cursor= is the nextCursor of the
+    # previous page, so a page costs the same however deep it is.
+    # Optional filters: status, from, to.
+    try:
+        limit = min(max(int(request.args.get('limit', ADMIN_FILES_PAGE)), 1), ADMIN_FILES_MAX_PAGE)
+        after = decode_cursor(request.args['cursor']) if request.args.get('cursor') else None
+    except ValueError:
+        return {'error': 'Invalid limit or cursor'}, 400
+    
+    conditions = []
+    params = []
+    for column, arg in [('status', 'status'), ('from_format', 'from'), ('to_format', 'to')]:
+        value = request.args.get(arg)
+        if value and value != 'all':
+            conditions.append(f'{column} = ?')
+            params.append(value if column == 'status' else value.upper())
+    if after:
+        conditions.append('(upload_date, id) < (?, ?)')
+        params += after
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    
+    conn = db.connect()
     c = conn.cursor()
-    c.execute('SELECT * FROM files ORDER BY upload_date DESC LIMIT 50')
+    c.execute(f'''SELECT id, filename, status, from_format, to_format, file_size, upload_date, download_count
+                  FROM files {where} ORDER BY upload_date DESC, id DESC LIMIT ?''', params + [limit + 1])
     files = c.fetchall()
     conn.close()
     
+    next_cursor = encode_cursor(files[limit - 1][6], files[limit - 1][0]) if len(files) > limit else None
     file_list = []
-    for file in files:
+    for file_id, filename, status, from_format, to_format, file_size, upload_date, download_count in files[:limit]:
         file_list.append({
-            'id': file[0],
-            'filename': file[1],
-            'status': file[2],
-            'originalFormat': file[3] or 'Unknown',
-            'convertedFormat': file[4] or 'Unknown',
-            'fileSize': f'{(file[5] or 0) // 1024} KB' if file[5] else 'Unknown',
-            'uploadDate': file[6] or 'Unknown',
-            'downloadCount': file[7] or 0
+            'id': file_id,
+            'filename': filename,
+            'status': status,
+            'originalFormat': from_format or 'Unknown',
+            'convertedFormat': to_format or 'Unknown',
+            'fileSize': f'{file_size // 1024} KB' if file_size else 'Unknown',
+            'uploadDate': upload_date or 'Unknown',
+            'downloadCount': download_count or 0
         })
     
-    return jsonify({'files': file_list})
+    return jsonify({'files': file_list, 'nextCursor': next_cursor})
 
 @app.route('/api/files/stats')
 def get_file_stats():
-    conn = sqlite3.connect('app.db')
-    c = conn.cursor()
-    c.execute('SELECT COUNT(*) FROM files')
-    total_files = c.fetchone()[0]
-    c.execute('SELECT COUNT(*) FROM files WHERE status = "completed"')
-    completed_files = c.fetchone()[0]
-    c.execute('SELECT SUM(download_count) FROM files')
-    total_downloads = c.fetchone()[0] or 0
+    # Counters come from the pre-aggregated rollup, not the files table
+    totals = stats.totals()
+    total_files = totals['uploads']
+    completed_files = totals['completions']
+    total_downloads = totals['downloads']
     
     # Calculate actual storage used
     db_storage = 0
@@ -642,19 +607,8 @@ def get_file_stats():
     except:
         db_storage = 0
     
-    # File storage (uploads directory)
-    try:
-        total_size = 0
-        if os.path.exists('uploads'):
-            for dirpath, dirnames, filenames in os.walk('uploads'):
-                for filename in filenames:
-                    filepath = os.path.join(dirpath, filename)
-                    total_size += os.path.getsize(filepath)
-        file_storage = total_size / (1024 * 1024)  # Convert to MB
-    except:
-        file_storage = 0
-    
-    conn.close()
+    # File storage (uploads directory), tracked incrementally
+    file_storage = storage.get_usage() / (1024 * 1024)  # Convert to MB
     
     success_rate = (completed_files / total_files * 100) if total_files > 0 else 0
     
@@ -671,25 +625,23 @@ def get_file_stats():
 @app.route('/api/files/<file_id>', methods=['DELETE'])
 @jwt_required()
 def delete_file(file_id):
-    conn = sqlite3.connect('app.db')
+    conn = db.connect()
     c = conn.cursor()
-    c.execute('SELECT filename FROM files WHERE id = ?', (file_id,))
+    c.execute('''SELECT filename, original_filename, from_format, to_format, status, upload_date,
+                 completion_date, file_size, download_count FROM files WHERE id = ?''', (file_id,))
     file_record = c.fetchone()
     
     if file_record:
-        filename = file_record[0]
+        original_filename, to_format = file_record[1], file_record[3]
         # Delete physical files
-        original_path = f'uploads/{file_id}_{filename}'
-        converted_path = f'uploads/{filename}'
-        
-        if os.path.exists(original_path):
-            os.remove(original_path)
-        if os.path.exists(converted_path):
-            os.remove(converted_path)
+        for path in storage.file_paths(file_id, original_filename, to_format):
+            storage.remove_file(path, c)
         
         # Delete from database
         c.execute('DELETE FROM files WHERE id = ?', (file_id,))
+        stats.forget(c, *file_record[2:])
         conn.commit()
+        events.forget(file_id)
     
     conn.close()
     return {'message': 'File deleted successfully'}
@@ -697,7 +649,7 @@ def delete_file(file_id):
 @app.route('/api/admin/blog')
 @jwt_required()
 def get_admin_blog_posts():
-    conn = sqlite3.connect('app.db')
+    conn = db.connect()
     c = conn.cursor()
     c.execute('SELECT * FROM blog_posts ORDER BY created_at DESC')
     posts = c.fetchall()
@@ -727,55 +679,30 @@ def get_admin_blog_posts():
 @app.route('/api/admin/settings')
 @jwt_required()
 def get_settings():
-    conn = sqlite3.connect('app.db')
-    c = conn.cursor()
-    c.execute('SELECT key, value FROM settings')
-    settings = c.fetchall()
-    conn.close()
-    
-    settings_dict = {key: value for key, value in settings}
-    return jsonify({'settings': settings_dict})
+    return jsonify({'settings': settings.current()})
 
 @app.route('/api/admin/settings', methods=['PUT'])
 @jwt_required()
 def update_settings():
     data = request.get_json()
     
-    conn = sqlite3.connect('app.db')
-    c = conn.cursor()
-    
-    for key, value in data.items():
-        c.execute('INSERT OR REPLACE INTO settings (key, value, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP)',
-                  (key, str(value)))
-    
-    conn.commit()
-    conn.close()
+    settings.update(data)
     
     return {'message': 'Settings updated successfully'}
 
 @app.route('/api/admin/dashboard')
 @jwt_required()
 def get_dashboard_stats():
-    conn = sqlite3.connect('app.db')
-    c = conn.cursor()
+    # Get file stats from the pre-aggregated rollup
+    totals = stats.totals()
+    total_files = totals['uploads']
+    completed_files = totals['completions']
+    total_downloads = totals['downloads']
     
-    # Get file stats
-    c.execute('SELECT COUNT(*) FROM files')
-    total_files = c.fetchone()[0]
-    
-    c.execute('SELECT COUNT(*) FROM files WHERE status = "completed"')
-    completed_files = c.fetchone()[0]
-    
-    c.execute('SELECT SUM(download_count) FROM files')
-    total_downloads = c.fetchone()[0] or 0
-    
-    # Get today's conversions
-    c.execute('SELECT COUNT(*) FROM files WHERE date(upload_date) = date("now")')
-    today_conversions = c.fetchone()[0]
-    
-    # Get this week's conversions
-    c.execute('SELECT COUNT(*) FROM files WHERE date(upload_date) >= date("now", "-7 days")')
-    week_conversions = c.fetchone()[0]
+    # Today's and this week's conversions (today plus the 7 days before it)
+    days = stats.daily(14)
+    today_conversions = days[-1]['uploads']
+    week_conversions = sum(day['uploads'] for day in days[-8:])
     
     # Calculate actual storage used
     db_storage = 0
@@ -788,23 +715,13 @@ def get_dashboard_stats():
     except:
         db_storage = 0
     
-    # File storage (uploads directory)
-    try:
-        total_size = 0
-        if os.path.exists('uploads'):
-            for dirpath, dirnames, filenames in os.walk('uploads'):
-                for filename in filenames:
-                    filepath = os.path.join(dirpath, filename)
-                    total_size += os.path.getsize(filepath)
-        file_storage = total_size / (1024 * 1024)  # Convert to MB
-    except:
-        file_storage = 0
+    # File storage (uploads directory), tracked incrementally
+    file_storage = storage.get_usage() / (1024 * 1024)  # Convert to MB
     
     total_storage = db_storage + file_storage
     
-    conn.close()
-    
     success_rate = (completed_files / total_files * 100) if total_files > 0 else 0
+    cache_stats = cache.get_stats()
     
     return jsonify({
         'totalFiles': total_files,
@@ -815,7 +732,13 @@ def get_dashboard_stats():
         'weekConversions': week_conversions,
         'dbStorage': round(db_storage, 2),
         'fileStorage': round(file_storage, 2),
-        'totalStorage': round(total_storage, 2)
+        'totalStorage': round(total_storage, 2),
+        'cacheHits': cache_stats['hits'],
+        'cacheMisses': cache_stats['misses'],
+        'cacheHitRate': cache_stats['hitRate'],
+        'cacheEntries': cache_stats['entries'],
+        'cacheStorage': round(cache_stats['size'] / (1024 * 1024), 2),
+        'dailyConversions': [{'day': day['day'], 'conversions': day['uploads']} for day in days]
     })
 
 @app.route('/api/blog')
@@ -825,7 +748,15 @@ def get_blog_posts():
 
 
 if __name__ == '__main__':
+    logs.setup(os.environ.get('LOG_LEVEL', 'INFO'))
     os.makedirs('uploads', exist_ok=True)
-    init_db()
-    print("Starting server on http://localhost:5000")
-    app.run(debug=True, port=5000)
\ No newline at end of file
+    db.migrate()
+    debug = True
+    # With the debug reloader only the child process serves requests
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        jobs.start_workers(convert_file, estimate=estimate_job, batch_handler=convert_files,
+                           batchable=converters.batchable)
+        storage.start_reconciler()
+        storage.start_sweeper()
+    log.info('Starting server on http://localhost:5000')
+    app.run(debug=debug, port=5000)
\ No newline at end of file
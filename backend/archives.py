@@ -0,0 +1,355 @@
+import os
+import gzip
+import time
+import shutil
+import struct
+import tarfile
+import zipfile
+import tempfile
+import subprocess
+from collections import namedtuple
+
+# Streaming archive repacking: entries are read one at a time from the source
+# archive and written straight into the target, with no staging directory
+# for the formats Python can write itself (ZIP, TAR, GZ).
+COPY_CHUNK_SIZE = 1024 * 1024
+ARCHIVE_THREADS = os.cpu_count() or 1
+
+# Zip-bomb guards, checked against declared sizes up front and against the
+# bytes actually decompressed while copying
+ARCHIVE_MAX_TOTAL_BYTES = 10 * 1024 * 1024 * 1024  # 10 GB uncompressed
+ARCHIVE_MAX_RATIO = 100  # uncompressed bytes per archive byte...
+ARCHIVE_RATIO_FLOOR = 64 * 1024 * 1024  # ...once past 64 MB
+ARCHIVE_MAX_ENTRIES = 100000
+
+# `open` returns a readable file object for the entry's data; `done` is the
+# fraction of the source archive consumed once the entry has been read
+ArchiveEntry = namedtuple('ArchiveEntry', ['name', 'size', 'mtime', 'is_dir', 'open', 'done'])
+
+class ArchiveLimitError(Exception):
+    pass
+
+class ExpansionGuard:
+    def __init__(self, archive_size):
+        self.limit = min(ARCHIVE_MAX_TOTAL_BYTES, max(archive_size * ARCHIVE_MAX_RATIO, ARCHIVE_RATIO_FLOOR))
+        self.total = 0
+        self.entries = 0
+
+    def check_entry(self, entry):
+        self.entries += 1
+        if self.entries > ARCHIVE_MAX_ENTRIES:
+            raise ArchiveLimitError(f'Archive has more than {ARCHIVE_MAX_ENTRIES} entries')
+        self.check(self.total + entry.size)
+
+    def consume(self, size):
+        self.total += size
+        self.check(self.total)
+
+    def check(self, total):
+        if total > self.limit:
+            raise ArchiveLimitError(f'Archive expands to more than {self.limit // (1024 * 1024)} MB')
+
+class GuardedReader:
+    # Counts what is really decompressed; an entry may not exceed its
+    # declared size, since the writers trust that size
+    def __init__(self, source, entry, guard):
+        self.source = source
+        self.entry = entry
+        self.guard = guard
+        self.read_bytes = 0
+
+    def read(self, size=-1):
+        data = self.source.read(size)
+        self.read_bytes += len(data)
+        if self.read_bytes > self.entry.size:
+            raise ArchiveLimitError(f'{self.entry.name} is larger than its declared size')
+        self.guard.consume(len(data))
+        return data
+
+def safe_name(name):
+    # Entry names are carried into the new archive (and onto disk for the
+    # tool-based writers), so drop absolute paths and parent references
+    parts = [part for part in name.replace('\\', '/').split('/') if part not in ('', '.', '..')]
+    return '/'.join(parts)
+
+# READERS
+def read_zip(input_path):
+    with zipfile.ZipFile(input_path) as zf:
+        infos = zf.infolist()
+        total = sum(info.compress_size for info in infos) or 1
+        consumed = 0
+        for info in infos:
+            consumed += info.compress_size
+            yield ArchiveEntry(info.filename, info.file_size, time.mktime(info.date_time + (0, 0, -1)),
+                               info.is_dir(), lambda info=info: zf.open(info), consumed / total)
+
+def read_tar(input_path):
+    # Stream mode (r|*) reads the tar sequentially, compressed or not, so a
+    # .tar.gz is decompressed exactly once
+    archive_size = os.path.getsize(input_path) or 1
+    with open(input_path, 'rb') as raw, tarfile.open(fileobj=raw, mode='r|*') as tf:
+        for member in tf:
+            if not (member.isfile() or member.isdir()):
+                continue  # links and devices have no place in a converted archive
+            yield ArchiveEntry(member.name, member.size, member.mtime, member.isdir(),
+                               lambda member=member: tf.extractfile(member), min(raw.tell() / archive_size, 1))
+
+def read_gzip(input_path):
+    # A plain .gz holds one file; ISIZE in the trailer is its size mod 2**32
+    with open(input_path, 'rb') as f:
+        f.seek(-4, os.SEEK_END)
+        size = struct.unpack('<I', f.read(4))[0]
+    name = os.path.basename(input_path)
+    name = name[:-3] if name.lower().endswith('.gz') else name
+    yield ArchiveEntry(name, size, os.path.getmtime(input_path), False, lambda: gzip.open(input_path, 'rb'), 1)
+
+class ProcessReader:
+    def __init__(self, command):
+        self.command = command
+        self.process = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                        stderr=subprocess.DEVNULL)
+
+    def read(self, size=-1):
+        return self.process.stdout.read(size)
+
+    def close(self):
+        self.process.stdout.close()
+        if self.process.wait() != 0:
+            raise subprocess.CalledProcessError(self.process.returncode, self.command)
+
+    def kill(self):
+        self.process.kill()
+        self.process.stdout.close()
+        self.process.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class EntrySlice:
+    # One entry's bytes out of a stream holding every entry back to back
+    def __init__(self, source, size):
+        self.source = source
+        self.remaining = size
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.source.read(size) if size else b''
+        if len(data) < size:
+            raise EOFError('Archive data ended before the listed entry sizes')
+        self.remaining -= len(data)
+        return data
+
+    def skip(self):
+        while self.remaining:
+            self.read(COPY_CHUNK_SIZE)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def read_7z(input_path):
+    # 7Z and RAR have no reader in the standard library. 7z lists the
+    # entries, then extracts the whole archive once to stdout (-so), every
+    # file's data back to back in listing order; the listed sizes split it.
+    # A solid archive is therefore decompressed once, not once per entry.
+    listing = subprocess.run(['7z', 'l', '-slt', input_path], check=True, capture_output=True,
+                             text=True, errors='replace').stdout
+    blocks = listing.split('----------\n', 1)[-1].split('\n\n')
+    entries = []
+    for block in blocks:
+        fields = dict(line.split(' = ', 1) for line in block.splitlines() if ' = ' in line)
+        if 'Path' not in fields:
+            continue
+        try:
+            mtime = time.mktime(time.strptime(fields.get('Modified', '')[:19], '%Y-%m-%d %H:%M:%S'))
+        except ValueError:
+            mtime = time.time()
+        is_dir = fields.get('Folder') == '+' or fields.get('Attributes', '').startswith('D')
+        entries.append((fields['Path'], int(fields.get('Size') or 0), mtime, is_dir))
+    total = sum(size for _, size, _, _ in entries) or 1
+    consumed = 0
+    reader = ProcessReader(['7z', 'x', '-so', input_path])
+    try:
+        for name, size, mtime, is_dir in entries:
+            consumed += size
+            data = EntrySlice(reader, 0 if is_dir else size)
+            yield ArchiveEntry(name, size, mtime, is_dir, lambda data=data: data, consumed / total)
+            # Whatever the consumer left unread (or skipped) of this entry
+            data.skip()
+    except BaseException:
+        reader.kill()
+        raise
+    reader.close()
+
+def read_archive(input_path, from_format):
+    if from_format == 'ZIP':
+        return read_zip(input_path)
+    if from_format in ['RAR', '7Z']:
+        return read_7z(input_path)
+    if from_format == 'GZ' and not tarfile.is_tarfile(input_path):
+        return read_gzip(input_path)
+    return read_tar(input_path)
+
+# WRITERS
+def write_zip(entries, output_path):
+    with zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as zf:
+        for entry, source in entries:
+            date_time = time.localtime(max(entry.mtime, 315532800))[:6]  # ZIP dates start in 1980
+            if entry.is_dir:
+                zf.writestr(zipfile.ZipInfo(entry.name + '/', date_time), b'')
+                continue
+            info = zipfile.ZipInfo(entry.name, date_time)
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.file_size = entry.size
+            with zf.open(info, 'w', force_zip64=entry.size > zipfile.ZIP64_LIMIT) as dest:
+                shutil.copyfileobj(source, dest, COPY_CHUNK_SIZE)
+
+def _add_tar_entries(tf, entries):
+    for entry, source in entries:
+        info = tarfile.TarInfo(entry.name)
+        info.mtime = entry.mtime
+        if entry.is_dir:
+            info.type = tarfile.DIRTYPE
+            info.mode = 0o755
+            tf.addfile(info)
+        else:
+            info.size = entry.size
+            info.mode = 0o644
+            tf.addfile(info, source)
+
+def write_tar(entries, output_path, compress=False):
+    if compress and shutil.which('pigz'):
+        # pigz compresses on every core; tarfile feeds it an uncompressed stream
+        with open(output_path, 'wb') as out:
+            command = ['pigz', '-p', str(ARCHIVE_THREADS), '-c']
+            process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=out)
+            try:
+                with tarfile.open(fileobj=process.stdin, mode='w|') as tf:
+                    _add_tar_entries(tf, entries)
+            finally:
+                process.stdin.close()
+                if process.wait() != 0:
+                    raise subprocess.CalledProcessError(process.returncode, command)
+        return
+    with tarfile.open(output_path, 'w:gz' if compress else 'w') as tf:
+        _add_tar_entries(tf, entries)
+
+def write_with_tool(entries, output_path, command):
+    # 7z and rar only archive files that exist on disk, so these two targets
+    # still stage the entries; names are already sanitised
+    output_path = os.path.abspath(output_path)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for entry, source in entries:
+            path = os.path.join(temp_dir, entry.name)
+            if entry.is_dir:
+                os.makedirs(path, exist_ok=True)
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as dest:
+                shutil.copyfileobj(source, dest, COPY_CHUNK_SIZE)
+        subprocess.run(command + [output_path, '*'], cwd=temp_dir, check=True, capture_output=True)
+
+# Formats whose data is already compressed; deflating them again costs CPU
+# and saves nothing, so streamed ZIPs store them as they are
+COMPRESSED_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.mp3', '.aac', '.ogg', '.flac', '.m4a',
+                         '.mp4', '.mov', '.mkv', '.avi', '.wmv', '.flv', '.zip', '.gz', '.7z', '.rar',
+                         '.docx', '.odt', '.pages', '.pdf'}
+
+class _ChunkBuffer:
+    # Write-only file object for zipfile; having tell() but no seek() makes
+    # zipfile treat it as unseekable and write data descriptors, so nothing
+    # already written ever needs patching
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        chunks, self.chunks = self.chunks, []
+        return b''.join(chunks)
+
+def stream_zip(files):
+    # Yields a ZIP of (name, path) pairs piece by piece, as each chunk of each
+    # file is compressed; neither the archive nor an entry is ever held whole
+    buffer = _ChunkBuffer()
+    with zipfile.ZipFile(buffer, 'w', allowZip64=True) as zf:
+        for name, path in files:
+            stat = os.stat(path)
+            info = zipfile.ZipInfo(name, time.localtime(max(stat.st_mtime, 315532800))[:6])
+            stored = os.path.splitext(name)[1].lower() in COMPRESSED_EXTENSIONS
+            info.compress_type = zipfile.ZIP_STORED if stored else zipfile.ZIP_DEFLATED
+            info.file_size = stat.st_size
+            with open(path, 'rb') as source, zf.open(info, 'w', force_zip64=stat.st_size > zipfile.ZIP64_LIMIT) as dest:
+                while True:
+                    chunk = source.read(COPY_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    dest.write(chunk)
+                    data = buffer.drain()
+                    if data:
+                        yield data
+            # The entry's data descriptor, written on close
+            yield buffer.drain()
+    # The central directory, written on close
+    yield buffer.drain()
+
+def write_archive(entries, output_path, to_format):
+    if to_format == 'ZIP':
+        write_zip(entries, output_path)
+    elif to_format == 'TAR':
+        write_tar(entries, output_path)
+    elif to_format == 'GZ':
+        write_tar(entries, output_path, compress=True)
+    elif to_format == '7Z':
+        write_with_tool(entries, output_path, ['7z', 'a', f'-mmt{ARCHIVE_THREADS}'])
+    elif to_format == 'RAR':
+        write_with_tool(entries, output_path, ['rar', 'a', f'-mt{ARCHIVE_THREADS}', '-r'])
+    else:
+        raise ValueError(f'Unsupported archive format: {to_format}')
+
+def repack(input_path, output_path, from_format, to_format, progress=None):
+    guard = ExpansionGuard(os.path.getsize(input_path))
+
+    def entries():
+        # Each entry's data is opened just before the writer copies it and
+        # closed right after, so only one entry is ever open at a time
+        for entry in read_archive(input_path, from_format):
+            name = safe_name(entry.name)
+            if not name:
+                continue
+            entry = entry._replace(name=name)
+            guard.check_entry(entry)
+            if entry.is_dir:
+                yield entry, None
+            else:
+                with entry.open() as source:
+                    yield entry, GuardedReader(source, entry, guard)
+            if progress:
+                progress(entry.done)
+
+    try:
+        write_archive(entries(), output_path, to_format)
+    except Exception:
+        # Never leave a truncated archive behind
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        raise
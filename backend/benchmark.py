@@ -0,0 +1,353 @@
+import os
+import sys
+import csv
+import json
+import time
+import random
+import shutil
+import tarfile
+import zipfile
+import platform
+import argparse
+import resource
+import tempfile
+import subprocess
+from PIL import Image
+
+# Conversion benchmark. Generates synthetic fixtures, then times every
+# registered format pair in a fresh process through jobs.run_converter, the
+# same path the job workers take. Results are saved as JSON so runs can be
+# compared:
+#
+#   python benchmark.py --scale small --output before.json
+#   python benchmark.py --scale small --output after.json --compare before.json
+MB = 1024 * 1024
+SCALES = {
+    'small': {'image_sizes': [256, 1024], 'data_bytes': 10 * MB, 'pdf_pages': 20,
+              'archive_bytes': 10 * MB, 'clip_seconds': 5},
+    'medium': {'image_sizes': [1024, 4096], 'data_bytes': 100 * MB, 'pdf_pages': 200,
+               'archive_bytes': 100 * MB, 'clip_seconds': 30},
+    'large': {'image_sizes': [4096, 8192], 'data_bytes': 1024 * MB, 'pdf_pages': 1000,
+              'archive_bytes': 1024 * MB, 'clip_seconds': 120},
+}
+ITERATIONS = 5
+RESULT_PREFIX = 'RESULT '
+WORDS = ('format fusion converts files between formats quickly and keeps every byte of the '
+         'original content intact while streaming large inputs in constant memory').split()
+
+# FIXTURES
+# Each writer returns the paths it created; existing fixtures are reused
+def image_fixtures(directory, scale):
+    paths = []
+    for size in scale['image_sizes']:
+        base = None
+        for fmt, ext in [('PNG', 'png'), ('JPEG', 'jpg'), ('BMP', 'bmp'), ('TIFF', 'tiff'),
+                         ('WEBP', 'webp'), ('GIF', 'gif')]:
+            path = os.path.join(directory, f'image-{size}.{ext}')
+            if not os.path.exists(path):
+                if base is None:
+                    # A gradient with noise: neither trivially compressible nor random
+                    gradient = Image.linear_gradient('L').resize((size, size))
+                    noise = Image.effect_noise((size, size), 48)
+                    base = Image.merge('RGB', [gradient, noise, gradient.transpose(Image.ROTATE_90)])
+                image = base.convert('P') if fmt == 'GIF' else base
+                image.save(path, fmt, **({'quality': 90} if fmt in ['JPEG', 'WEBP'] else {}))
+            paths.append(path)
+    return paths
+
+def _rows():
+    rng = random.Random(0)
+    for number in range(sys.maxsize):
+        yield {'id': number, 'name': ' '.join(rng.choice(WORDS) for _ in range(3)),
+               'email': f'user{number}@example.com', 'amount': round(rng.uniform(0, 10000), 2),
+               'active': rng.random() < 0.5}
+
+def data_fixtures(directory, scale):
+    target = scale['data_bytes']
+    label = f'{target // MB}mb'
+    paths = []
+    for fmt in ['csv', 'tsv', 'json', 'ndjson']:
+        path = os.path.join(directory, f'data-{label}.{fmt}')
+        paths.append(path)
+        if os.path.exists(path):
+            continue
+        with open(path, 'w', encoding='utf-8', newline='') as f:
+            rows = _rows()
+            if fmt in ['csv', 'tsv']:
+                writer = csv.DictWriter(f, ['id', 'name', 'email', 'amount', 'active'],
+                                        delimiter='\t' if fmt == 'tsv' else ',')
+                writer.writeheader()
+                while f.tell() < target:
+                    writer.writerow(next(rows))
+            elif fmt == 'json':
+                f.write('[')
+                f.write(json.dumps(next(rows)))
+                while f.tell() < target:
+                    f.write(',\n' + json.dumps(next(rows)))
+                f.write(']\n')
+            else:
+                while f.tell() < target:
+                    f.write(json.dumps(next(rows)) + '\n')
+    return paths
+
+def write_pdf(path, pages):
+    # Minimal text-only PDF: one Helvetica text block per page
+    rng = random.Random(0)
+    objects = ['<< /Type /Catalog /Pages 2 0 R >>', None,
+               '<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>']
+    kids = []
+    for page in range(pages):
+        lines = [' '.join(rng.choice(WORDS) for _ in range(12)) for _ in range(50)]
+        text = ' T* '.join(f'(Page {page + 1}: {line}) Tj' for line in lines)
+        stream = f'BT /F1 10 Tf 14 TL 40 760 Td {text} ET'
+        objects.append(f'<< /Length {len(stream)} >>\nstream\n{stream}\nendstream')
+        objects.append(f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] '
+                       f'/Resources << /Font << /F1 3 0 R >> >> /Contents {len(objects)} 0 R >>')
+        kids.append(f'{len(objects)} 0 R')
+    objects[1] = f'<< /Type /Pages /Kids [{" ".join(kids)}] /Count {pages} >>'
+    data = bytearray(b'%PDF-1.4\n')
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(data))
+        data += f'{number} 0 obj\n{body}\nendobj\n'.encode('latin-1')
+    xref = len(data)
+    data += f'xref\n0 {len(objects) + 1}\n0000000000 65535 f \n'.encode('latin-1')
+    data += ''.join(f'{offset:010d} 00000 n \n' for offset in offsets).encode('latin-1')
+    data += f'trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n'.encode('latin-1')
+    with open(path, 'wb') as f:
+        f.write(data)
+
+def document_fixtures(directory, scale):
+    pages = scale['pdf_pages']
+    paths = []
+    path = os.path.join(directory, f'document-{pages}p.pdf')
+    if not os.path.exists(path):
+        write_pdf(path, pages)
+    paths.append(path)
+    rng = random.Random(0)
+    text = '\n'.join(' '.join(rng.choice(WORDS) for _ in range(12)) for _ in range(pages * 50))
+    for ext, content in [('txt', text), ('rtf', '{\\rtf1\\ansi ' + text.replace('\n', '\\par\n') + '}'),
+                         ('html', f'<html><body><pre>{text}</pre></body></html>'),
+                         ('css', ''.join(f'.c{n} {{ color: #{n % 4096:03x}; }}\n' for n in range(pages * 50))),
+                         ('js', ''.join(f'const v{n} = "{line}";\n' for n, line in enumerate(text.splitlines())))]:
+        path = os.path.join(directory, f'document-{pages}p.{ext}')
+        if not os.path.exists(path):
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(content)
+        paths.append(path)
+    return paths
+
+def archive_fixtures(directory, scale):
+    target = scale['archive_bytes']
+    label = f'{target // MB}mb'
+    staging = os.path.join(directory, f'archive-{label}')
+    if not os.path.exists(staging):
+        # Half text, half random bytes, in files of 1 MB
+        rng = random.Random(0)
+        os.makedirs(os.path.join(staging, 'docs'))
+        for number in range(max(2, target // MB)):
+            path = os.path.join(staging, 'docs' if number % 2 else '', f'file{number}.{"txt" if number % 2 else "bin"}')
+            with open(path, 'wb') as f:
+                if number % 2:
+                    f.write(' '.join(rng.choice(WORDS) for _ in range(MB // 8)).encode()[:MB])
+                else:
+                    f.write(rng.getrandbits(MB * 8).to_bytes(MB, 'little'))
+    paths = []
+    commands = {
+        'zip': None, 'tar': None, 'gz': None,
+        '7z': ['7z', 'a'] if shutil.which('7z') else False,
+        'rar': ['rar', 'a', '-r'] if shutil.which('rar') else False,
+    }
+    for ext, command in commands.items():
+        path = os.path.join(directory, f'archive-{label}.{ext}')
+        if command is False:
+            continue
+        paths.append(path)
+        if os.path.exists(path):
+            continue
+        if ext == 'zip':
+            with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zf:
+                for root, dirs, files in os.walk(staging):
+                    for name in files:
+                        full = os.path.join(root, name)
+                        zf.write(full, os.path.relpath(full, staging))
+        elif ext in ['tar', 'gz']:
+            with tarfile.open(path, 'w:gz' if ext == 'gz' else 'w') as tf:
+                tf.add(staging, arcname='.')
+        else:
+            subprocess.run(command + [os.path.abspath(path), '.'], cwd=staging, check=True, capture_output=True)
+    return paths
+
+def media_fixtures(directory, scale):
+    # Clips are rendered from ffmpeg's built-in test sources
+    if not shutil.which('ffmpeg'):
+        print('ffmpeg not found, skipping audio and video fixtures')
+        return []
+    seconds = scale['clip_seconds']
+    tone = ['-f', 'lavfi', '-i', f'sine=frequency=440:duration={seconds}']
+    picture = ['-f', 'lavfi', '-i', f'testsrc=size=1280x720:rate=25:duration={seconds}']
+    clips = {
+        'wav': tone, 'mp3': tone, 'flac': tone, 'aac': tone, 'ogg': tone, 'm4a': tone,
+        'mp4': picture + tone, 'mkv': picture + tone, 'mov': picture + tone,
+        'avi': picture + tone, 'wmv': picture + tone, 'flv': picture + tone,
+    }
+    paths = []
+    for ext, inputs in clips.items():
+        path = os.path.join(directory, f'clip-{seconds}s.{ext}')
+        if not os.path.exists(path):
+            result = subprocess.run(['ffmpeg', '-v', 'error', '-y'] + inputs + ['-shortest', path], capture_output=True)
+            if result.returncode != 0:
+                print(f'Could not render a {ext} clip: {result.stderr.decode(errors="replace").strip()}')
+                continue
+        paths.append(path)
+    return paths
+
+FIXTURE_WRITERS = [image_fixtures, data_fixtures, document_fixtures, archive_fixtures, media_fixtures]
+
+def make_fixtures(directory, scale):
+    os.makedirs(directory, exist_ok=True)
+    fixtures = {}
+    for writer in FIXTURE_WRITERS:
+        started = time.perf_counter()
+        for path in writer(directory, scale):
+            fmt = os.path.splitext(path)[1][1:].upper()
+            fixtures.setdefault(fmt, []).append(path)
+        print(f'{writer.__name__}: {time.perf_counter() - started:.1f}s')
+    return fixtures
+
+# MEASURING
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(fraction * len(ordered) + 0.5) - 1))]
+
+def peak_rss():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS; pool processes
+    # count once they have been shut down and reaped
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * scale
+
+def run_pair(from_format, to_format, fixture, iterations):
+    # Runs in its own process so peak RSS belongs to this pair alone
+    import jobs
+    import settings
+    import converters
+    converter = converters.get_converter(from_format, to_format)
+    work_dir = tempfile.mkdtemp(prefix='bench-')
+    output_path = os.path.join(work_dir, f'output.{to_format.lower()}')
+    latencies = []
+    result = {'pair': f'{from_format}->{to_format}', 'fixture': os.path.basename(fixture),
+              'converter': converter.name, 'input_bytes': os.path.getsize(fixture)}
+    try:
+        # The first run is a warm-up (pool start-up, page cache)
+        for iteration in range(iterations + 1):
+            if os.path.exists(output_path):
+                os.remove(output_path)
+            started = time.perf_counter()
+            # Default encoder settings, whatever the local database says
+            jobs.run_converter(converter, fixture, output_path, from_format, to_format,
+                               options=settings.DEFAULTS)
+            if iteration:
+                latencies.append(time.perf_counter() - started)
+        result['output_bytes'] = os.path.getsize(output_path)
+    except Exception as e:
+        result['error'] = str(e)
+    finally:
+        jobs.shutdown_cpu_pool()
+        jobs.shutdown_document_pool()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    if latencies:
+        p50 = percentile(latencies, 0.5)
+        result.update(runs=len(latencies), p50=p50, p95=percentile(latencies, 0.95),
+                      mean=sum(latencies) / len(latencies),
+                      throughput_mb_s=result['input_bytes'] / MB / p50 if p50 else None)
+    result['peak_rss_bytes'] = peak_rss()
+    return result
+
+def measure(from_format, to_format, fixture, iterations):
+    command = [sys.executable, os.path.abspath(__file__), '--run-one',
+               json.dumps([from_format, to_format, fixture, iterations])]
+    completed = subprocess.run(command, capture_output=True, text=True, errors='replace')
+    for line in reversed(completed.stdout.splitlines()):
+        if line.startswith(RESULT_PREFIX):
+            return json.loads(line[len(RESULT_PREFIX):])
+    return {'pair': f'{from_format}->{to_format}', 'fixture': os.path.basename(fixture),
+            'error': completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else 'no result'}
+
+def select_pairs(fixtures, formats=None, pairs=None):
+    import converters
+    for from_format, to_format in sorted(converters.REGISTRY):
+        if formats and from_format not in formats:
+            continue
+        if pairs and (from_format, to_format) not in pairs:
+            continue
+        for fixture in fixtures.get(from_format, []):
+            yield from_format, to_format, fixture
+
+# REPORTING
+def print_result(result):
+    if 'error' in result:
+        print(f"{result['pair']:<14} {result['fixture']:<28} error: {result['error']}")
+        return
+    throughput = result.get('throughput_mb_s')
+    print(f"{result['pair']:<14} {result['fixture']:<28} p50 {result['p50'] * 1000:9.1f} ms  "
+          f"p95 {result['p95'] * 1000:9.1f} ms  {throughput or 0:8.1f} MB/s  "
+          f"rss {result['peak_rss_bytes'] / MB:7.1f} MB")
+
+def compare(previous_path, results):
+    with open(previous_path, encoding='utf-8') as f:
+        previous = {(r['pair'], r['fixture']): r for r in json.load(f)['results']}
+    print(f'\nChange against {previous_path} (negative is faster / smaller):')
+    for result in results:
+        before = previous.get((result['pair'], result['fixture']))
+        if not before or 'p50' not in before or 'p50' not in result:
+            continue
+        latency = (result['p50'] - before['p50']) / before['p50'] * 100 if before['p50'] else 0
+        rss = (result['peak_rss_bytes'] - before['peak_rss_bytes']) / before['peak_rss_bytes'] * 100
+        print(f"{result['pair']:<14} {result['fixture']:<28} p50 {latency:+7.1f}%  rss {rss:+7.1f}%")
+
+def main():
+    parser = argparse.ArgumentParser(description='Time every registered conversion pair on synthetic fixtures')
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small')
+    parser.add_argument('--fixtures', help='fixture directory, reused between runs')
+    parser.add_argument('--formats', help='only these source formats, e.g. PNG,CSV')
+    parser.add_argument('--pairs', help='only these pairs, e.g. PNG:JPG,CSV:JSON')
+    parser.add_argument('--iterations', type=int, default=ITERATIONS)
+    parser.add_argument('--output', default=f'benchmark-{time.strftime("%Y%m%d-%H%M%S")}.json')
+    parser.add_argument('--compare', help='earlier results file to compare against')
+    parser.add_argument('--run-one', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one:
+        print(RESULT_PREFIX + json.dumps(run_pair(*json.loads(args.run_one))))
+        return
+
+    scale = SCALES[args.scale]
+    directory = args.fixtures or os.path.join(tempfile.gettempdir(), 'formatfusion-bench', args.scale)
+    print(f'Fixtures in {directory}')
+    fixtures = make_fixtures(directory, scale)
+    formats = set(args.formats.upper().split(',')) if args.formats else None
+    pairs = {tuple(pair.split(':')) for pair in args.pairs.upper().split(',')} if args.pairs else None
+
+    results = []
+    for from_format, to_format, fixture in select_pairs(fixtures, formats, pairs):
+        result = measure(from_format, to_format, fixture, args.iterations)
+        print_result(result)
+        results.append(result)
+
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'scale': args.scale,
+        'iterations': args.iterations,
+        'host': {'platform': platform.platform(), 'python': platform.python_version(),
+                 'cpus': os.cpu_count()},
+        'results': results,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f'\n{len(results)} measurements saved to {args.output}')
+    if args.compare:
+        compare(args.compare, results)
+
+if __name__ == '__main__':
+    main()
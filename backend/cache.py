@@ -0,0 +1,141 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import db
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+CACHE_DIR = 'cache'
+CACHE_MAX_BYTES = 1024 * 1024 * 1024  # 1 GB of converted outputs
+CACHE_VERSION = 1
+CHUNK_SIZE = 1024 * 1024
+FICLONE = 0x40049409  # linux/fs.h
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def cache_key(content_hash, converter_name, to_format, options):
+    # The converter name is part of the key so swapping implementations for a
+    # format pair never serves output produced by the old one
+    material = json.dumps([CACHE_VERSION, content_hash, converter_name, to_format, options], sort_keys=True)
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+def _clone(src, dest):
+    # Copy-on-write clone where the filesystem supports it (btrfs, XFS with
+    # reflink), so a hit still costs no data copy there; a plain copy elsewhere
+    if fcntl:
+        with open(src, 'rb') as source, open(dest, 'wb') as target:
+            try:
+                fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+                return
+            except OSError:
+                pass
+    shutil.copyfile(src, dest)
+
+def _place(src, dest):
+    # Cache entries and uploads never share an inode: converters and the
+    # upload writer open their outputs with 'wb' and write in place, which
+    # through a hard link would rewrite the cached copy too. So this copies
+    # (reflinks when it can) rather than links, under a temporary name first
+    # so readers never see a half-written file.
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    tmp_path = f'{dest}.{uuid.uuid4().hex}.tmp'
+    try:
+        _clone(src, tmp_path)
+        os.replace(tmp_path, dest)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+def lookup(key, output_path):
+    # Returns the SHA-256 of the cached output on a hit, None on a miss
+    conn = db.connect()
+    c = conn.cursor()
+    c.execute('SELECT path, output_hash FROM conversion_cache WHERE key = ?', (key,))
+    row = c.fetchone()
+    output_hash = None
+    if row and os.path.exists(row[0]):
+        _place(row[0], output_path)
+        output_hash = row[1] or hash_file(row[0])
+        c.execute('UPDATE conversion_cache SET hits = hits + 1, last_access = ?, output_hash = ? WHERE key = ?',
+                  (time.time(), output_hash, key))
+    elif row:
+        # Cached file vanished from disk, forget about it
+        c.execute('DELETE FROM conversion_cache WHERE key = ?', (key,))
+    c.execute('UPDATE cache_stats SET value = value + 1 WHERE name = ?', ('hits' if output_hash else 'misses',))
+    conn.commit()
+    conn.close()
+    return output_hash
+
+def store(key, output_path):
+    # Returns the SHA-256 of the stored output
+    if not os.path.exists(output_path):
+        return None
+    output_hash = hash_file(output_path)
+    cache_path = os.path.join(CACHE_DIR, key[:2], key)
+    _place(output_path, cache_path)
+    size = os.path.getsize(cache_path)
+    conn = db.connect()
+    c = conn.cursor()
+    c.execute('INSERT OR REPLACE INTO conversion_cache (key, path, size, last_access, output_hash) VALUES (?, ?, ?, ?, ?)',
+              (key, cache_path, size, time.time(), output_hash))
+    conn.commit()
+    conn.close()
+    evict()
+    return output_hash
+
+def evict(max_bytes=None):
+    max_bytes = CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    conn = db.connect()
+    c = conn.cursor()
+    c.execute('SELECT COALESCE(SUM(size), 0) FROM conversion_cache')
+    total = c.fetchone()[0]
+    evicted = 0
+    if total > max_bytes:
+        # Least recently used entries go first
+        c.execute('SELECT key, path, size FROM conversion_cache ORDER BY last_access ASC')
+        for key, path, size in c.fetchall():
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            c.execute('DELETE FROM conversion_cache WHERE key = ?', (key,))
+            total -= size
+            evicted += 1
+        conn.commit()
+    conn.close()
+    return evicted
+
+def get_stats():
+    conn = db.connect()
+    c = conn.cursor()
+    c.execute('SELECT name, value FROM cache_stats')
+    counters = dict(c.fetchall())
+    c.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM conversion_cache')
+    entries, size = c.fetchone()
+    conn.close()
+    hits = counters.get('hits', 0)
+    misses = counters.get('misses', 0)
+    lookups = hits + misses
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hitRate': round(hits / lookups * 100, 2) if lookups else 0,
+        'entries': entries,
+        'size': size
+    }
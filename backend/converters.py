@@ -0,0 +1,505 @@
+import os
+import json
+import csv
+import heapq
+import logging
+import zipfile
+import shutil
+import subprocess
+import jobs
+import archives
+import images
+import media
+import documents
+import settings
+from collections import namedtuple
+from functools import lru_cache
+from io import BytesIO
+
+try:
+    import PyPDF2
+except ImportError:
+    PyPDF2 = None
+try:
+    from docx import Document
+except ImportError:
+    Document = None
+try:
+    import cairosvg
+except (ImportError, OSError):  # OSError when the cairo system library is missing
+    cairosvg = None
+
+log = logging.getLogger(__name__)
+
+IMAGE_INPUTS = ['PNG', 'JPG', 'JPEG', 'BMP', 'TIFF', 'WEBP', 'GIF', 'SVG']
+IMAGE_OUTPUTS = ['PNG', 'JPG', 'JPEG', 'BMP', 'TIFF', 'WEBP', 'PDF', 'SVG']
+DOCUMENT_FORMATS = ['PDF', 'DOCX', 'TXT', 'RTF', 'ODT', 'PAGES']
+CODE_FORMATS = ['HTML', 'CSS', 'JS']
+ARCHIVE_FORMATS = ['ZIP', 'RAR', '7Z', 'TAR', 'GZ']
+AUDIO_INPUTS = ['MP3', 'WAV', 'FLAC', 'AAC', 'OGG', 'M4A']
+AUDIO_OUTPUTS = ['MP3', 'WAV', 'FLAC', 'AAC', 'OGG']
+VIDEO_FORMATS = ['MP4', 'AVI', 'MOV', 'WMV', 'FLV', 'MKV']
+
+# Converters take (input_path, output_path, from_format, to_format, progress).
+# `progress`, when given, is called with the fraction done (0-1) by the
+# converters that can measure it. A converter that could not really convert
+# (a tool failed or is missing) and wrote a stand-in instead returns
+# FALLBACK, so the result is not cached as the real conversion.
+#
+# Cost classes tell the job workers where a conversion should run:
+#   cpu        - pure Python/Pillow work, runs on the process pool
+#   io         - mostly reading and writing files, runs on a worker thread
+#   subprocess - an external tool does the work, runs on a worker thread
+#   parallel   - splits its own CPU work across the process pool (jobs.map_cpu)
+#                from a worker thread
+#   document   - document libraries and pandoc, runs on a warm document worker
+#                (documents.py)
+#
+# `memory`, when given, estimates a conversion's peak memory from the same
+# arguments; jobs.run_converter holds that much of the job memory limit while
+# it runs.
+#
+# `supports(from_format, to_format)`, when given, says whether the converter
+# really produces to_format here rather than falling back to a copy (e.g. a
+# missing library). Pairs it does not support are planned through other
+# formats instead (see plan()).
+#
+# `buffers` converters also accept binary file objects for input_path and
+# output_path, so they can be chained without temporary files.
+#
+# `options(input_path, output_path, from_format, to_format)`, when given,
+# names the admin settings (settings.ENCODER_SETTINGS) the output depends on
+# for this file; only those go into its cache key (see encoder_settings()).
+FALLBACK = 'fallback'
+EXECUTORS = {'cpu': 'process', 'io': 'thread', 'subprocess': 'thread', 'parallel': 'thread', 'document': 'document'}
+
+Converter = namedtuple('Converter', ['name', 'func', 'cost', 'streaming', 'executor', 'memory', 'supports', 'buffers',
+                                     'options'])
+
+REGISTRY = {}
+
+def register(from_formats, to_formats, cost, streaming=False, memory=None, supports=None, buffers=False,
+             options=None):
+    def decorator(func):
+        converter = Converter(func.__name__, func, cost, streaming, EXECUTORS[cost], memory, supports, buffers,
+                              options)
+        for from_format in from_formats:
+            for to_format in to_formats:
+                REGISTRY[(from_format, to_format)] = converter
+        return func
+    return decorator
+
+def supported(converter, from_format, to_format):
+    return converter.supports is None or converter.supports(from_format, to_format)
+
+def encoder_settings(converter, input_path, output_path, from_format, to_format):
+    if not converter.options:
+        return []
+    return converter.options(input_path, output_path, from_format, to_format)
+
+def get_converter(from_format, to_format):
+    # The registered converter, or a chain through other formats when that
+    # one would only copy the file
+    converter = REGISTRY.get((from_format, to_format))
+    if converter and supported(converter, from_format, to_format):
+        return converter
+    return plan(from_format, to_format) or converter or COPY_CONVERTER
+
+def run_conversion(from_format, to_format, input_path, output_path, progress=None):
+    get_converter(from_format, to_format).func(input_path, output_path, from_format, to_format, progress=progress)
+
+# DEFAULT - Copy with new extension
+def copy_file(input_path, output_path, from_format, to_format, progress=None):
+    shutil.copy2(input_path, output_path)
+
+def fallback_copy(input_path, output_path):
+    shutil.copy2(input_path, output_path)
+    return FALLBACK
+
+COPY_CONVERTER = Converter('copy_file', copy_file, 'io', True, EXECUTORS['io'], None, None, False, None)
+
+# PLANNING
+# A pair with no converter of its own is converted through intermediate
+# formats: a cheapest-path search over the supported `buffers` converters.
+# Intermediates stay in memory, each hop reading the buffer the previous one
+# wrote.
+MAX_HOPS = 3
+HOP_WEIGHTS = {'io': 1, 'cpu': 2, 'parallel': 2, 'document': 3, 'subprocess': 4}
+
+class Chain:
+    # The func of a planned converter. Holds only format pairs so it pickles
+    # for the process pool, where the hops are looked up again.
+    def __init__(self, hops):
+        self.hops = hops
+
+    def __call__(self, input_path, output_path, from_format, to_format, progress=None):
+        source = input_path
+        result = None
+        for number, (hop_from, hop_to) in enumerate(self.hops):
+            last = number == len(self.hops) - 1
+            target = output_path if last else BytesIO()
+            if REGISTRY[(hop_from, hop_to)].func(source, target, hop_from, hop_to,
+                                                 progress=_hop_progress(progress, number, len(self.hops))) == FALLBACK:
+                result = FALLBACK
+            if not last:
+                target.seek(0)
+            source = target
+        return result
+
+def chain_options(hops):
+    # Every hop's settings; intermediates only exist while the chain runs,
+    # so each hop is asked about the chain's own input and output
+    def options(input_path, output_path, from_format, to_format):
+        names = []
+        for hop_from, hop_to in hops:
+            names += encoder_settings(REGISTRY[(hop_from, hop_to)], input_path, output_path, hop_from, hop_to)
+        return list(dict.fromkeys(names))
+    return options
+
+def _hop_progress(progress, number, count):
+    if not progress:
+        return None
+    return lambda fraction: progress((number + fraction) / count)
+
+@lru_cache(maxsize=None)
+def plan(from_format, to_format):
+    # A Converter running the cheapest chain, or None if there is none
+    edges = {}
+    for (hop_from, hop_to), converter in REGISTRY.items():
+        if hop_from != hop_to and converter.buffers and supported(converter, hop_from, hop_to):
+            edges.setdefault(hop_from, []).append((hop_to, converter))
+    queue = [(0, from_format, [])]
+    settled = set()
+    while queue:
+        weight, current, hops = heapq.heappop(queue)
+        if current == to_format:
+            break
+        if current in settled or len(hops) >= MAX_HOPS:
+            continue
+        settled.add(current)
+        for hop_to, converter in edges.get(current, ()):
+            if hop_to not in settled:
+                heapq.heappush(queue, (weight + HOP_WEIGHTS[converter.cost], hop_to, hops + [(current, hop_to)]))
+    else:
+        return None
+    if len(hops) < 2:
+        return None
+    steps = [REGISTRY[hop] for hop in hops]
+    executor = 'process' if all(step.executor == 'process' for step in steps) else 'thread'
+    cost = max((step.cost for step in steps), key=lambda cost: HOP_WEIGHTS[cost])
+    name = '>'.join(step.name for step in steps)
+    return Converter(name, Chain(hops), cost, False, executor, None, None, False, chain_options(hops))
+
+# IMAGE CONVERSIONS (see images.py)
+def image_memory(input_path, output_path, from_format, to_format):
+    return images.memory_needed(input_path)
+
+def image_quality():
+    return settings.number('image_quality', 1, 100)
+
+def image_max_size():
+    dimension = settings.number('image_max_dimension', 0)
+    return (dimension, dimension) if dimension else None
+
+def image_task(input_path, output_path, from_format, to_format):
+    # convert_image's arguments to images.convert, for images.convert_batch
+    return input_path, output_path, to_format, image_quality(), image_max_size()
+
+def image_options(input_path, output_path, from_format, to_format):
+    return ['image_quality', 'image_max_dimension']
+
+@register(IMAGE_INPUTS, IMAGE_OUTPUTS, 'cpu', memory=image_memory, buffers=True, options=image_options)
+def convert_image(input_path, output_path, from_format, to_format, progress=None):
+    images.convert(input_path, output_path, to_format, quality=image_quality(), progress=progress,
+                   max_size=image_max_size())
+
+# Converters whose small jobs can share one process pool task (see
+# app.convert_files): name -> (batch function, task builder). The task builder
+# takes the converter's arguments; the batch function takes a list of tasks
+# and returns an exception (or None) for each.
+BATCHES = {'convert_image': (images.convert_batch, image_task)}
+
+def batchable(from_format, to_format):
+    return get_converter(from_format, to_format).name in BATCHES
+
+# Registered after convert_image so SVG on either side takes precedence.
+# Nothing vectorises rasters, and only PNG is rendered directly; plan() takes
+# SVG on to the other raster formats through PNG.
+@register(['SVG'], IMAGE_OUTPUTS, 'cpu', supports=lambda from_format, to_format: False)
+@register(IMAGE_INPUTS, ['SVG'], 'cpu', supports=lambda from_format, to_format: False)
+def convert_svg(input_path, output_path, from_format, to_format, progress=None):
+    shutil.copy2(input_path, output_path)
+
+@register(['SVG'], ['PNG'], 'cpu', supports=lambda from_format, to_format: cairosvg is not None, buffers=True)
+def svg_to_png(input_path, output_path, from_format, to_format, progress=None):
+    if not cairosvg:
+        return fallback_copy(input_path, output_path)
+    if hasattr(input_path, 'read'):
+        cairosvg.svg2png(file_obj=input_path, write_to=output_path)
+    else:
+        cairosvg.svg2png(url=input_path, write_to=output_path)
+
+# DOCUMENT CONVERSIONS (including RTF, ODT, PAGES)
+@register(DOCUMENT_FORMATS, DOCUMENT_FORMATS, 'document')
+def convert_document(input_path, output_path, from_format, to_format, progress=None):
+    try:
+        documents.pandoc(input_path, output_path, from_format, to_format)
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return fallback_copy(input_path, output_path)
+
+@register(DOCUMENT_FORMATS + CODE_FORMATS, ['TXT'], 'io')
+def convert_to_text(input_path, output_path, from_format, to_format, progress=None):
+    # For complex formats, try to read as text
+    try:
+        with open(input_path, 'r', encoding='utf-8', errors='ignore') as f:
+            content = f.read()
+        with open(output_path, 'w', encoding='utf-8') as f:
+            f.write(f"Converted from {from_format}\n\n{content}")
+    except Exception:
+        return fallback_copy(input_path, output_path)
+
+PDF_PAGES_PER_CHUNK = 16
+
+def extract_pdf_pages(input_path, start, stop):
+    # Runs in a pool process; each chunk opens its own reader
+    with open(input_path, 'rb') as f:
+        reader = PyPDF2.PdfReader(f)
+        return [reader.pages[number].extract_text() or '' for number in range(start, stop)]
+
+@register(['PDF'], ['TXT'], 'parallel')
+def pdf_to_text(input_path, output_path, from_format, to_format, progress=None):
+    try:
+        with open(input_path, 'rb') as f:
+            page_count = len(PyPDF2.PdfReader(f).pages)
+        chunks = [(input_path, start, min(start + PDF_PAGES_PER_CHUNK, page_count))
+                  for start in range(0, page_count, PDF_PAGES_PER_CHUNK)]
+        # Chunks are extracted in parallel and written out in page order as
+        # they finish; no more than a few chunks of text are held at a time
+        pages_done = 0
+        with open(output_path, 'w', encoding='utf-8') as out:
+            for texts in jobs.map_cpu(extract_pdf_pages, chunks):
+                for text in texts:
+                    out.write(text + '\n')
+                    pages_done += 1
+                    if progress:
+                        progress(pages_done / page_count)
+    except Exception:
+        # Fallback to simple copy
+        return fallback_copy(input_path, output_path)
+
+@register(['DOCX'], ['TXT'], 'document')
+def docx_to_text(input_path, output_path, from_format, to_format, progress=None):
+    try:
+        if Document:
+            doc = Document(input_path)
+            text = ''
+            for paragraph in doc.paragraphs:
+                text += paragraph.text + '\n'
+            with open(output_path, 'w', encoding='utf-8') as f:
+                f.write(text)
+        else:
+            # Fallback to pandoc
+            subprocess.run(['pandoc', input_path, '-t', 'plain', '-o', output_path], check=True, capture_output=True)
+    except Exception:
+        return fallback_copy(input_path, output_path)
+
+# DATA CONVERSIONS
+# Rows are streamed one at a time in both directions, so memory stays flat
+# no matter how large the export is.
+TABLE_FORMATS = ['CSV', 'TSV']
+RECORD_FORMATS = ['JSON', 'NDJSON']
+DELIMITERS = {'CSV': ',', 'TSV': '\t'}
+JSON_CHUNK_SIZE = 64 * 1024
+
+def read_table(input_path, from_format):
+    with open(input_path, 'r', encoding='utf-8-sig', newline='') as f:
+        yield from csv.DictReader(f, delimiter=DELIMITERS[from_format])
+
+def read_records(input_path):
+    # Items of a top-level JSON array, or each value of an NDJSON (or any
+    # whitespace separated) stream, decoded incrementally from fixed-size reads
+    decoder = json.JSONDecoder()
+    with open(input_path, 'r', encoding='utf-8-sig') as f:
+        buffer = ''
+        pos = 0
+        eof = False
+        in_array = None
+        while True:
+            separators = ' \t\r\n,' if in_array else ' \t\r\n'
+            while pos < len(buffer) and buffer[pos] in separators:
+                pos += 1
+            if pos == len(buffer) and not eof:
+                chunk = f.read(JSON_CHUNK_SIZE)
+                buffer, pos, eof = chunk, 0, not chunk
+                continue
+            if pos == len(buffer):
+                if in_array:
+                    raise ValueError('Unterminated JSON array')
+                return
+            if in_array is None:
+                in_array = buffer[pos] == '['
+                if in_array:
+                    pos += 1
+                    continue
+            if in_array and buffer[pos] == ']':
+                return
+            error = None
+            try:
+                value, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError as e:
+                error, end = e, None
+            # An item cut off by the read boundary (or a number that might
+            # continue) needs more input; grow the read so big items stay linear
+            if (end is None or end == len(buffer)) and not eof:
+                chunk = f.read(max(JSON_CHUNK_SIZE, len(buffer) - pos))
+                buffer, pos, eof = buffer[pos:] + chunk, 0, not chunk
+                continue
+            if error:
+                raise error
+            pos = end
+            yield value
+
+def write_records(rows, output_path, to_format):
+    with open(output_path, 'w', encoding='utf-8') as f:
+        if to_format == 'NDJSON':
+            for row in rows:
+                f.write(json.dumps(row) + '\n')
+            return
+        # Same layout json.dump(rows, indent=2) would give, one row at a time
+        f.write('[')
+        separator = '\n  '
+        for row in rows:
+            f.write(separator + json.dumps(row, indent=2).replace('\n', '\n  '))
+            separator = ',\n  '
+        f.write(']' if separator == '\n  ' else '\n]')
+
+def cell(value):
+    # Nested objects and arrays are kept as JSON rather than Python reprs
+    return json.dumps(value) if isinstance(value, (dict, list)) else value
+
+@register(TABLE_FORMATS, RECORD_FORMATS, 'io', streaming=True)
+def csv_to_json(input_path, output_path, from_format, to_format, progress=None):
+    write_records(read_table(input_path, from_format), output_path, to_format)
+
+@register(RECORD_FORMATS, TABLE_FORMATS, 'io', streaming=True)
+def json_to_csv(input_path, output_path, from_format, to_format, progress=None):
+    # First pass collects the union of keys so rows with extra fields fit
+    fieldnames = {}
+    for record in read_records(input_path):
+        if not isinstance(record, dict):
+            fieldnames = None
+            break
+        fieldnames.update(dict.fromkeys(record))
+    if not fieldnames:
+        shutil.copy2(input_path, output_path)
+        return
+    with open(output_path, 'w', encoding='utf-8', newline='') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=list(fieldnames), delimiter=DELIMITERS[to_format])
+        writer.writeheader()
+        for record in read_records(input_path):
+            writer.writerow({key: cell(value) for key, value in record.items()})
+
+@register(TABLE_FORMATS, TABLE_FORMATS, 'io', streaming=True)
+def convert_table(input_path, output_path, from_format, to_format, progress=None):
+    if from_format == to_format:
+        shutil.copy2(input_path, output_path)
+        return
+    with open(input_path, 'r', encoding='utf-8-sig', newline='') as infile, \
+         open(output_path, 'w', encoding='utf-8', newline='') as outfile:
+        csv.writer(outfile, delimiter=DELIMITERS[to_format]).writerows(
+            csv.reader(infile, delimiter=DELIMITERS[from_format]))
+
+@register(RECORD_FORMATS, RECORD_FORMATS, 'io', streaming=True)
+def convert_records(input_path, output_path, from_format, to_format, progress=None):
+    if from_format == to_format:
+        shutil.copy2(input_path, output_path)
+        return
+    write_records(read_records(input_path), output_path, to_format)
+
+# ARCHIVE CONVERSIONS (streamed entry by entry, see archives.py)
+@register(ARCHIVE_FORMATS, ARCHIVE_FORMATS, 'subprocess')
+def convert_archive(input_path, output_path, from_format, to_format, progress=None):
+    if from_format == to_format:
+        shutil.copy2(input_path, output_path)
+        return
+    try:
+        archives.repack(input_path, output_path, from_format, to_format, progress)
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        # Fallback: create zip with original file
+        with zipfile.ZipFile(output_path, 'w') as zipf:
+            zipf.write(input_path, os.path.basename(input_path))
+        return FALLBACK
+
+# AUDIO CONVERSIONS (ffmpeg, run by media.py)
+# Encoder arguments per stream type; streams the target container can carry
+# as they are are copied instead (see media.stream_args)
+AUDIO_ARGS = {
+    'MP3': {'audio': []},
+    'WAV': {},
+    'FLAC': {'audio': ['-c:a', 'flac']},
+    'AAC': {'audio': ['-c:a', 'aac']},
+    'OGG': {'audio': ['-c:a', 'libvorbis']},
+}
+LOSSY_AUDIO = ['MP3', 'AAC']  # encoded at the audio_bitrate setting
+VIDEO_TO_AUDIO_ARGS = dict(AUDIO_ARGS, WAV={'audio': ['-c:a', 'pcm_s16le']})
+VIDEO_ARGS = {
+    'MP4': {'video': ['-c:v', 'libx264'], 'audio': ['-c:a', 'aac']},
+    'AVI': {'video': ['-c:v', 'libx264'], 'audio': ['-c:a', 'mp3']},
+    'MOV': {'video': ['-c:v', 'libx264'], 'audio': ['-c:a', 'aac']},
+}
+
+def audio_args(table, to_format):
+    args = dict(table[to_format])
+    if to_format in LOSSY_AUDIO:
+        bitrate = settings.number('audio_bitrate', 8, 640)
+        args['audio'] = args.get('audio', []) + ['-b:a', f'{bitrate}k']
+    return args
+
+def bitrate_options(table):
+    # audio_bitrate only reaches ffmpeg when the audio is encoded to a lossy
+    # format; a remux copies the streams as they are
+    def options(input_path, output_path, from_format, to_format):
+        if to_format not in LOSSY_AUDIO or media.stream_args(input_path, to_format, table[to_format]) is not None:
+            return []
+        return ['audio_bitrate']
+    return options
+
+def run_ffmpeg(input_path, output_path, args, progress=None):
+    # Cancellation and timeouts propagate; see media.py
+    try:
+        media.run_ffmpeg(input_path, output_path, args, progress)
+    except subprocess.CalledProcessError as e:
+        log.warning('ffmpeg failed, copying the input instead', extra={'returncode': e.returncode, 'output': e.output})
+        return fallback_copy(input_path, output_path)
+    except FileNotFoundError:
+        # Fallback to file copy if ffmpeg not available
+        return fallback_copy(input_path, output_path)
+
+def transcode(input_path, output_path, to_format, encode_args, extra_args=(), progress=None):
+    # Remux when the source streams already suit the target container; a copy
+    # that ffmpeg rejects (odd timestamps, unsupported tags) is re-encoded
+    args = media.stream_args(input_path, to_format, encode_args)
+    if args is not None:
+        log.debug('Remuxing', extra={'ffmpeg_args': args})
+        try:
+            media.run_ffmpeg(input_path, output_path, list(extra_args) + args, progress)
+            return
+        except subprocess.CalledProcessError as e:
+            log.warning('Remux failed, re-encoding', extra={'returncode': e.returncode, 'output': e.output})
+    return run_ffmpeg(input_path, output_path,
+                      list(extra_args) + encode_args.get('video', []) + encode_args.get('audio', []), progress)
+
+@register(AUDIO_INPUTS, AUDIO_OUTPUTS, 'subprocess', streaming=True, options=bitrate_options(AUDIO_ARGS))
+def convert_audio(input_path, output_path, from_format, to_format, progress=None):
+    return transcode(input_path, output_path, to_format, audio_args(AUDIO_ARGS, to_format), progress=progress)
+
+# VIDEO TO AUDIO CONVERSIONS
+@register(VIDEO_FORMATS, AUDIO_OUTPUTS, 'subprocess', streaming=True,
+          options=bitrate_options(VIDEO_TO_AUDIO_ARGS))
+def extract_audio(input_path, output_path, from_format, to_format, progress=None):
+    return transcode(input_path, output_path, to_format, audio_args(VIDEO_TO_AUDIO_ARGS, to_format), ['-vn'], progress)
+
+# VIDEO TO VIDEO CONVERSIONS
+@register(VIDEO_FORMATS, VIDEO_FORMATS, 'subprocess', streaming=True)
+def convert_video(input_path, output_path, from_format, to_format, progress=None):
+    return transcode(input_path, output_path, to_format, VIDEO_ARGS.get(to_format, {}), progress=progress)
@@ -0,0 +1,41 @@
+import os
+import converters
+import images
+import media
+
+# Rough seconds of work per conversion, used to order the job queue
+# (jobs.claim_job). Only the order matters, so the rates are coarse; they lean
+# slow so an unknown input is not mistaken for a quick one.
+STARTUP_SECONDS = 0.05
+BYTES_PER_SECOND = {'cpu': 20e6, 'io': 50e6, 'parallel': 40e6, 'document': 5e6, 'subprocess': 2e6}
+PIXELS_PER_SECOND = 25e6
+# Seconds of media encoded per second of work: re-encoding video is the slow
+# case, audio-only targets are much quicker
+MEDIA_SPEED = {'video': 1.0, 'audio': 20.0}
+IMAGE_CONVERTERS = ['convert_image', 'convert_svg']
+MEDIA_CONVERTERS = {'convert_video': 'video', 'convert_audio': 'audio', 'extract_audio': 'audio'}
+
+def quick_estimate(from_format, to_format, size):
+    # From the file size and the converter's cost class alone, so it is cheap
+    # enough for the request that queues the job; estimate() refines it later
+    converter = converters.get_converter(from_format, to_format)
+    return STARTUP_SECONDS + (size or 0) / BYTES_PER_SECOND[converter.cost]
+
+def estimate(input_path, from_format, to_format, size=None):
+    # Reads image headers and probes media, so it runs off the request path
+    # (jobs.refine_estimates)
+    converter = converters.get_converter(from_format, to_format)
+    if size is None:
+        size = os.path.getsize(input_path) if os.path.exists(input_path) else 0
+    seconds = None
+    if converter.name in IMAGE_CONVERTERS:
+        pixels = images.pixel_count(input_path)
+        if pixels:
+            seconds = pixels / PIXELS_PER_SECOND
+    elif converter.name in MEDIA_CONVERTERS:
+        length = media.duration(input_path)
+        if length:
+            seconds = length / MEDIA_SPEED[MEDIA_CONVERTERS[converter.name]]
+    if seconds is None:
+        seconds = size / BYTES_PER_SECOND[converter.cost]
+    return STARTUP_SECONDS + seconds
@@ -0,0 +1,350 @@
+import time
+import uuid
+import queue
+import logging
+import sqlite3
+import metrics
+from werkzeug.security import generate_password_hash
+
+DB_PATH = 'app.db'
+BUSY_TIMEOUT = 30  # seconds a connection waits on a locked database
+POOL_SIZE = 16
+
+_pool = queue.LifoQueue(maxsize=POOL_SIZE)
+
+log = logging.getLogger(__name__)
+
+def _execute(conn, execute, sql, parameters):
+    # The statement that opens a write transaction is the one that waits for
+    # SQLite's write lock (busy_timeout), so time it separately
+    if conn.in_transaction:
+        return execute(sql, parameters)
+    started = time.perf_counter()
+    result = execute(sql, parameters)
+    if conn.in_transaction:
+        metrics.observe('formatfusion_sqlite_lock_wait_seconds', time.perf_counter() - started)
+    return result
+
+class TimedCursor:
+    def __init__(self, cursor, conn):
+        self._cursor = cursor
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def execute(self, sql, parameters=()):
+        _execute(self._conn, self._cursor.execute, sql, parameters)
+        return self
+
+    def executemany(self, sql, parameters):
+        _execute(self._conn, self._cursor.executemany, sql, parameters)
+        return self
+
+def _open():
+    conn = sqlite3.connect(DB_PATH, timeout=BUSY_TIMEOUT, check_same_thread=False)
+    conn.execute(f'PRAGMA busy_timeout = {BUSY_TIMEOUT * 1000}')
+    # With WAL, NORMAL only syncs at checkpoints and is still crash safe
+    conn.execute('PRAGMA synchronous = NORMAL')
+    return conn
+
+class PooledConnection:
+    # Behaves like a sqlite3 connection, but close() hands it back to the
+    # pool instead of closing it. Only one thread uses it between connect()
+    # and close().
+    _conn = None
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def cursor(self):
+        return TimedCursor(self._conn.cursor(), self._conn)
+
+    def execute(self, sql, parameters=()):
+        return TimedCursor(self._conn.cursor(), self._conn).execute(sql, parameters)
+
+    def close(self):
+        conn, self._conn = self._conn, None
+        if conn is None:
+            return
+        if conn.in_transaction:
+            # Never hand out a connection that still holds a lock
+            conn.rollback()
+        try:
+            _pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def __del__(self):
+        self.close()
+
+def connect():
+    try:
+        conn = _pool.get_nowait()
+    except queue.Empty:
+        conn = _open()
+    return PooledConnection(conn)
+
+def migrate():
+    # Runs once at startup. Each migration runs at most once per database,
+    # tracked by PRAGMA user_version.
+    conn = sqlite3.connect(DB_PATH, timeout=BUSY_TIMEOUT, isolation_level=None)
+    conn.execute('PRAGMA journal_mode = WAL')
+    c = conn.cursor()
+    c.execute('BEGIN IMMEDIATE')
+    try:
+        version = c.execute('PRAGMA user_version').fetchone()[0]
+        for target, migration in enumerate(MIGRATIONS, start=1):
+            if target > version:
+                migration(c)
+                c.execute(f'PRAGMA user_version = {target}')
+                log.info('Applied database migration', extra={'version': target, 'migration': migration.__name__})
+        c.execute('COMMIT')
+    except Exception:
+        c.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+
+def _add_column(c, table, column, definition):
+    c.execute(f'PRAGMA table_info({table})')
+    if column not in [row[1] for row in c.fetchall()]:
+        c.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+def baseline_schema(c):
+    # Written to also bring databases created before migrations up to date
+    c.execute('''CREATE TABLE IF NOT EXISTS files (
+        id TEXT PRIMARY KEY,
+        filename TEXT,
+        status TEXT DEFAULT 'pending',
+        from_format TEXT,
+        to_format TEXT,
+        file_size INTEGER,
+        upload_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        download_count INTEGER DEFAULT 0,
+        error_message TEXT,
+        completion_date TIMESTAMP,
+        content_hash TEXT,
+        output_hash TEXT
+    )''')
+    _add_column(c, 'files', 'from_format', 'TEXT')
+    _add_column(c, 'files', 'to_format', 'TEXT')
+    _add_column(c, 'files', 'upload_date', 'TIMESTAMP DEFAULT CURRENT_TIMESTAMP')
+    _add_column(c, 'files', 'download_count', 'INTEGER DEFAULT 0')
+    _add_column(c, 'files', 'content_hash', 'TEXT')
+    _add_column(c, 'files', 'output_hash', 'TEXT')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS admin_users (
+        id TEXT PRIMARY KEY,
+        username TEXT UNIQUE NOT NULL,
+        password_hash TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )''')
+
+    # Blog posts table
+    c.execute('''CREATE TABLE IF NOT EXISTS blog_posts (
+        id TEXT PRIMARY KEY,
+        title TEXT NOT NULL,
+        content TEXT NOT NULL,
+        excerpt TEXT,
+        author TEXT DEFAULT 'Admin',
+        category TEXT DEFAULT 'General',
+        tags TEXT,
+        featured BOOLEAN DEFAULT 0,
+        published BOOLEAN DEFAULT 1,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        views INTEGER DEFAULT 0
+    )''')
+
+    # Settings table
+    c.execute('''CREATE TABLE IF NOT EXISTS settings (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )''')
+
+    # Conversion job queue
+    c.execute('''CREATE TABLE IF NOT EXISTS jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        file_id TEXT NOT NULL,
+        status TEXT DEFAULT 'queued',
+        attempts INTEGER DEFAULT 0,
+        error_message TEXT,
+        enqueued_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        started_at TIMESTAMP,
+        finished_at TIMESTAMP
+    )''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, id)')
+
+    # Conversion result cache
+    c.execute('''CREATE TABLE IF NOT EXISTS conversion_cache (
+        key TEXT PRIMARY KEY,
+        path TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        hits INTEGER DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        last_access REAL NOT NULL,
+        output_hash TEXT
+    )''')
+    _add_column(c, 'conversion_cache', 'output_hash', 'TEXT')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_cache_last_access ON conversion_cache (last_access)')
+    c.execute('''CREATE TABLE IF NOT EXISTS cache_stats (
+        name TEXT PRIMARY KEY,
+        value INTEGER DEFAULT 0
+    )''')
+    c.execute('''INSERT OR IGNORE INTO cache_stats (name, value) VALUES ('hits', 0), ('misses', 0)''')
+
+    # Bytes stored under uploads/
+    c.execute('''CREATE TABLE IF NOT EXISTS storage_usage (
+        name TEXT PRIMARY KEY,
+        bytes INTEGER DEFAULT 0,
+        reconciled_at TIMESTAMP
+    )''')
+    c.execute('''INSERT OR IGNORE INTO storage_usage (name, bytes) VALUES ('uploads', 0)''')
+
+    # Create admin user
+    c.execute('INSERT OR IGNORE INTO admin_users (id, username, password_hash) VALUES (?, ?, ?)',
+              (str(uuid.uuid4()), 'admin', generate_password_hash('admin123')))
+
+    # Insert default settings
+    default_settings = [
+        ('max_file_size', '100'),
+        ('allowed_file_types', 'PDF,DOCX,JPG,PNG,MP4,MP3,WAV,FLAC'),
+        ('image_quality', '95'),
+        ('audio_bitrate', '192')
+    ]
+    for key, value in default_settings:
+        c.execute('INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)', (key, value))
+
+    # Insert sample blog post on a fresh database
+    c.execute('SELECT COUNT(*) FROM blog_posts')
+    if c.fetchone()[0] == 0:
+        c.execute('INSERT INTO blog_posts (id, title, content, excerpt, category, featured) VALUES (?, ?, ?, ?, ?, ?)',
+                  (str(uuid.uuid4()), 'Welcome to FormatFusion',
+                   'FormatFusion is your go-to solution for file conversions...',
+                   'Learn about our powerful file conversion platform', 'Announcements', 1))
+
+def stats_rollups(c):
+    # Pre-aggregated counters behind the dashboard; maintained by stats.record()
+    c.execute('''CREATE TABLE IF NOT EXISTS stats_rollup (
+        period TEXT NOT NULL,
+        bucket TEXT NOT NULL,
+        from_format TEXT NOT NULL,
+        to_format TEXT NOT NULL,
+        uploads INTEGER DEFAULT 0,
+        completions INTEGER DEFAULT 0,
+        failures INTEGER DEFAULT 0,
+        downloads INTEGER DEFAULT 0,
+        bytes_in INTEGER DEFAULT 0,
+        bytes_out INTEGER DEFAULT 0,
+        PRIMARY KEY (period, bucket, from_format, to_format)
+    )''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_files_status ON files (status)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_files_upload_date ON files (upload_date)')
+
+    # Backfill from existing history. Failures and downloads have no timestamp
+    # of their own, so they are attributed to the upload time.
+    buckets = {
+        'hour': "strftime('%Y-%m-%d %H:00', {column})",
+        'day': "strftime('%Y-%m-%d', {column})",
+        'total': "'all'",
+    }
+    metrics = [
+        ('uploads', 'COUNT(*)', 'upload_date', '1'),
+        ('bytes_in', 'COALESCE(SUM(file_size), 0)', 'upload_date', '1'),
+        ('completions', 'COUNT(*)', 'completion_date', "status = 'completed'"),
+        ('failures', 'COUNT(*)', 'upload_date', "status = 'failed'"),
+        ('downloads', 'COALESCE(SUM(download_count), 0)', 'upload_date', '1'),
+    ]
+    for period, bucket in buckets.items():
+        for metric, aggregate, column, condition in metrics:
+            bucket_sql = bucket.format(column=f'COALESCE({column}, upload_date, CURRENT_TIMESTAMP)')
+            c.execute(f'''INSERT INTO stats_rollup (period, bucket, from_format, to_format, {metric})
+                         SELECT ?, {bucket_sql}, COALESCE(from_format, ''), COALESCE(to_format, ''), {aggregate}
+                         FROM files WHERE {condition} GROUP BY 2, 3, 4
+                         ON CONFLICT (period, bucket, from_format, to_format)
+                         DO UPDATE SET {metric} = {metric} + excluded.{metric}''', (period,))
+
+def file_retention(c):
+    # expires_at drives the cleanup sweeper (storage.sweep) and deleted_at
+    # records when it removed the files. original_filename keeps the upload's
+    # name, since filename becomes the output's once converted.
+    _add_column(c, 'files', 'original_filename', 'TEXT')
+    _add_column(c, 'files', 'expires_at', 'REAL')
+    _add_column(c, 'files', 'deleted_at', 'TIMESTAMP')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_files_expires_at ON files (expires_at) WHERE expires_at IS NOT NULL')
+    c.execute("UPDATE files SET original_filename = filename WHERE status != 'completed'")
+    # Downloaded files should already be gone; the rest get a day from their
+    # last activity, the default retention for files nobody downloads
+    c.execute('''UPDATE files SET expires_at = CASE
+                     WHEN download_count > 0 THEN CAST(strftime('%s', 'now') AS REAL)
+                     ELSE CAST(strftime('%s', COALESCE(completion_date, upload_date, CURRENT_TIMESTAMP)) AS REAL) + 86400
+                 END''')
+
+def admin_file_indexes(c):
+    # The admin file list pages newest first on (upload_date, id), optionally
+    # filtered by status or format pair. These cover no filter, status alone
+    # and both formats; a single format needs admin_file_format_indexes.
+    # They supersede the single-column indexes.
+    c.execute('DROP INDEX IF EXISTS idx_files_status')
+    c.execute('DROP INDEX IF EXISTS idx_files_upload_date')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_files_recent ON files (upload_date, id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_files_status_recent ON files (status, upload_date, id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_files_pair_recent ON files (from_format, to_format, upload_date, id)')
+
+def admin_file_format_indexes(c):
+    # A single format filter (from or to without the other) also pages in
+    # index order; without these it sorted, or scanned every row
+    c.execute('CREATE INDEX IF NOT EXISTS idx_files_from_recent ON files (from_format, upload_date, id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_files_to_recent ON files (to_format, upload_date, id)')
+
+def settings_version(c):
+    # Bumped by settings.update() so every process knows to reload its cache
+    c.execute('''CREATE TABLE IF NOT EXISTS settings_version (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        version INTEGER NOT NULL
+    )''')
+    c.execute('INSERT OR IGNORE INTO settings_version (id, version) VALUES (1, 1)')
+
+def fair_scheduling(c):
+    # Start-time fair queuing (see jobs.enqueue): every job gets virtual
+    # start/finish tags from its client's previous work and its estimated
+    # cost, and workers take the lowest finish tag. job_clock is the virtual
+    # time, the start tag of the latest claimed job.
+    _add_column(c, 'jobs', 'client', "TEXT DEFAULT ''")
+    _add_column(c, 'jobs', 'cost', 'REAL DEFAULT 0')
+    _add_column(c, 'jobs', 'lane', "TEXT DEFAULT 'bulk'")
+    _add_column(c, 'jobs', 'start_tag', 'REAL DEFAULT 0')
+    _add_column(c, 'jobs', 'finish_tag', 'REAL DEFAULT 0')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_jobs_tag ON jobs (status, finish_tag)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_jobs_lane_tag ON jobs (status, lane, finish_tag)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_jobs_client ON jobs (client, status, finish_tag)')
+    c.execute('''CREATE TABLE IF NOT EXISTS job_clock (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        vtime REAL NOT NULL
+    )''')
+    c.execute('INSERT OR IGNORE INTO job_clock (id, vtime) VALUES (1, 0)')
+
+def job_estimates(c):
+    # Jobs are queued with a quick estimate from the file size; a background
+    # thread then probes the file and re-tags the job (jobs.refine_estimates)
+    _add_column(c, 'jobs', 'estimated', 'INTEGER DEFAULT 0')
+    c.execute('''UPDATE jobs SET estimated = 1 WHERE status != 'queued' ''')
+
+MIGRATIONS = [
+    baseline_schema,
+    stats_rollups,
+    file_retention,
+    admin_file_indexes,
+    settings_version,
+    fair_scheduling,
+    job_estimates,
+    admin_file_format_indexes,
+]
@@ -0,0 +1,278 @@
+import os
+import json
+import time
+import base64
+import signal
+import socket
+import logging
+import resource
+import importlib
+import threading
+import subprocess
+import multiprocessing
+import urllib.error
+import urllib.request
+
+# Warm document workers. Document conversions run in long-lived processes
+# that keep python-docx, PyPDF2 and a pandoc server loaded between jobs, so a
+# small file no longer pays for interpreter, library and pandoc start-up. Each
+# worker is replaced after MAX_JOBS jobs or once it (with its pandoc server)
+# grows past MEMORY_LIMIT.
+WORKERS = int(os.environ.get('DOCUMENT_WORKERS', max(1, (os.cpu_count() or 1) // 2)))
+MAX_JOBS = int(os.environ.get('DOCUMENT_WORKER_MAX_JOBS', '200'))
+MEMORY_LIMIT = int(os.environ.get('DOCUMENT_WORKER_MEMORY_MB', '512')) * 1024 * 1024
+TIMEOUT = int(os.environ.get('DOCUMENT_TIMEOUT', '600'))  # per job, seconds
+PRELOAD = ['converters']  # imported when a worker starts
+
+log = logging.getLogger(__name__)
+
+class WorkerCrashed(Exception):
+    pass
+
+def _rss(pid='self'):
+    # Current resident memory in bytes; peak RSS where /proc is missing
+    try:
+        with open(f'/proc/{pid}/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        if pid != 'self':
+            return 0
+        scale = 1 if os.uname().sysname == 'Darwin' else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+# WORKER PROCESS
+class _Channel:
+    # Gives the worker's end of the pipe the put() of a queue, so progress
+    # and metrics (events.init_worker, metrics.init_worker) travel over it
+    def __init__(self, conn):
+        self.conn = conn
+
+    def put(self, message):
+        self.conn.send(message)
+
+def _serve(conn, initializer, max_jobs, memory_limit):
+    # A process group of its own, so killing the worker takes its pandoc
+    # server with it
+    os.setpgid(0, 0)
+    if initializer:
+        initializer(_Channel(conn))
+    for module in PRELOAD:
+        importlib.import_module(module)
+    done = 0
+    try:
+        while True:
+            try:
+                task = conn.recv()
+            except EOFError:
+                return
+            if task is None:
+                return
+            fn, args, kwargs = task
+            try:
+                reply = ('done', fn(*args, **kwargs))
+            except Exception as e:
+                reply = ('failed', e)
+            done += 1
+            retire = done >= max_jobs or _rss() + _pandoc.rss() > memory_limit
+            try:
+                conn.send(reply + (retire,))
+            except Exception:
+                # An unpicklable result or exception
+                conn.send(('failed', RuntimeError(str(reply[1])), retire))
+            if retire:
+                return
+    finally:
+        _pandoc.stop()
+
+# SERVER SIDE
+class _Worker:
+    def __init__(self, context, initializer):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_serve, args=(child_conn, initializer, MAX_JOBS, MEMORY_LIMIT),
+                                       name='document-worker', daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def stop(self, wait=True):
+        try:
+            self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+        if wait:
+            self.process.join(5)
+        if self.process.is_alive():
+            try:
+                os.killpg(self.process.pid, signal.SIGKILL)
+            except (ProcessLookupError, PermissionError):
+                self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+class WorkerPool:
+    # run() hands a job to an idle worker (starting one if fewer than `size`
+    # exist) and waits for it. Messages other than the reply (progress,
+    # metrics) go to `forward`.
+    def __init__(self, size=WORKERS, initializer=None, forward=None):
+        self.size = size
+        self.initializer = initializer
+        self.forward = forward
+        self.context = multiprocessing.get_context('spawn')
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._idle = [_Worker(self.context, initializer) for _ in range(size)]
+
+    def _take(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return _Worker(self.context, self.initializer)
+
+    def _replace(self, worker, wait=True):
+        worker.stop(wait)
+        # Started now so the next job finds it warm
+        with self._lock:
+            self._idle.append(_Worker(self.context, self.initializer))
+
+    def run(self, fn, *args, **kwargs):
+        with self._slots:
+            worker = self._take()
+            deadline = time.monotonic() + TIMEOUT
+            message = None
+            try:
+                worker.conn.send((fn, args, kwargs))
+                while worker.conn.poll(max(deadline - time.monotonic(), 0)):
+                    message = worker.conn.recv()
+                    if message[0] in ('done', 'failed'):
+                        break
+                    if self.forward:
+                        self.forward(message)
+                    message = None
+            except (EOFError, OSError):
+                self._replace(worker, wait=False)
+                raise WorkerCrashed(f'Document worker exited with code {worker.process.exitcode}')
+            if message is None:
+                self._replace(worker, wait=False)
+                raise TimeoutError(f'Document conversion did not finish within {TIMEOUT} seconds')
+            kind, value, retire = message
+            if retire:
+                self._replace(worker)
+            else:
+                with self._lock:
+                    self._idle.append(worker)
+        if kind == 'failed':
+            raise value
+        return value
+
+    def shutdown(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for worker in idle:
+            worker.stop()
+
+# PANDOC
+# `pandoc server` (or pandoc-server) converts over HTTP without a process per
+# document. Each worker starts one on first use; pandoc builds without server
+# mode, and pairs it cannot do (PDF), run pandoc per job as before.
+PANDOC_READERS = {'DOCX': 'docx', 'ODT': 'odt', 'RTF': 'rtf', 'TXT': 'markdown'}
+PANDOC_WRITERS = {'DOCX': 'docx', 'ODT': 'odt', 'RTF': 'rtf', 'TXT': 'plain'}
+BINARY_READERS = ['docx', 'odt']  # sent base64 encoded
+PANDOC_SERVER_COMMANDS = [['pandoc-server'], ['pandoc', 'server']]
+PANDOC_START_TIMEOUT = 10
+
+class ServerUnavailable(Exception):
+    pass
+
+class PandocServer:
+    def __init__(self):
+        self.process = None
+        self.port = None
+        self.unavailable = False
+        self._lock = threading.Lock()
+
+    def _free_port(self):
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            return s.getsockname()[1]
+
+    def _ready(self, process, port):
+        deadline = time.monotonic() + PANDOC_START_TIMEOUT
+        while time.monotonic() < deadline and process.poll() is None:
+            try:
+                with urllib.request.urlopen(f'http://127.0.0.1:{port}/version', timeout=1):
+                    return True
+            except OSError:
+                time.sleep(0.05)
+        return False
+
+    def _start(self):
+        # Caller holds _lock
+        port = self._free_port()
+        for command in PANDOC_SERVER_COMMANDS:
+            try:
+                process = subprocess.Popen(command + ['--port', str(port), '--timeout', str(TIMEOUT)],
+                                           stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                           stderr=subprocess.DEVNULL)
+            except FileNotFoundError:
+                continue
+            if self._ready(process, port):
+                self.process, self.port = process, port
+                return True
+            process.kill()
+            process.wait()
+        log.info('pandoc has no server mode here; running it per document')
+        self.unavailable = True
+        return False
+
+    def available(self):
+        with self._lock:
+            if self.process and self.process.poll() is None:
+                return True
+            if self.unavailable:
+                return False
+            return self._start()
+
+    def convert(self, input_path, output_path, reader, writer):
+        with open(input_path, 'rb') as f:
+            data = f.read()
+        text = base64.b64encode(data).decode() if reader in BINARY_READERS else data.decode('utf-8', 'replace')
+        body = json.dumps({'text': text, 'from': reader, 'to': writer, 'standalone': True}).encode()
+        request = urllib.request.Request(f'http://127.0.0.1:{self.port}/', data=body,
+                                         headers={'Content-Type': 'application/json', 'Accept': 'application/json'})
+        try:
+            with urllib.request.urlopen(request, timeout=TIMEOUT) as response:
+                result = json.load(response)
+        except urllib.error.HTTPError as e:
+            # Conversion errors come back as a 500 with pandoc's message
+            raise subprocess.CalledProcessError(1, ['pandoc-server'], output=e.read().decode('utf-8', 'replace'))
+        except (urllib.error.URLError, ConnectionError, socket.timeout) as e:
+            # The server died or hung; the next available() starts a new one
+            log.warning('pandoc server did not answer; restarting it', extra={'error': str(e)})
+            self.stop()
+            raise ServerUnavailable(str(e)) from e
+        output = result.get('output', '')
+        with open(output_path, 'wb') as f:
+            f.write(base64.b64decode(output) if result.get('base64') else output.encode('utf-8'))
+
+    def rss(self):
+        return _rss(self.process.pid) if self.process and self.process.poll() is None else 0
+
+    def stop(self):
+        with self._lock:
+            if self.process and self.process.poll() is None:
+                self.process.kill()
+                self.process.wait()
+            self.process = None
+
+_pandoc = PandocServer()
+
+def pandoc(input_path, output_path, from_format, to_format):
+    # Raises CalledProcessError or FileNotFoundError like running pandoc does
+    reader = PANDOC_READERS.get(from_format)
+    writer = PANDOC_WRITERS.get(to_format)
+    if reader and writer and _pandoc.available():
+        try:
+            _pandoc.convert(input_path, output_path, reader, writer)
+            return
+        except ServerUnavailable:
+            pass  # this document runs through pandoc itself
+    subprocess.run(['pandoc', input_path, '-o', output_path], check=True, capture_output=True)
@@ -0,0 +1,122 @@
+import time
+import queue
+import threading
+from collections import OrderedDict
+
+# In-process pub/sub for conversion progress. The latest event for every file
+# lives in memory, so progress polls and SSE streams never touch the database.
+TERMINAL_STATUSES = ('completed', 'failed')
+RETAIN_SECONDS = 3600  # files are forgotten an hour after their last event
+KEEPALIVE = 15
+
+_lock = threading.Lock()
+_states = {}
+_updated = OrderedDict()  # file id -> time of its last event, oldest first
+_subscribers = {}
+
+def _set(file_id, state):
+    # Caller holds _lock
+    _states[file_id] = state
+    _updated[file_id] = time.time()
+    _updated.move_to_end(file_id)
+    for events in _subscribers.get(file_id, ()):
+        events.put(state)
+
+def _prune():
+    # Whatever the status: uploads that are never converted publish 'pending'
+    # and nothing after it. A file asked about again is reloaded from the
+    # database (app.load_progress).
+    cutoff = time.time() - RETAIN_SECONDS
+    while _updated:
+        file_id, updated_at = next(iter(_updated.items()))
+        if updated_at >= cutoff:
+            break
+        del _updated[file_id]
+        _states.pop(file_id, None)
+
+def publish(file_id, status, progress=None, file_name=None):
+    with _lock:
+        state = dict(_states.get(file_id) or {'id': file_id, 'fileName': None, 'progress': 0})
+        state['status'] = status
+        if progress is not None:
+            state['progress'] = progress
+        if file_name is not None:
+            state['fileName'] = file_name
+        _set(file_id, state)
+        _prune()
+    return state
+
+def report(file_id, progress):
+    # Progress-only update from a running converter. Late or out-of-order
+    # reports (e.g. forwarded from the process pool) never move a bar backwards
+    # or reopen a finished job.
+    with _lock:
+        state = _states.get(file_id)
+        if not state or state['status'] != 'processing' or progress <= state['progress']:
+            return
+        _set(file_id, dict(state, progress=progress))
+
+def get(file_id):
+    with _lock:
+        return _states.get(file_id)
+
+def forget(file_id):
+    with _lock:
+        _states.pop(file_id, None)
+        _updated.pop(file_id, None)
+
+def watch(file_ids, keepalive=KEEPALIVE):
+    # Yields the current state of each file, then every change until all of
+    # them are finished. Yields None when nothing happened for `keepalive`
+    # seconds so the caller can keep the connection open.
+    events = queue.Queue()
+    with _lock:
+        for file_id in file_ids:
+            _subscribers.setdefault(file_id, set()).add(events)
+            if file_id in _states:
+                events.put(_states[file_id])
+    pending = set(file_ids)
+    try:
+        while pending:
+            try:
+                state = events.get(timeout=keepalive)
+            except queue.Empty:
+                yield None
+                continue
+            if state['status'] in TERMINAL_STATUSES:
+                pending.discard(state['id'])
+            yield state
+    finally:
+        with _lock:
+            for file_id in file_ids:
+                subscribers = _subscribers.get(file_id)
+                if subscribers:
+                    subscribers.discard(events)
+                    if not subscribers:
+                        del _subscribers[file_id]
+
+# Converters running on the process pool report through a multiprocessing
+# queue that a thread in the server process (jobs._forward) drains into report()
+_worker_queue = None
+
+def init_worker(worker_queue):
+    global _worker_queue
+    _worker_queue = worker_queue
+
+class Reporter:
+    # Passed to converters as `progress`; call it with the fraction done (0-1).
+    # Picklable so it works the same in the process pool.
+    def __init__(self, file_id):
+        self.file_id = file_id
+        self.last = 0
+
+    def __call__(self, fraction):
+        # 100 is reserved for the completed event
+        progress = min(max(int(fraction * 100), 0), 99)
+        if progress <= self.last:
+            return
+        self.last = progress
+        if _worker_queue is not None:
+            _worker_queue.put(('progress', self.file_id, progress))
+        else:
+            report(self.file_id, progress)
@@ -0,0 +1,540 @@
+import io
+import os
+import math
+import mmap
+import zlib
+import time
+import struct
+import tempfile
+from PIL import Image, TiffImagePlugin
+import metrics
+
+# Image engine. convert() is plain Pillow work and runs on the process pool;
+# convert_batch() runs many small conversions in one pool task.
+JPEG_FORMATS = ['JPG', 'JPEG']
+FLATTEN_FORMATS = ['JPG', 'JPEG', 'PDF']  # targets without an alpha channel
+DEFAULT_QUALITY = 95
+RESAMPLE = Image.LANCZOS
+REDUCING_GAP = 3.0
+
+# Large images. Anything whose decoded pixels (plus one converted copy) would
+# not fit in the per-job budget is processed in horizontal bands instead.
+IMAGE_MEMORY_BUDGET = int(os.environ.get('IMAGE_MEMORY_BUDGET_MB', '512')) * 1024 * 1024
+IMAGE_MAX_PIXELS = 2 * 1024 ** 3
+
+def check_pixels(img):
+    width, height = img.size
+    if width * height > IMAGE_MAX_PIXELS:
+        raise ValueError(f'{width}x{height} image exceeds the {IMAGE_MAX_PIXELS} pixel limit')
+
+def open_image(input_path):
+    # Pillow's decompression-bomb check stays on for everything except a TIFF
+    # that band mode can decode under the budget; that one is held to
+    # IMAGE_MAX_PIXELS instead. Building the plugin class directly skips the
+    # check Image.open() applies.
+    try:
+        return Image.open(input_path)
+    except Image.DecompressionBombError:
+        try:
+            img = TiffImagePlugin.TiffImageFile(input_path)
+        except (SyntaxError, OSError):
+            img = None
+        if img is None or tiff_bands(img) is None:
+            if img is not None:
+                img.close()
+            raise
+        check_pixels(img)
+        return img
+
+def bytes_per_pixel(mode):
+    if mode.startswith('I;16'):
+        return 2
+    if mode in ['1', 'L', 'P']:
+        return 1
+    return 4  # I, F and all multi-band modes are stored as 32-bit pixels
+
+def decoded_size(img):
+    return img.size[0] * img.size[1] * bytes_per_pixel(img.mode)
+
+def pixel_count(input_path):
+    # From the header; None when Pillow cannot read it
+    try:
+        with open_image(input_path) as img:
+            return img.size[0] * img.size[1]
+    except Exception:
+        return None
+
+def memory_needed(input_path):
+    # Estimated peak memory of converting the image, from its header alone
+    with open_image(input_path) as img:
+        check_pixels(img)
+        needed = decoded_size(img) * 2
+        if needed > IMAGE_MEMORY_BUDGET and tiff_bands(img) is not None:
+            return IMAGE_MEMORY_BUDGET
+        return needed
+
+def flatten(img, background=(255, 255, 255)):
+    if img.mode in ['P', 'PA'] and ('transparency' in img.info or img.mode == 'PA'):
+        img = img.convert('RGBA')
+    if img.mode not in ['RGBA', 'LA']:
+        return img
+    flat = Image.new('RGB', img.size, background)
+    # The image is its own mask: paste() reads the alpha band in place rather
+    # than split() copying out every band
+    flat.paste(img, mask=img)
+    return flat
+
+def save(img, output_path, to_format, quality=DEFAULT_QUALITY):
+    if to_format in FLATTEN_FORMATS:
+        img = flatten(img)
+    if to_format in JPEG_FORMATS and img.mode not in ['RGB', 'L', 'CMYK']:
+        img = img.convert('RGB')
+
+    if to_format == 'PDF':
+        img.save(output_path, 'PDF')
+    elif to_format in JPEG_FORMATS:
+        img.save(output_path, 'JPEG', quality=quality)
+    else:
+        img.save(output_path, to_format)
+
+def scaled_size(size, max_size):
+    # The size an image is reduced to so it fits in max_size, or None when it
+    # already does
+    if not max_size:
+        return None
+    scale = min(max_size[0] / size[0], max_size[1] / size[1])
+    if scale >= 1:
+        return None
+    return max(1, round(size[0] * scale)), max(1, round(size[1] * scale))
+
+def convert(input_path, output_path, to_format, quality=DEFAULT_QUALITY, progress=None, max_size=None):
+    # `max_size` (width, height) bounds the output; the image is scaled down
+    # to fit, never up
+    with open_image(input_path) as img:
+        check_pixels(img)
+        if decoded_size(img) * 2 > IMAGE_MEMORY_BUDGET:
+            bands = tiff_bands(img)
+            if bands is not None:
+                convert_bands(img, bands, output_path, to_format, quality, progress, max_size)
+                return
+        with metrics.stage('decode'):
+            if scaled_size(img.size, max_size):
+                # thumbnail() first asks the decoder for a reduced-resolution
+                # draft (JPEG decodes straight to 1/2, 1/4 or 1/8 scale), then
+                # reduce()s by whole factors and only resamples the last step,
+                # so the image is never decoded or filtered at full size
+                img.thumbnail(max_size, RESAMPLE, reducing_gap=REDUCING_GAP)
+            else:
+                img.load()
+        with metrics.stage('encode'):
+            save(img, output_path, to_format, quality)
+
+def convert_batch(tasks):
+    # (input_path, output_path, to_format, quality, max_size) tuples, run
+    # one after another in the calling process. Returns an exception (or
+    # None) per task, so one bad file does not sink the others.
+    errors = []
+    for input_path, output_path, to_format, quality, max_size in tasks:
+        try:
+            convert(input_path, output_path, to_format, quality, max_size=max_size)
+            errors.append(None)
+        except Exception as e:
+            errors.append(e)
+    return errors
+
+# BAND DECODING
+# Pillow decodes a compressed TIFF as a single tile, so each strip (or row of
+# tiles) is handed to it as a small standalone TIFF that shares the original
+# tags and holds only that piece's data.
+POINTER_TAGS = [330, 34665, 34853, 40965]  # sub-IFDs that point into the original file
+COUNT_TAGS = {273: 279, 324: 325}  # strip/tile offsets -> their byte counts
+
+def band_rows(img):
+    # A band and one converted copy of it use at most half the budget
+    return max(1, IMAGE_MEMORY_BUDGET // 4 // (img.size[0] * 4))
+
+def _as_tuple(value):
+    return value if isinstance(value, tuple) else (value,)
+
+def _piece_tags(img, offset_tag):
+    # The original tags minus anything that points into the original file;
+    # the per-strip offset and byte count arrays are rebuilt for every piece
+    tags = img.tag_v2
+    skip = POINTER_TAGS + [offset_tag, COUNT_TAGS[offset_tag]]
+    return [(tag, value, tags.tagtype.get(tag)) for tag, value in tags.items() if tag not in skip]
+
+def _tiff_piece(prefix, template, rows, offset_tag, pieces):
+    ifd = TiffImagePlugin.ImageFileDirectory_v2(prefix=prefix)
+    for tag, value, tagtype in template:
+        if tagtype is not None:
+            ifd.tagtype[tag] = tagtype
+        ifd[tag] = value
+    ifd[257] = rows
+    if offset_tag == 273:
+        ifd[278] = rows  # the piece is always a single strip
+    ifd[COUNT_TAGS[offset_tag]] = tuple(len(piece) for piece in pieces)
+    order = '<' if prefix == b'II' else '>'
+    if offset_tag == 273:
+        # tobytes() points a single strip offset past the IFD by itself
+        ifd[273] = 0
+        header = prefix + struct.pack(order + 'HL', 42, 8) + ifd.tobytes(8)
+    else:
+        ifd[offset_tag] = (0,) * len(pieces)
+        start = 8 + len(ifd.tobytes(8))
+        offsets = []
+        for piece in pieces:
+            offsets.append(start)
+            start += len(piece)
+        ifd[offset_tag] = tuple(offsets)
+        header = prefix + struct.pack(order + 'HL', 42, 8) + ifd.tobytes(8)
+    # Past Image.open()'s bomb check too: the whole image was checked already
+    with TiffImagePlugin.TiffImageFile(io.BytesIO(header + b''.join(pieces))) as piece:
+        piece.load()
+        return piece
+
+def tiff_bands(img, rows_per_band=None):
+    # Returns a generator of (top, band image) covering the whole image, or
+    # None when the file cannot be decoded a band at a time
+    if img.format != 'TIFF' or not img.filename or getattr(img, 'n_frames', 1) != 1:
+        return None
+    tags = img.tag_v2
+    if tags.get(284, 1) != 1:
+        return None  # planar (separate band) storage
+    width, height = img.size
+    rows_per_band = rows_per_band or band_rows(img)
+    tiled = 322 in tags
+    if tiled:
+        unit = tags[323]
+        across = math.ceil(width / tags[322])
+    elif tags.get(259, 1) == 1:
+        # Uncompressed: any row range is a byte range, whatever the strips
+        unit = 1
+        across = 0
+    else:
+        unit = min(tags.get(278, height), height)
+        across = 1
+    if unit > rows_per_band * 2:
+        return None  # a single strip is already over budget
+    return _bands(img, tiled, unit, across, max(unit, rows_per_band // unit * unit))
+
+def _bands(img, tiled, unit, across, step):
+    tags = img.tag_v2
+    width, height = img.size
+    offset_tag = 324 if tiled else 273
+    offsets = _as_tuple(tags[offset_tag])
+    counts = _as_tuple(tags[COUNT_TAGS[offset_tag]])
+    row_bytes = math.ceil(width * sum(_as_tuple(tags.get(258, 1))) / 8)
+    rows_per_strip = min(tags.get(278, height), height)
+    template = _piece_tags(img, offset_tag)
+    # A handle of our own, since Pillow closes img.fp once an image loads
+    with open(img.filename, 'rb') as fp:
+        for top in range(0, height, step):
+            rows = min(step, height - top)
+            if across == 0:
+                # The whole band in one piece, gathered across strips
+                data = _read_rows(fp, offsets, rows_per_strip, top, rows, row_bytes)
+                yield top, _tiff_piece(tags.prefix, template, rows, offset_tag, [data])
+                continue
+            band = None
+            for first in range(top, top + rows, unit):
+                index = first // unit * across
+                pieces = []
+                for i in range(index, index + across):
+                    fp.seek(offsets[i])
+                    pieces.append(fp.read(counts[i]))
+                piece = _tiff_piece(tags.prefix, template, min(unit, height - first), offset_tag, pieces)
+                if piece.height == rows:
+                    band = piece
+                    break
+                if band is None:
+                    band = Image.new(piece.mode, (width, rows))
+                    if piece.mode == 'P':
+                        band.putpalette(piece.getpalette())
+                band.paste(piece, (0, first - top))
+            yield top, band
+
+def _read_rows(fp, offsets, rows_per_strip, first, count, row_bytes):
+    # Uncompressed strips: gather `count` rows starting at row `first`
+    data = []
+    position = first
+    while position < first + count:
+        strip = position // rows_per_strip
+        rows = min((strip + 1) * rows_per_strip, first + count) - position
+        fp.seek(offsets[strip] + (position - strip * rows_per_strip) * row_bytes)
+        data.append(fp.read(rows * row_bytes))
+        position += rows
+    return b''.join(data)
+
+# BAND WRITERS
+# PNG, TIFF, BMP and PDF are written row by row. Pillow encodes JPEG and WEBP
+# only from a whole image: JPEG bands are assembled in a file-backed canvas,
+# WEBP ones in memory when that fits. Nothing is ever scaled down.
+STREAM_MODES = {
+    # format: {image mode: (raw mode, header arguments)}
+    'PNG': {'1': ('1', (1, 0)), 'L': ('L', (8, 0)), 'I;16': ('I;16B', (16, 0)),
+            'LA': ('LA', (8, 4)), 'RGB': ('RGB', (8, 2)), 'RGBA': ('RGBA', (8, 6))},
+    'TIFF': {'1': ('1', ((1,), 1)), 'L': ('L', ((8,), 1)), 'I;16': ('I;16', ((16,), 1)),
+             'RGB': ('RGB', ((8, 8, 8), 2)), 'RGBA': ('RGBA', ((8, 8, 8, 8), 2)),
+             'CMYK': ('CMYK', ((8, 8, 8, 8), 5))},
+    'BMP': {'RGB': ('BGR', None)},
+    'PDF': {'L': ('L', b'/DeviceGray'), 'RGB': ('RGB', b'/DeviceRGB'), 'CMYK': ('CMYK', b'/DeviceCMYK')},
+}
+MAX_DIMENSIONS = {'WEBP': 16383, 'JPG': 65500, 'JPEG': 65500}
+MAX_FILE_BYTES = {'TIFF': 0xFFFFFFFF, 'BMP': 0xFFFFFFFF}  # 32-bit offsets and sizes
+
+def stream_mode(img, to_format):
+    modes = STREAM_MODES[to_format]
+    if img.mode in modes:
+        return img.mode
+    has_alpha = img.mode in ['RGBA', 'LA', 'PA'] or 'transparency' in img.info
+    return 'RGBA' if has_alpha and 'RGBA' in modes else 'RGB'
+
+def convert_bands(img, bands, output_path, to_format, quality=DEFAULT_QUALITY, progress=None, max_size=None):
+    width, height = img.size
+    started = time.perf_counter()
+    decoding = [0]  # time spent pulling bands; the rest is the writer's
+
+    def tracked():
+        iterator = iter(bands)
+        while True:
+            pulled = time.perf_counter()
+            try:
+                top, band = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                decoding[0] += time.perf_counter() - pulled
+            yield top, band
+            if progress:
+                progress((top + band.height) / height)
+
+    size = scaled_size(img.size, max_size)
+    if size:
+        write_scaled(img, tracked(), output_path, to_format, size, quality)
+    else:
+        write_bands(img, tracked(), output_path, to_format, quality)
+    metrics.observe_stage('decode', decoding[0])
+    metrics.observe_stage('encode', time.perf_counter() - started - decoding[0])
+
+def write_bands(img, bands, output_path, to_format, quality):
+    width, height = img.size
+
+    if to_format in MAX_DIMENSIONS and max(width, height) > MAX_DIMENSIONS[to_format]:
+        raise ValueError(f'{width}x{height} image is too large for {to_format} '
+                         f'(at most {MAX_DIMENSIONS[to_format]} pixels a side)')
+    if to_format not in JPEG_FORMATS + list(STREAM_MODES) + list(MAX_DIMENSIONS):
+        raise ValueError(f'{width}x{height} images cannot be converted to {to_format} within the memory budget')
+    try:
+        if to_format in JPEG_FORMATS:
+            write_jpeg(img, bands, output_path, quality)
+        elif to_format in MAX_DIMENSIONS:
+            write_whole(img, bands, output_path, to_format, quality)
+        else:
+            mode = 'L' if to_format == 'PDF' and img.mode in ['1', 'LA'] else stream_mode(img, to_format)
+            writer = {'PNG': write_png, 'TIFF': write_tiff, 'BMP': write_bmp, 'PDF': write_pdf}[to_format]
+            writer(bands, img.size, mode, STREAM_MODES[to_format][mode], output_path)
+    except BaseException:
+        # Never leave a partial output behind
+        if isinstance(output_path, str) and os.path.exists(output_path):
+            os.remove(output_path)
+        raise
+
+def _raw_rows(bands, mode, rawmode):
+    # (band bytes, bytes per row) for each band, converted to the output mode
+    for top, band in bands:
+        if band.mode != mode and mode in ['L', 'RGB']:
+            band = flatten(band)
+        if band.mode != mode:
+            band = band.convert(mode)
+        data = band.tobytes('raw', rawmode)
+        yield data, len(data) // band.height
+
+def _png_chunk(f, kind, data):
+    f.write(struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data)))
+
+def write_png(bands, size, mode, spec, output_path):
+    rawmode, (depth, color_type) = spec
+    compressor = zlib.compressobj(6)
+    with open(output_path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        _png_chunk(f, b'IHDR', struct.pack('>IIBBBBB', size[0], size[1], depth, color_type, 0, 0, 0))
+        for data, stride in _raw_rows(bands, mode, rawmode):
+            # Filter type 0 on every row; zlib still gets a continuous stream
+            filtered = b''.join(b'\0' + data[start:start + stride] for start in range(0, len(data), stride))
+            compressed = compressor.compress(filtered)
+            if compressed:
+                _png_chunk(f, b'IDAT', compressed)
+        _png_chunk(f, b'IDAT', compressor.flush())
+        _png_chunk(f, b'IEND', b'')
+
+def write_tiff(bands, size, mode, spec, output_path):
+    # Uncompressed strips, one per band, with the IFD written last once the
+    # strip offsets are known
+    rawmode, (bits, photometric) = spec
+    # Checked before anything is written; the IFD is checked again below
+    if 8 + math.ceil(size[0] * sum(bits) / 8) * size[1] > MAX_FILE_BYTES['TIFF']:
+        raise ValueError('Image too large for a classic TIFF file')
+    offsets = []
+    counts = []
+    rows_per_strip = None
+    with open(output_path, 'wb') as f:
+        f.write(b'II*\x00\x00\x00\x00\x00')
+        for data, stride in _raw_rows(bands, mode, rawmode):
+            rows_per_strip = rows_per_strip or len(data) // stride
+            offsets.append(f.tell())
+            counts.append(len(data))
+            f.write(data)
+        entries = [
+            (256, 4, [size[0]]), (257, 4, [size[1]]), (258, 3, list(bits)), (259, 3, [1]),
+            (262, 3, [photometric]), (273, 4, offsets), (277, 3, [len(bits)]),
+            (278, 4, [rows_per_strip or size[1]]), (279, 4, counts), (284, 3, [1]),
+        ]
+        if mode == 'RGBA':
+            entries.append((338, 3, [2]))  # unassociated alpha
+        if f.tell() % 2:
+            f.write(b'\0')
+        ifd_offset = f.tell()
+        data_offset = ifd_offset + 2 + len(entries) * 12 + 4
+        ifd = struct.pack('<H', len(entries))
+        extra = b''
+        for tag, kind, values in entries:
+            packed = struct.pack(f'<{len(values)}{"H" if kind == 3 else "L"}', *values)
+            if len(packed) <= 4:
+                ifd += struct.pack('<HHL', tag, kind, len(values)) + packed.ljust(4, b'\0')
+            else:
+                ifd += struct.pack('<HHLL', tag, kind, len(values), data_offset + len(extra))
+                extra += packed
+        if data_offset + len(extra) > MAX_FILE_BYTES['TIFF']:
+            raise ValueError('Image too large for a classic TIFF file')
+        f.write(ifd + b'\0\0\0\0' + extra)
+        f.seek(4)
+        f.write(struct.pack('<L', ifd_offset))
+
+def write_bmp(bands, size, mode, spec, output_path):
+    # A negative height marks a top-down bitmap, so rows go out in order
+    rawmode, _ = spec
+    width, height = size
+    row_size = (width * 3 + 3) // 4 * 4
+    padding = b'\0' * (row_size - width * 3)
+    file_size = 54 + row_size * height
+    if file_size > MAX_FILE_BYTES['BMP']:
+        raise ValueError('Image too large for a BMP file')
+    with open(output_path, 'wb') as f:
+        f.write(b'BM' + struct.pack('<LHHL', file_size, 0, 0, 54))
+        f.write(struct.pack('<LllHHLLllLL', 40, width, -height, 1, 24, 0, row_size * height, 2835, 2835, 0, 0))
+        for data, stride in _raw_rows(bands, mode, rawmode):
+            f.write(b''.join(data[start:start + stride] + padding for start in range(0, len(data), stride)))
+
+def write_pdf(bands, size, mode, spec, output_path):
+    # A single page holding the image as one Flate-compressed XObject, at 72
+    # dpi like Pillow's PDF output. The stream length is an object of its own,
+    # written once the data is out.
+    rawmode, colorspace = spec
+    width, height = size
+    compressor = zlib.compressobj(6)
+    offsets = []
+    with open(output_path, 'wb') as f:
+        def start_object():
+            offsets.append(f.tell())
+            f.write(b'%d 0 obj\n' % len(offsets))
+
+        f.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+        start_object()
+        f.write(b'<< /Type /Catalog /Pages 2 0 R >>\nendobj\n')
+        start_object()
+        f.write(b'<< /Type /Pages /Kids [3 0 R] /Count 1 >>\nendobj\n')
+        start_object()
+        f.write(b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %d %d] '
+                b'/Resources << /XObject << /Im0 4 0 R >> >> /Contents 5 0 R >>\nendobj\n' % (width, height))
+        start_object()
+        f.write(b'<< /Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace %s '
+                b'/BitsPerComponent 8 /Filter /FlateDecode /Length 6 0 R >>\nstream\n' % (width, height, colorspace))
+        length = 0
+        for data, stride in _raw_rows(bands, mode, rawmode):
+            compressed = compressor.compress(data)
+            length += len(compressed)
+            f.write(compressed)
+        compressed = compressor.flush()
+        length += len(compressed)
+        f.write(compressed + b'\nendstream\nendobj\n')
+        content = b'q %d 0 0 %d 0 0 cm /Im0 Do Q' % (width, height)
+        start_object()
+        f.write(b'<< /Length %d >>\nstream\n%s\nendstream\nendobj\n' % (len(content), content))
+        start_object()
+        f.write(b'%d\nendobj\n' % length)
+        xref = f.tell()
+        f.write(b'xref\n0 %d\n0000000000 65535 f \n' % (len(offsets) + 1))
+        f.write(b''.join(b'%010d 00000 n \n' % offset for offset in offsets))
+        f.write(b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(offsets) + 1, xref))
+
+def write_jpeg(img, bands, output_path, quality=DEFAULT_QUALITY):
+    # The canvas lives in a temporary file mapped into memory, so its pages
+    # go back to disk under memory pressure rather than counting against the
+    # budget. Bands are copied in as raw rows; Pillow then encodes straight
+    # from the mapping.
+    width, height = img.size
+    if img.mode == 'CMYK':
+        mode, rawmode, pixel_size = 'CMYK', 'CMYK', 4
+    elif img.mode in ['1', 'L']:
+        mode, rawmode, pixel_size = 'L', 'L', 1
+    else:
+        mode, rawmode, pixel_size = 'RGB', 'RGBX', 4
+    directory = os.path.dirname(output_path) or '.' if isinstance(output_path, str) else None
+    with tempfile.TemporaryFile(dir=directory) as spool:
+        spool.truncate(width * height * pixel_size)
+        with mmap.mmap(spool.fileno(), width * height * pixel_size) as buffer:
+            position = 0
+            for data, stride in _raw_rows(bands, mode, rawmode):
+                buffer[position:position + len(data)] = data
+                position += len(data)
+            canvas = Image.frombuffer(rawmode, (width, height), buffer, 'raw', rawmode, 0, 1)
+            try:
+                canvas.save(output_path, 'JPEG', quality=quality)
+            finally:
+                canvas.close()
+                del canvas
+
+def within_bomb_guard(img):
+    # Whether Image.open() would have opened the image without open_image()
+    limit = Image.MAX_IMAGE_PIXELS
+    return limit is None or img.size[0] * img.size[1] <= limit * 2
+
+def write_whole(img, bands, output_path, to_format, quality=DEFAULT_QUALITY):
+    # Formats whose encoder needs the whole image in memory. An image within
+    # Pillow's own pixel limit is built whatever the budget, as before band
+    # mode existed; a larger one must fit in half the budget.
+    width, height = img.size
+    mode = 'RGBA' if img.mode in ['RGBA', 'LA', 'PA'] or 'transparency' in img.info else 'RGB'
+    if not within_bomb_guard(img) and width * height * bytes_per_pixel(mode) > IMAGE_MEMORY_BUDGET // 2:
+        raise ValueError(f'{width}x{height} image cannot be converted to {to_format} within the '
+                         f'{IMAGE_MEMORY_BUDGET // (1024 * 1024)} MB memory budget')
+    canvas = Image.new(mode, (width, height))
+    for top, band in bands:
+        if band.mode != mode and mode == 'RGB':
+            band = flatten(band)
+        if band.mode != mode:
+            band = band.convert(mode)
+        canvas.paste(band, (0, top))
+    save(canvas, output_path, to_format, quality)
+
+def write_scaled(img, bands, output_path, to_format, size, quality=DEFAULT_QUALITY):
+    # A requested output size: each band is box-filtered down to its share
+    # of the small canvas as it is decoded, so band edges line up without
+    # seams and the full-size image never exists
+    width, height = img.size
+    mode = 'RGBA' if img.mode in ['RGBA', 'LA', 'PA'] or 'transparency' in img.info else 'RGB'
+    canvas = Image.new(mode, size)
+    scale = size[1] / height
+    for top, band in bands:
+        first, last = round(top * scale), round((top + band.height) * scale)
+        if last <= first:
+            continue
+        if band.mode != mode:
+            band = band.convert(mode)
+        canvas.paste(band.resize((size[0], last - first), Image.BOX), (0, first))
+    try:
+        save(canvas, output_path, to_format, quality)
+    except BaseException:
+        if isinstance(output_path, str) and os.path.exists(output_path):
+            os.remove(output_path)
+        raise
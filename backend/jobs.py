@@ -0,0 +1,450 @@
+import os
+import time
+import logging
+import sqlite3
+import db
+import stats
+import media
+import events
+import documents
+import metrics
+import settings
+import threading
+import multiprocessing
+from contextlib import contextmanager, nullcontext
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+WORKER_COUNT = os.cpu_count() or 2
+MAX_ATTEMPTS = 3
+POLL_INTERVAL = 1.0
+# Jobs estimated to take at most FAST_LANE_SECONDS also go to the fast lane,
+# served by FAST_LANE_WORKERS workers of their own on top of WORKER_COUNT, so
+# small conversions never wait behind a long transcode. What those workers
+# run gets capacity bulk jobs cannot take: process and document pools of
+# FAST_LANE_WORKERS processes, FAST_LANE_MEMORY of the memory limit and
+# media.FAST_LANE_ENCODES ffmpeg slots.
+FAST_LANE_SECONDS = float(os.environ.get('FAST_LANE_SECONDS', '2'))
+FAST_LANE_WORKERS = int(os.environ.get('FAST_LANE_WORKERS', '1'))
+FAST_LANE_MEMORY = int(os.environ.get('FAST_LANE_MEMORY_MB', '256')) * 1024 * 1024
+# A job queued this long is taken before any other, whatever its tag
+STARVATION_SECONDS = int(os.environ.get('JOB_STARVATION_SECONDS', '600'))
+REFINE_BATCH = 20
+# Small jobs for the same format pair a worker may claim at once, when the
+# handler can run them together (start_workers' batch_handler)
+BATCH_SIZE = int(os.environ.get('JOB_BATCH_SIZE', '16'))
+# Conversions that declare an estimated peak memory are only started while
+# the running ones leave room for it under this ceiling
+MEMORY_LIMIT = int(os.environ.get('CONVERSION_MEMORY_LIMIT_MB', '2048')) * 1024 * 1024
+
+_wakeup = threading.Event()
+_refine_wakeup = threading.Event()
+_workers = []
+_lane = threading.local()  # the lane of the worker thread running a job
+_cpu_pools = {}  # lane -> ProcessPoolExecutor
+_cpu_pool_lock = threading.Lock()
+_progress_queue = None
+_document_pools = {}  # lane -> documents.WorkerPool
+_memory_free = threading.Condition()
+_memory_used = 0
+_busy_lock = threading.Lock()
+_busy = 0
+_enqueued = {}  # file_id -> time.time() when it was queued by this process
+
+log = logging.getLogger(__name__)
+
+def recover_jobs():
+    # Anything still marked processing was running when the server died
+    conn = db.connect()
+    c = conn.cursor()
+    c.execute('''UPDATE jobs SET status = 'failed', finished_at = CURRENT_TIMESTAMP,
+                 error_message = 'Gave up after repeated interrupted attempts'
+                 WHERE status = 'processing' AND attempts >= ?''', (MAX_ATTEMPTS,))
+    abandoned = '''id IN (SELECT file_id FROM jobs WHERE status = 'failed' AND attempts >= ?)
+                   AND status = 'processing' '''
+    c.execute(f'SELECT from_format, to_format FROM files WHERE {abandoned}', (MAX_ATTEMPTS,))
+    for from_format, to_format in c.fetchall():
+        stats.record(c, from_format, to_format, failures=1)
+    c.execute(f'''UPDATE files SET status = 'failed', error_message = 'Conversion interrupted'
+                  WHERE {abandoned}''', (MAX_ATTEMPTS,))
+    c.execute('''UPDATE jobs SET status = 'queued', started_at = NULL WHERE status = 'processing' ''')
+    recovered = c.rowcount
+    c.execute('''UPDATE files SET status = 'pending'
+                 WHERE id IN (SELECT file_id FROM jobs WHERE status = 'queued') AND status = 'processing' ''')
+    conn.commit()
+    conn.close()
+    if recovered:
+        log.warning('Re-queued interrupted conversion jobs', extra={'count': recovered})
+    return recovered
+
+def enqueue(file_ids, client='', costs=None):
+    # `costs` maps file ids to estimated seconds of work (costs.estimate).
+    # A client's jobs are tagged one after another from where its queued work
+    # ends, or from the virtual clock if it has none, cheapest first. A client
+    # with a lot queued therefore only delays its own later jobs, and a cheap
+    # job from anyone else lands ahead of an expensive one.
+    costs = costs or {}
+    conn = db.connect()
+    c = conn.cursor()
+    try:
+        c.execute('BEGIN IMMEDIATE')
+        new = []
+        for file_id in dict.fromkeys(file_ids):
+            c.execute('''SELECT 1 FROM jobs WHERE file_id = ? AND status IN ('queued', 'processing')''', (file_id,))
+            if not c.fetchone():
+                new.append(file_id)
+        c.execute('SELECT vtime FROM job_clock')
+        tag = c.fetchone()[0]
+        c.execute('''SELECT MAX(finish_tag) FROM jobs WHERE client = ? AND status IN ('queued', 'processing')''', (client,))
+        tag = max(tag, c.fetchone()[0] or 0)
+        for file_id in sorted(new, key=lambda file_id: costs.get(file_id, 0)):
+            cost = costs.get(file_id, 0)
+            lane = _lane_for(cost)
+            c.execute('''INSERT INTO jobs (file_id, client, cost, lane, start_tag, finish_tag)
+                         VALUES (?, ?, ?, ?, ?, ?)''', (file_id, client, cost, lane, tag, tag + cost))
+            tag += cost
+            _enqueued[file_id] = time.time()
+        conn.commit()
+    finally:
+        conn.close()
+    _wakeup.set()
+    _refine_wakeup.set()
+    return len(new)
+
+def _lane_for(cost):
+    return 'fast' if cost <= FAST_LANE_SECONDS else 'bulk'
+
+def refine_estimates(estimate, batch=REFINE_BATCH):
+    # Replaces the quick estimates jobs were queued with by estimate(file_id),
+    # which may read or probe the file, for jobs no worker has claimed yet.
+    # The job keeps its start tag; its finish tag and lane follow the new cost,
+    # and the client's later jobs, tagged from where this one ended, move by
+    # the same amount. Returns how many jobs were looked at.
+    conn = db.connect()
+    c = conn.cursor()
+    c.execute('''SELECT id, file_id FROM jobs WHERE status = 'queued' AND estimated = 0
+                 ORDER BY finish_tag LIMIT ?''', (batch,))
+    pending = c.fetchall()
+    conn.close()
+    for job_id, file_id in pending:
+        try:
+            cost = estimate(file_id)
+        except Exception:
+            log.exception('Estimating job failed', extra={'job_id': job_id, 'file_id': file_id})
+            cost = None
+        conn = db.connect()
+        c = conn.cursor()
+        try:
+            c.execute('BEGIN IMMEDIATE')
+            c.execute('''SELECT client, cost, finish_tag FROM jobs WHERE id = ? AND status = 'queued' ''', (job_id,))
+            job = c.fetchone()
+            if job and cost is not None:
+                client, old_cost, finish_tag = job
+                shift = cost - old_cost
+                c.execute('''UPDATE jobs SET cost = ?, lane = ?, finish_tag = finish_tag + ?, estimated = 1
+                             WHERE id = ?''', (cost, _lane_for(cost), shift, job_id))
+                c.execute('''UPDATE jobs SET start_tag = start_tag + ?, finish_tag = finish_tag + ?
+                             WHERE client = ? AND status = 'queued' AND id != ? AND start_tag >= ?''',
+                          (shift, shift, client, job_id, finish_tag))
+            else:
+                c.execute('UPDATE jobs SET estimated = 1 WHERE id = ?', (job_id,))
+            conn.commit()
+        finally:
+            conn.close()
+    return len(pending)
+
+def _refine_loop(estimate):
+    while True:
+        _refine_wakeup.wait(POLL_INTERVAL)
+        _refine_wakeup.clear()
+        try:
+            while refine_estimates(estimate):
+                pass
+        except sqlite3.OperationalError as e:
+            log.warning('Refining job estimates failed', extra={'error': str(e)})
+
+def claim_job(lane=None, batchable=None):
+    # The job with the lowest finish tag, in `lane` only if given; a job that
+    # has waited STARVATION_SECONDS goes first regardless. Returns a list of
+    # (job id, file id): when batchable(from_format, to_format) holds for a
+    # small job, up to BATCH_SIZE - 1 more small queued jobs for the same
+    # pair come with it, next in tag order.
+    conn = db.connect()
+    c = conn.cursor()
+    lane_sql = 'AND j.lane = ?' if lane else ''
+    lane_params = [lane] if lane else []
+    try:
+        # Idle workers poll; only take the write lock when there is work
+        c.execute(f'''SELECT 1 FROM jobs j WHERE j.status = 'queued' {lane_sql} LIMIT 1''', lane_params)
+        if not c.fetchone():
+            return []
+        # BEGIN IMMEDIATE takes the write lock up front so two workers can
+        # never claim the same row
+        c.execute('BEGIN IMMEDIATE')
+        columns = '''j.id, j.file_id, j.start_tag, j.cost, f.from_format, f.to_format,
+                     (julianday('now') - julianday(j.enqueued_at)) * 86400'''
+        c.execute(f'''SELECT {columns} FROM jobs j LEFT JOIN files f ON f.id = j.file_id
+                      WHERE j.status = 'queued' {lane_sql} AND j.enqueued_at <= datetime('now', ?)
+                      ORDER BY j.id LIMIT 1''', lane_params + [f'-{STARVATION_SECONDS} seconds'])
+        job = c.fetchone()
+        if not job:
+            c.execute(f'''SELECT {columns} FROM jobs j LEFT JOIN files f ON f.id = j.file_id
+                          WHERE j.status = 'queued' {lane_sql}
+                          ORDER BY j.finish_tag, j.id LIMIT 1''', lane_params)
+            job = c.fetchone()
+        if not job:
+            conn.commit()
+            return []
+        claimed = [job]
+        job_id, _, _, cost, from_format, to_format, _ = job
+        if batchable and cost <= FAST_LANE_SECONDS and from_format and batchable(from_format, to_format):
+            c.execute(f'''SELECT {columns} FROM jobs j JOIN files f ON f.id = j.file_id
+                          WHERE j.status = 'queued' {lane_sql} AND j.id != ? AND j.cost <= ?
+                          AND f.from_format = ? AND f.to_format = ?
+                          ORDER BY j.finish_tag, j.id LIMIT ?''',
+                      lane_params + [job_id, FAST_LANE_SECONDS, from_format, to_format, BATCH_SIZE - 1])
+            claimed += c.fetchall()
+        for job_id, _, start_tag, _, _, _, _ in claimed:
+            c.execute('''UPDATE jobs SET status = 'processing', attempts = attempts + 1,
+                         started_at = CURRENT_TIMESTAMP WHERE id = ?''', (job_id,))
+        c.execute('UPDATE job_clock SET vtime = MAX(vtime, ?)', (max(job[2] for job in claimed),))
+        conn.commit()
+        for _, file_id, _, _, from_format, to_format, waited in claimed:
+            # enqueued_at only has whole seconds; jobs queued by this process
+            # (not recovered at startup) have an exact time
+            enqueued_at = _enqueued.pop(file_id, None)
+            if enqueued_at is not None:
+                waited = time.time() - enqueued_at
+            metrics.observe_stage('queue_wait', max(waited or 0, 0), from_format, to_format)
+        return [(job[0], job[1]) for job in claimed]
+    finally:
+        # close() rolls back anything left open
+        conn.close()
+
+def cancel_queued(file_id):
+    # Only jobs no worker has claimed yet; claim_job never sees them again
+    conn = db.connect()
+    c = conn.cursor()
+    c.execute('''UPDATE jobs SET status = 'cancelled', finished_at = CURRENT_TIMESTAMP
+                 WHERE file_id = ? AND status = 'queued' ''', (file_id,))
+    cancelled = c.rowcount
+    conn.commit()
+    conn.close()
+    _enqueued.pop(file_id, None)
+    return cancelled > 0
+
+def finish_job(job_id, status, error_message=None):
+    conn = db.connect()
+    c = conn.cursor()
+    c.execute('''UPDATE jobs SET status = ?, error_message = ?, finished_at = CURRENT_TIMESTAMP
+                 WHERE id = ?''', (status, error_message, job_id))
+    conn.commit()
+    conn.close()
+
+def queue_depth():
+    conn = db.connect()
+    c = conn.cursor()
+    c.execute('''SELECT status, COUNT(*) FROM jobs WHERE status IN ('queued', 'processing') GROUP BY status''')
+    counts = dict(c.fetchall())
+    conn.close()
+    return {'queued': counts.get('queued', 0), 'processing': counts.get('processing', 0)}
+
+def _current_lane():
+    return getattr(_lane, 'name', None)
+
+def _lane_size():
+    return FAST_LANE_WORKERS if _current_lane() == 'fast' else WORKER_COUNT
+
+def _get_cpu_pool():
+    # The pool of the calling worker's lane, so bulk jobs never fill the
+    # processes fast-lane jobs run on
+    global _progress_queue
+    lane = _current_lane()
+    with _cpu_pool_lock:
+        if lane not in _cpu_pools:
+            # spawn rather than fork: the parent is full of threads holding locks
+            context = multiprocessing.get_context('spawn')
+            if _progress_queue is None:
+                _progress_queue = context.Queue()
+                forwarder = threading.Thread(target=_forward, args=(_progress_queue,), name='progress-forwarder')
+                forwarder.daemon = True
+                forwarder.start()
+            _cpu_pools[lane] = ProcessPoolExecutor(max_workers=_lane_size(), mp_context=context,
+                                                   initializer=_init_worker, initargs=(_progress_queue,))
+        return _cpu_pools[lane]
+
+# Pool processes send progress and metrics back through one queue, tagged
+# with their kind
+def _init_worker(worker_queue):
+    events.init_worker(worker_queue)
+    metrics.init_worker(worker_queue)
+
+def _dispatch(message):
+    if message[0] == 'progress':
+        events.report(*message[1:])
+    elif message[0] == 'metric':
+        metrics.replay(*message[1:])
+
+def _forward(worker_queue):
+    while True:
+        _dispatch(worker_queue.get())
+
+def _get_document_pool():
+    lane = _current_lane()
+    with _cpu_pool_lock:
+        if lane not in _document_pools:
+            size = FAST_LANE_WORKERS if lane == 'fast' else documents.WORKERS
+            _document_pools[lane] = documents.WorkerPool(size, initializer=_init_worker, forward=_dispatch)
+        return _document_pools[lane]
+
+def shutdown_document_pool():
+    with _cpu_pool_lock:
+        for pool in _document_pools.values():
+            pool.shutdown()
+        _document_pools.clear()
+
+def shutdown_cpu_pool():
+    # Waits for the pool processes to exit (the benchmark counts their memory)
+    with _cpu_pool_lock:
+        for pool in _cpu_pools.values():
+            pool.shutdown(wait=True)
+        _cpu_pools.clear()
+
+def run_cpu(fn, *args, **kwargs):
+    return _get_cpu_pool().submit(fn, *args, **kwargs).result()
+
+def map_cpu(fn, args_list, window=None):
+    # Like Executor.map over the process pool, but yields results in order
+    # while keeping at most `window` tasks in flight, so a huge input never
+    # queues (or buffers) all of its chunks at once
+    pool = _get_cpu_pool()
+    window = window or _lane_size() * 2
+    pending = deque()
+    for args in args_list:
+        pending.append(pool.submit(fn, *args))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+@contextmanager
+def reserve_memory(amount):
+    # Blocks until `amount` bytes fit under MEMORY_LIMIT. Bulk jobs leave
+    # FAST_LANE_MEMORY of it free for the fast lane. A job larger than its
+    # whole limit is admitted once nothing else holds memory, so it runs
+    # alone rather than never.
+    global _memory_used
+    limit = MEMORY_LIMIT
+    if _current_lane() != 'fast':
+        limit = max(MEMORY_LIMIT - FAST_LANE_MEMORY, MEMORY_LIMIT // 2)
+    amount = min(amount, limit)
+    with _memory_free:
+        _memory_free.wait_for(lambda: _memory_used + amount <= limit)
+        _memory_used += amount
+    try:
+        yield
+    finally:
+        with _memory_free:
+            _memory_used -= amount
+            _memory_free.notify_all()
+
+def _call_converter(func, *args, progress=None, options=None):
+    # Converter args are (input_path, output_path, from_format, to_format);
+    # the stages a converter times are labelled with that pair
+    with metrics.pair(args[2], args[3]), settings.pinned(options):
+        return func(*args, progress=progress)
+
+def run_converter(converter, *args, progress=None, options=None):
+    # Route each conversion to the executor its converter asked for.
+    # `options` is the settings snapshot the converter reads its encoder
+    # parameters from (settings.current() when not given).
+    memory = converter.memory(*args) if converter.memory else 0
+    options = options if options is not None else settings.current()
+    encodes = media.fast_lane() if _current_lane() == 'fast' else nullcontext()
+    with reserve_memory(memory), encodes, metrics.stage('convert', args[2], args[3]):
+        if converter.executor == 'process':
+            return run_cpu(_call_converter, converter.func, *args, progress=progress, options=options)
+        if converter.executor == 'document':
+            return _get_document_pool().run(_call_converter, converter.func, *args, progress=progress, options=options)
+        return _call_converter(converter.func, *args, progress=progress, options=options)
+
+def run_batch(func, tasks, memory, from_format, to_format):
+    # func(tasks) as one process pool task, holding the batch's combined
+    # memory estimate
+    encodes = media.fast_lane() if _current_lane() == 'fast' else nullcontext()
+    with reserve_memory(memory), encodes, metrics.stage('convert', from_format, to_format):
+        return run_cpu(func, tasks)
+
+@contextmanager
+def _busy_worker():
+    global _busy
+    with _busy_lock:
+        _busy += 1
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.inc('formatfusion_worker_busy_seconds_total', time.perf_counter() - started)
+        with _busy_lock:
+            _busy -= 1
+
+@metrics.gauge('formatfusion_workers', 'Conversion worker threads, by state')
+def _worker_gauge():
+    with _busy_lock:
+        busy = _busy
+    return [({'state': 'busy'}, busy), ({'state': 'idle'}, len(_workers) - busy)]
+
+@metrics.gauge('formatfusion_queue_depth', 'Conversion jobs waiting or running')
+def _queue_gauge():
+    return [({'status': status}, count) for status, count in queue_depth().items()]
+
+@metrics.gauge('formatfusion_memory_reserved_bytes', 'Estimated memory held by running conversions')
+def _memory_gauge():
+    with _memory_free:
+        return [({}, _memory_used)]
+
+def _worker_loop(handler, lane=None, batch_handler=None, batchable=None):
+    _lane.name = lane
+    while True:
+        _wakeup.clear()
+        try:
+            claimed = claim_job(lane, batchable if batch_handler else None)
+        except sqlite3.OperationalError as e:
+            log.warning('Job claim failed', extra={'error': str(e), 'lane': lane})
+            claimed = []
+        if not claimed:
+            _wakeup.wait(POLL_INTERVAL)
+            continue
+        file_ids = [file_id for _, file_id in claimed]
+        try:
+            with _busy_worker():
+                if len(claimed) > 1:
+                    batch_handler(file_ids)
+                else:
+                    handler(file_ids[0])
+            for job_id, _ in claimed:
+                finish_job(job_id, 'done')
+        except Exception as e:
+            log.exception('Job crashed', extra={'job_ids': [job_id for job_id, _ in claimed], 'file_ids': file_ids})
+            for job_id, _ in claimed:
+                finish_job(job_id, 'failed', str(e))
+
+def start_workers(handler, count=None, estimate=None, batch_handler=None, batchable=None):
+    # `estimate(file_id)`, when given, refines queued jobs' costs in a thread
+    # of its own (see refine_estimates). With `batch_handler(file_ids)` and
+    # `batchable(from_format, to_format)`, small jobs for a batchable pair are
+    # claimed and handled several at a time (see claim_job).
+    if _workers:
+        return
+    recover_jobs()
+    if estimate:
+        thread = threading.Thread(target=_refine_loop, args=(estimate,), name='job-estimator')
+        thread.daemon = True
+        thread.start()
+    lanes = [None] * (count or WORKER_COUNT) + ['fast'] * FAST_LANE_WORKERS
+    for i, lane in enumerate(lanes):
+        name = f'convert-worker-{i}' if lane is None else f'convert-{lane}-worker-{i}'
+        thread = threading.Thread(target=_worker_loop, args=(handler, lane, batch_handler, batchable), name=name)
+        thread.daemon = True
+        thread.start()
+        _workers.append(thread)
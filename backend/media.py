@@ -0,0 +1,243 @@
+import os
+import json
+import time
+import signal
+import metrics
+import threading
+import subprocess
+from collections import deque
+from contextlib import contextmanager
+
+# Managed ffmpeg processes. Encodes share a fixed core budget: at most
+# MAX_ENCODES run at once, each told to use its share of the cores, so
+# concurrent jobs never oversubscribe the machine.
+CORE_BUDGET = int(os.environ.get('FFMPEG_CORES', os.cpu_count() or 1))
+MAX_ENCODES = int(os.environ.get('FFMPEG_MAX_ENCODES', max(1, CORE_BUDGET // 2)))
+THREADS_PER_ENCODE = max(1, CORE_BUDGET // MAX_ENCODES)
+# Encodes for fast-lane jobs (see jobs.FAST_LANE_SECONDS) have slots of their
+# own on top of MAX_ENCODES, so long transcodes holding every slot never hold
+# up a short one
+FAST_LANE_ENCODES = int(os.environ.get('FFMPEG_FAST_LANE_ENCODES', '1'))
+TIMEOUT = int(os.environ.get('FFMPEG_TIMEOUT', 2 * 3600))  # wall clock, seconds
+OUTPUT_TAIL_LINES = 40  # kept for error messages; the rest is discarded
+PROBE_TIMEOUT = 30
+
+# Codecs each target container can carry as-is; '*' takes anything. Streams
+# already in one of these are copied instead of re-encoded.
+CONTAINER_CODECS = {
+    'MP4': {'video': {'h264', 'hevc', 'mpeg4', 'av1', 'vp9'},
+            'audio': {'aac', 'mp3', 'ac3', 'eac3', 'alac', 'opus', 'flac'}},
+    'MOV': {'video': {'h264', 'hevc', 'mpeg4', 'prores', 'mjpeg'},
+            'audio': {'aac', 'mp3', 'ac3', 'alac', 'pcm_s16le', 'pcm_s24le'}},
+    'MKV': {'video': '*', 'audio': '*'},
+    'AVI': {'video': {'mpeg4', 'msmpeg4v3', 'mjpeg', 'h264'}, 'audio': {'mp3', 'ac3', 'pcm_s16le'}},
+    'FLV': {'video': {'h264', 'flv1'}, 'audio': {'aac', 'mp3'}},
+    'WMV': {'video': {'wmv1', 'wmv2', 'wmv3', 'vc1'}, 'audio': {'wmav1', 'wmav2'}},
+    'MP3': {'audio': {'mp3'}},
+    'AAC': {'audio': {'aac'}},
+    'FLAC': {'audio': {'flac'}},
+    'OGG': {'audio': {'vorbis', 'opus', 'flac'}},
+    'WAV': {'audio': {'pcm_s16le', 'pcm_s24le', 'pcm_s32le', 'pcm_f32le', 'pcm_u8'}},
+}
+CODEC_FLAGS = {'video': '-c:v', 'audio': '-c:a'}
+
+_slots = threading.BoundedSemaphore(MAX_ENCODES)
+_fast_slots = threading.BoundedSemaphore(FAST_LANE_ENCODES)
+_lane = threading.local()
+_lock = threading.Lock()
+_running = {}  # output path -> ManagedProcess, from the moment it queues for a slot
+_converting = set()  # output paths of conversions between begin() and cancelled()
+_cancel_requests = set()  # output paths whose conversion should stop
+
+class Cancelled(Exception):
+    pass
+
+class TimedOut(Exception):
+    pass
+
+class ManagedProcess:
+    def __init__(self, command):
+        self.command = command
+        self.process = None
+        self.stopped = None  # 'cancelled' or 'timeout' once killed
+        self.output = deque(maxlen=OUTPUT_TAIL_LINES)
+
+    def start(self, output_path):
+        with _lock:
+            if output_path in _cancel_requests:
+                self.stopped = 'cancelled'
+            if self.stopped:
+                return False
+            # A session of its own, so a kill reaches anything ffmpeg spawned
+            self.process = subprocess.Popen(self.command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                            text=True, errors='replace', start_new_session=True)
+        metrics.inc('formatfusion_subprocesses_started_total', labels={'tool': self.command[0]})
+        return True
+
+    def kill(self, reason):
+        with _lock:
+            if self.stopped:
+                return
+            self.stopped = reason
+            process = self.process
+        if process and process.poll() is None:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+    def tail(self):
+        return '\n'.join(self.output)
+
+def _parse_timestamp(value):
+    # HH:MM:SS.ss as printed by ffmpeg, None for N/A
+    try:
+        hours, minutes, seconds = value.strip().split(':')
+        return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+    except ValueError:
+        return None
+
+@contextmanager
+def fast_lane():
+    # Encodes started by this thread inside the block take a fast-lane slot
+    _lane.fast = True
+    try:
+        yield
+    finally:
+        _lane.fast = False
+
+def begin(output_path):
+    # A conversion writing output_path has started; cancel() only takes
+    # requests for those, so none outlives the conversion it was meant for
+    with _lock:
+        _converting.add(output_path)
+
+def cancel(output_path):
+    # Asks the conversion writing output_path to stop. A running encode is
+    # killed and one still waiting for a slot never starts; other converters
+    # cannot be interrupted, so the caller checks cancelled() once they return.
+    with _lock:
+        if output_path not in _converting:
+            return
+        _cancel_requests.add(output_path)
+        managed = _running.get(output_path)
+    if managed:
+        managed.kill('cancelled')
+
+def cancelled(output_path):
+    # True if cancel() was called for output_path; clears the request and
+    # ends the conversion begun with begin()
+    with _lock:
+        _converting.discard(output_path)
+        if output_path in _cancel_requests:
+            _cancel_requests.discard(output_path)
+            return True
+        return False
+
+def probe(input_path):
+    # [(codec_type, codec_name)] for every stream, or None when ffprobe is
+    # missing or cannot read the file
+    command = ['ffprobe', '-v', 'error', '-show_entries', 'stream=codec_type,codec_name', '-of', 'json', input_path]
+    try:
+        with metrics.stage('probe'):
+            metrics.inc('formatfusion_subprocesses_started_total', labels={'tool': 'ffprobe'})
+            result = subprocess.run(command, capture_output=True, text=True, errors='replace',
+                                    timeout=PROBE_TIMEOUT, check=True)
+        streams = json.loads(result.stdout).get('streams', [])
+    except (subprocess.SubprocessError, FileNotFoundError, ValueError):
+        return None
+    return [(stream.get('codec_type'), stream.get('codec_name')) for stream in streams]
+
+def duration(input_path):
+    # Length in seconds from the container header, or None
+    command = ['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'json', input_path]
+    try:
+        with metrics.stage('probe'):
+            metrics.inc('formatfusion_subprocesses_started_total', labels={'tool': 'ffprobe'})
+            result = subprocess.run(command, capture_output=True, text=True, errors='replace',
+                                    timeout=PROBE_TIMEOUT, check=True)
+        return float(json.loads(result.stdout)['format']['duration'])
+    except (subprocess.SubprocessError, FileNotFoundError, ValueError, KeyError, TypeError):
+        return None
+
+def stream_args(input_path, to_format, encode_args):
+    # ffmpeg arguments that copy every stream type the target container can
+    # carry and re-encode only the rest with encode_args[type]. None when
+    # nothing can be copied, i.e. a plain transcode.
+    streams = probe(input_path)
+    containers = CONTAINER_CODECS.get(to_format)
+    if not streams or not containers:
+        return None
+    args = []
+    copied = False
+    for kind, codecs in containers.items():
+        present = {codec for codec_type, codec in streams if codec_type == kind}
+        if present and (codecs == '*' or present <= codecs):
+            args += [CODEC_FLAGS[kind], 'copy']
+            copied = True
+        else:
+            args += encode_args.get(kind, [])
+    return args if copied else None
+
+def run_ffmpeg(input_path, output_path, args, progress=None, timeout=TIMEOUT):
+    # -progress writes key=value lines as encoding advances; with stderr merged
+    # in, the "Duration:" header arrives on the same pipe so one reader sees both
+    command = ['ffmpeg', '-nostdin', '-nostats', '-progress', 'pipe:1', '-i', input_path,
+               '-threads', str(THREADS_PER_ENCODE)] + args + ['-y', output_path]
+    managed = ManagedProcess(command)
+    with _lock:
+        _running[output_path] = managed
+    try:
+        waiting = time.perf_counter()
+        with _fast_slots if getattr(_lane, 'fast', False) else _slots:
+            metrics.observe_stage('encode_wait', time.perf_counter() - waiting)
+            if not managed.start(output_path):
+                raise Cancelled('Conversion cancelled')
+            encoding = time.perf_counter()
+            watchdog = threading.Timer(timeout, managed.kill, args=('timeout',))
+            watchdog.daemon = True
+            watchdog.start()
+            try:
+                _read_progress(managed, progress)
+                returncode = managed.process.wait()
+            finally:
+                watchdog.cancel()
+                metrics.observe_stage('encode', time.perf_counter() - encoding)
+        if managed.stopped == 'cancelled':
+            raise Cancelled('Conversion cancelled')
+        if managed.stopped == 'timeout':
+            raise TimedOut(f'ffmpeg did not finish within {timeout} seconds')
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, command, output=managed.tail())
+    except Exception:
+        # Never leave a partial output behind
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        raise
+    finally:
+        with _lock:
+            if _running.get(output_path) is managed:
+                del _running[output_path]
+
+def _read_progress(managed, progress):
+    duration = None
+    with managed.process.stdout as stdout:
+        for line in stdout:
+            line = line.strip()
+            if '=' in line and ' ' not in line:
+                # -progress output
+                if line.startswith('out_time=') and duration and progress:
+                    position = _parse_timestamp(line[len('out_time='):])
+                    if position is not None:
+                        progress(position / duration)
+                continue
+            managed.output.append(line)
+            if duration is None and line.startswith('Duration:'):
+                duration = _parse_timestamp(line.split(',')[0][len('Duration:'):])
+
+@metrics.gauge('formatfusion_ffmpeg_processes', 'ffmpeg encodes running, or waiting for a core budget slot')
+def _process_gauge():
+    with _lock:
+        running = sum(1 for managed in _running.values() if managed.process and managed.process.poll() is None)
+        total = len(_running)
+    return [({'state': 'running'}, running), ({'state': 'waiting'}, total - running)]
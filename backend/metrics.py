@@ -0,0 +1,138 @@
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+# In-process metrics, rendered in the Prometheus text format by /api/metrics.
+# Pool processes send their observations to the server process (see
+# jobs._forward), so every number here covers the whole server.
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900)
+
+HELP = {
+    'formatfusion_stage_seconds': ('histogram', 'Time spent in each stage of a conversion, by format pair'),
+    'formatfusion_sqlite_lock_wait_seconds': ('histogram', 'Time the first write of a transaction waited for the SQLite write lock'),
+    'formatfusion_worker_busy_seconds_total': ('counter', 'Seconds job workers spent running conversions'),
+    'formatfusion_subprocesses_started_total': ('counter', 'External tools started, by tool'),
+}
+
+_lock = threading.Lock()
+_histograms = {}  # (name, labels) -> [count per bucket..., +Inf count, sum]
+_counters = {}  # (name, labels) -> value
+_gauges = []  # (name, callback returning [(labels, value)]) read at scrape time
+_context = threading.local()
+_worker_queue = None
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+def observe(name, value, labels=None):
+    labels = labels or {}
+    if _worker_queue is not None:
+        _worker_queue.put(('metric', 'observe', name, value, labels))
+        return
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [0] * (len(BUCKETS) + 2)
+        histogram[bisect.bisect_left(BUCKETS, value)] += 1
+        histogram[-1] += value
+
+def inc(name, amount=1, labels=None):
+    labels = labels or {}
+    if _worker_queue is not None:
+        _worker_queue.put(('metric', 'inc', name, amount, labels))
+        return
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+def replay(kind, name, value, labels):
+    # An observation forwarded from a pool process
+    (observe if kind == 'observe' else inc)(name, value, labels)
+
+def gauge(name, help_text):
+    # Registers a callback returning [(labels, value)] for a gauge
+    def decorator(func):
+        HELP[name] = ('gauge', help_text)
+        _gauges.append((name, func))
+        return func
+    return decorator
+
+def init_worker(worker_queue):
+    global _worker_queue
+    _worker_queue = worker_queue
+
+# STAGES
+# Conversion stages are labelled with the format pair being converted, which
+# pair() sets for the current thread while a converter runs
+@contextmanager
+def pair(from_format, to_format):
+    previous = getattr(_context, 'pair', None)
+    _context.pair = f'{from_format}->{to_format}'
+    try:
+        yield
+    finally:
+        _context.pair = previous
+
+def observe_stage(stage, seconds, from_format=None, to_format=None):
+    if from_format or to_format:
+        label = f'{from_format}->{to_format}'
+    else:
+        label = getattr(_context, 'pair', None) or 'unknown'
+    observe('formatfusion_stage_seconds', seconds, {'stage': stage, 'pair': label})
+
+@contextmanager
+def stage(name, from_format=None, to_format=None):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(name, time.perf_counter() - started, from_format, to_format)
+
+# EXPOSITION
+def _labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    text = ','.join(f'{name}="{_escape(value)}"' for name, value in pairs)
+    return '{' + text + '}'
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def render():
+    lines = []
+    seen = set()
+
+    def header(name):
+        if name not in seen:
+            seen.add(name)
+            kind, help_text = HELP.get(name, ('untyped', name))
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+
+    with _lock:
+        histograms = sorted((key, list(value)) for key, value in _histograms.items())
+        counters = sorted(_counters.items())
+    for (name, labels), histogram in histograms:
+        header(name)
+        cumulative = 0
+        for bound, count in zip(BUCKETS + (float('inf'),), histogram):
+            cumulative += count
+            lines.append(f'{name}_bucket{_labels(labels, [("le", _number(bound))])} {cumulative}')
+        lines.append(f'{name}_sum{_labels(labels)} {_number(histogram[-1])}')
+        lines.append(f'{name}_count{_labels(labels)} {cumulative}')
+    for (name, labels), value in counters:
+        header(name)
+        lines.append(f'{name}{_labels(labels)} {_number(value)}')
+    for name, func in _gauges:
+        header(name)
+        for labels, value in func():
+            lines.append(f'{name}{_labels(sorted(labels.items()))} {_number(value)}')
+    return '\n'.join(lines) + '\n'
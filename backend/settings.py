@@ -0,0 +1,107 @@
+import time
+import logging
+import sqlite3
+import threading
+from contextlib import contextmanager
+import db
+
+# Admin-editable settings, cached in every process. update() bumps the
+# version in settings_version in the same transaction as the new values;
+# other server processes see the change on their next version check, at most
+# CHECK_INTERVAL seconds later. Reads in between never touch the database.
+DEFAULTS = {
+    'max_file_size': '100',
+    'allowed_file_types': 'PDF,DOCX,JPG,PNG,MP4,MP3,WAV,FLAC',
+    'image_quality': '95',
+    'image_max_dimension': '0',  # longest side of image outputs in pixels; 0 keeps the size
+    'audio_bitrate': '192',
+}
+# Settings that can change converter output; a conversion's cache key holds
+# those its converter reads (converters.encoder_settings)
+ENCODER_SETTINGS = ['image_quality', 'image_max_dimension', 'audio_bitrate']
+CHECK_INTERVAL = 1.0
+
+_lock = threading.Lock()
+_values = None
+_version = None
+_checked = 0
+_context = threading.local()
+
+log = logging.getLogger(__name__)
+
+def _refresh():
+    # Caller holds _lock. The version is read before the values, so values
+    # written after it was read only cause one extra reload.
+    global _values, _version, _checked
+    conn = db.connect()
+    c = conn.cursor()
+    try:
+        c.execute('SELECT version FROM settings_version')
+        version = c.fetchone()[0]
+        if version != _version or _values is None:
+            c.execute('SELECT key, value FROM settings')
+            _values = dict(DEFAULTS, **dict(c.fetchall()))
+            _version = version
+    except sqlite3.OperationalError as e:
+        # No database here (e.g. a tool run outside the server)
+        log.debug('Using default settings', extra={'error': str(e)})
+        _values = _values or dict(DEFAULTS)
+    finally:
+        conn.close()
+    _checked = time.monotonic()
+
+def current():
+    # All settings as a dict of strings. Treat it as read-only: it is shared.
+    pinned = getattr(_context, 'values', None)
+    if pinned is not None:
+        return pinned
+    if _values is None or time.monotonic() - _checked >= CHECK_INTERVAL:
+        with _lock:
+            if _values is None or time.monotonic() - _checked >= CHECK_INTERVAL:
+                _refresh()
+    return _values
+
+def get(key):
+    return current().get(key, DEFAULTS.get(key))
+
+def number(key, minimum=None, maximum=None):
+    # A numeric setting, falling back to the default when it does not parse
+    try:
+        value = int(float(get(key)))
+    except (TypeError, ValueError):
+        value = int(DEFAULTS[key])
+    if minimum is not None:
+        value = max(value, minimum)
+    if maximum is not None:
+        value = min(value, maximum)
+    return value
+
+def encoder_options(keys, values=None):
+    values = values if values is not None else current()
+    return {key: values.get(key, DEFAULTS[key]) for key in keys if key in ENCODER_SETTINGS}
+
+@contextmanager
+def pinned(values):
+    # Makes this thread see `values` (a snapshot from current()) for the
+    # duration, so one job converts with the settings its cache key was
+    # computed from, even in a pool process
+    previous = getattr(_context, 'values', None)
+    _context.values = values
+    try:
+        yield
+    finally:
+        _context.values = previous
+
+def update(values):
+    global _checked
+    conn = db.connect()
+    c = conn.cursor()
+    for key, value in values.items():
+        c.execute('INSERT OR REPLACE INTO settings (key, value, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP)',
+                  (key, str(value)))
+    c.execute('UPDATE settings_version SET version = version + 1')
+    conn.commit()
+    conn.close()
+    # This process picks the change up on its next read
+    with _lock:
+        _checked = 0
@@ -0,0 +1,70 @@
+import time
+import db
+
+# Counters are kept per format pair at three granularities. Buckets are UTC,
+# matching SQLite's CURRENT_TIMESTAMP. They describe the files that exist, as
+# counting the files table would: deleting a file takes its counts back out
+# (forget), and a file counts as completed or failed once, by its latest
+# conversion (convert_file retracts the previous outcome). bytes_out alone
+# stays a running total of output written.
+PERIODS = {
+    'hour': '%Y-%m-%d %H:00',
+    'day': '%Y-%m-%d',
+    'total': 'all',
+}
+METRICS = ['uploads', 'completions', 'failures', 'downloads', 'bytes_in', 'bytes_out']
+
+def record(c, from_format, to_format, at=None, **counts):
+    # Call with the cursor of the write that caused the event so the rollup
+    # commits (or rolls back) together with it. `at` (a CURRENT_TIMESTAMP
+    # string) files the counts under an earlier time than now.
+    now = time.strptime(at, '%Y-%m-%d %H:%M:%S') if at else time.gmtime()
+    columns = [m for m in METRICS if counts.get(m)]
+    if not columns:
+        return
+    values = [counts[m] for m in columns]
+    updates = ', '.join(f'{m} = {m} + excluded.{m}' for m in columns)
+    for period, fmt in PERIODS.items():
+        c.execute(f'''INSERT INTO stats_rollup (period, bucket, from_format, to_format, {', '.join(columns)})
+                      VALUES (?, ?, ?, ?, {', '.join('?' * len(columns))})
+                      ON CONFLICT (period, bucket, from_format, to_format) DO UPDATE SET {updates}''',
+                  [period, time.strftime(fmt, now), from_format or '', to_format or ''] + values)
+
+def retract(c, from_format, to_format, status, completion_date):
+    # Takes a file's latest outcome back out before it is converted again.
+    # Failures carry no time of their own and only their total is read, so
+    # they come out of the current buckets.
+    if status == 'completed':
+        record(c, from_format, to_format, at=completion_date, completions=-1)
+    elif status == 'failed':
+        record(c, from_format, to_format, failures=-1)
+
+def forget(c, from_format, to_format, status, upload_date, completion_date, file_size, download_count):
+    # Undoes what a file being deleted added, in the buckets it was added
+    # to; downloads have no time of their own and come out of the upload's
+    retract(c, from_format, to_format, status, completion_date)
+    record(c, from_format, to_format, at=upload_date, uploads=-1, bytes_in=-(file_size or 0),
+           downloads=-(download_count or 0))
+
+def totals():
+    conn = db.connect()
+    c = conn.cursor()
+    c.execute(f'''SELECT {', '.join(f'COALESCE(SUM({m}), 0)' for m in METRICS)}
+                  FROM stats_rollup WHERE period = 'total' ''')
+    row = c.fetchone()
+    conn.close()
+    return dict(zip(METRICS, row))
+
+def daily(days):
+    # One row per day for the last `days` days (oldest first), zero-filled
+    today = time.time()
+    buckets = [time.strftime('%Y-%m-%d', time.gmtime(today - i * 86400)) for i in range(days - 1, -1, -1)]
+    conn = db.connect()
+    c = conn.cursor()
+    c.execute(f'''SELECT bucket, {', '.join(f'SUM({m})' for m in METRICS)}
+                  FROM stats_rollup WHERE period = 'day' AND bucket >= ?
+                  GROUP BY bucket''', (buckets[0],))
+    rows = {row[0]: dict(zip(METRICS, row[1:])) for row in c.fetchall()}
+    conn.close()
+    empty = dict.fromkeys(METRICS, 0)
+    return [dict(rows.get(bucket, empty), day=bucket) for bucket in buckets]
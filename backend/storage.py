@@ -0,0 +1,361 @@
+import os
+import glob
+import time
+import uuid
+import db
+import events
+import hashlib
+import logging
+import threading
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.sansio.multipart import MultipartDecoder, Field, File, Data, Epilogue, NeedData
+from werkzeug.utils import secure_filename
+
+UPLOAD_DIR = 'uploads'
+CHUNK_SIZE = 64 * 1024
+MAX_FIELD_BYTES = 1024 * 1024
+SNIFF_BYTES = 262  # the TAR "ustar" marker sits at offset 257
+
+log = logging.getLogger(__name__)
+
+# (offset, signature, format) checked against the first bytes of an upload
+MAGIC_NUMBERS = [
+    (0, b'\x89PNG\r\n\x1a\n', 'PNG'),
+    (0, b'\xff\xd8\xff', 'JPG'),
+    (0, b'GIF87a', 'GIF'),
+    (0, b'GIF89a', 'GIF'),
+    (0, b'II*\x00', 'TIFF'),
+    (0, b'MM\x00*', 'TIFF'),
+    (0, b'II+\x00', 'TIFF'),
+    (0, b'MM\x00+', 'TIFF'),
+    (0, b'%PDF', 'PDF'),
+    (0, b'{\\rtf', 'RTF'),
+    (0, b'PK\x03\x04', 'ZIP'),
+    (0, b'PK\x05\x06', 'ZIP'),
+    (0, b'Rar!\x1a\x07', 'RAR'),
+    (0, b'7z\xbc\xaf\x27\x1c', '7Z'),
+    (0, b'\x1f\x8b', 'GZ'),
+    (257, b'ustar', 'TAR'),
+    (0, b'fLaC', 'FLAC'),
+    (0, b'OggS', 'OGG'),
+    (0, b'ID3', 'MP3'),
+    (0, b'\xff\xf1', 'AAC'),  # ADTS, MPEG-4 and MPEG-2, without and with CRC
+    (0, b'\xff\xf9', 'AAC'),
+    (0, b'\xff\xf0', 'AAC'),
+    (0, b'\xff\xf8', 'AAC'),
+    (4, b'ftyp', 'MP4'),
+    # QuickTime files from older tools start straight with another atom
+    (4, b'moov', 'MOV'),
+    (4, b'mdat', 'MOV'),
+    (4, b'wide', 'MOV'),
+    (4, b'free', 'MOV'),
+    (0, b'\x1a\x45\xdf\xa3', 'MKV'),
+    (0, b'FLV', 'FLV'),
+    (0, b'\x30\x26\xb2\x75\x8e\x66\xcf\x11', 'WMV'),
+    (0, b'BM', 'BMP'),
+]
+RIFF_FORMATS = {b'WEBP': 'WEBP', b'WAVE': 'WAV', b'AVI ': 'AVI'}
+
+# Declared formats whose files legitimately carry another format's signature
+COMPATIBLE_FORMATS = {
+    'JPEG': ['JPG'],
+    'DOCX': ['ZIP'],
+    'XLSX': ['ZIP'],
+    'PPTX': ['ZIP'],
+    'ODT': ['ZIP'],
+    'PAGES': ['ZIP'],
+    'EPUB': ['ZIP'],
+    'MOV': ['MP4'],
+    'MP4': ['MOV'],
+    'M4A': ['MP4'],
+    'AAC': ['MP4'],
+    'WEBM': ['MKV'],
+    'TAR': ['GZ'],
+}
+SIGNED_FORMATS = {fmt for _, _, fmt in MAGIC_NUMBERS} | set(RIFF_FORMATS.values()) | set(COMPATIBLE_FORMATS)
+
+class UploadError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+class UploadedFile:
+    def __init__(self, filename, declared_format):
+        self.file_id = str(uuid.uuid4())
+        self.filename = secure_filename(filename)
+        self.path = f'{UPLOAD_DIR}/{self.file_id}_{self.filename}'
+        self.declared_format = declared_format
+        self.detected_format = None
+        self.size = 0
+        self.head = b''
+        self._hash = hashlib.sha256()
+        self._file = open(self.path, 'wb')
+
+    @property
+    def content_hash(self):
+        return self._hash.hexdigest()
+
+    def write(self, data, max_size):
+        self.size += len(data)
+        if max_size and self.size > max_size:
+            raise UploadError(f'{self.filename} exceeds the {max_size // (1024 * 1024)} MB upload limit', 413)
+        if len(self.head) < SNIFF_BYTES:
+            self.head += data[:SNIFF_BYTES - len(self.head)]
+            if len(self.head) == SNIFF_BYTES:
+                self.check_format()
+        self._hash.update(data)
+        self._file.write(data)
+
+    def check_format(self):
+        if self.detected_format is None:
+            self.detected_format = sniff_format(self.head)
+        if self.declared_format and not format_matches(self.declared_format, self.detected_format):
+            raise UploadError(f'{self.filename} is not a valid {self.declared_format} file', 415)
+
+    def close(self):
+        self._file.close()
+
+    def discard(self):
+        self._file.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+def sniff_format(head):
+    if head[:4] == b'RIFF' and head[8:12] in RIFF_FORMATS:
+        return RIFF_FORMATS[head[8:12]]
+    for offset, signature, fmt in MAGIC_NUMBERS:
+        if head[offset:offset + len(signature)] == signature:
+            return fmt
+    if len(head) > 1 and head[0] == 0xff and head[1] & 0xe0 == 0xe0:
+        # Bare MPEG audio frame sync without an ID3 tag
+        return 'MP3'
+    return None
+
+def format_matches(declared, detected):
+    if declared not in SIGNED_FORMATS:
+        # Text formats (CSV, JSON, SVG, HTML, ...) have no signature to verify
+        return True
+    return detected == declared or detected in COMPATIBLE_FORMATS.get(declared, [])
+
+def stream_upload(stream, boundary, max_file_size, file_field='files'):
+    # Parse multipart/form-data straight off the request stream so each file
+    # part is hashed, sniffed and written to disk chunk by chunk; nothing is
+    # spooled by Werkzeug and a violation stops reading the body right away.
+    # The decoder holds back file data up to the next line break, so its
+    # buffer is only capped at what one part may legitimately hold; form
+    # fields get their own, smaller cap below.
+    decoder = MultipartDecoder(boundary)
+    max_buffer = max_file_size + MAX_FIELD_BYTES if max_file_size else None
+    fields = {}
+    uploads = []
+    part = None
+    field_data = []
+    field_size = 0
+    try:
+        while True:
+            event = decoder.next_event()
+            if isinstance(event, NeedData):
+                if max_buffer and len(decoder.buffer) > max_buffer:
+                    raise UploadError(f'Upload exceeds the {max_file_size // (1024 * 1024)} MB upload limit', 413)
+                decoder.receive_data(stream.read(CHUNK_SIZE) or None)
+            elif isinstance(event, Epilogue):
+                break
+            elif isinstance(event, File):
+                if event.name == file_field and event.filename:
+                    os.makedirs(UPLOAD_DIR, exist_ok=True)
+                    # Fields sent ahead of the files let us reject a mismatch early
+                    part = UploadedFile(event.filename, fields.get('fromFormat', '').upper())
+                    uploads.append(part)
+                else:
+                    part = None
+            elif isinstance(event, Field):
+                part = event
+                field_data = []
+                field_size = 0
+            elif isinstance(event, Data):
+                if isinstance(part, UploadedFile):
+                    part.write(event.data, max_file_size)
+                    if not event.more_data:
+                        part.close()
+                elif isinstance(part, Field):
+                    field_size += len(event.data)
+                    if field_size > MAX_FIELD_BYTES:
+                        raise UploadError(f'Form field {part.name} is too large', 413)
+                    field_data.append(event.data)
+                    if not event.more_data:
+                        fields[part.name] = b''.join(field_data).decode('utf-8', 'replace')
+
+        # Files that arrived before the fromFormat field are checked now
+        declared_format = fields.get('fromFormat', '').upper()
+        for upload in uploads:
+            upload.declared_format = upload.declared_format or declared_format
+            upload.check_format()
+    except UploadError:
+        for upload in uploads:
+            upload.discard()
+        raise
+    except RequestEntityTooLarge:
+        # Too many parts
+        for upload in uploads:
+            upload.discard()
+        raise UploadError('Upload request too large', 413)
+    except ValueError:
+        for upload in uploads:
+            upload.discard()
+        raise UploadError('Malformed upload request')
+    except Exception:
+        # Client disconnects and disk errors must not leave partial files behind
+        for upload in uploads:
+            upload.discard()
+        raise
+    return fields, uploads
+
+# Bytes stored under uploads/, kept up to date as files come and go so the
+# stats endpoints never have to walk the directory
+RECONCILE_INTERVAL = 3600
+
+def add_usage(delta, c=None):
+    # Pass the caller's cursor to fold the update into its transaction
+    if not delta:
+        return
+    if c is not None:
+        c.execute('UPDATE storage_usage SET bytes = MAX(bytes + ?, 0) WHERE name = ?', (delta, UPLOAD_DIR))
+        return
+    conn = db.connect()
+    conn.execute('UPDATE storage_usage SET bytes = MAX(bytes + ?, 0) WHERE name = ?', (delta, UPLOAD_DIR))
+    conn.commit()
+    conn.close()
+
+def remove_file(path, c=None):
+    try:
+        size = os.path.getsize(path)
+        os.remove(path)
+    except FileNotFoundError:
+        return 0
+    add_usage(-size, c)
+    return size
+
+def get_usage():
+    conn = db.connect()
+    c = conn.cursor()
+    c.execute('SELECT bytes FROM storage_usage WHERE name = ?', (UPLOAD_DIR,))
+    row = c.fetchone()
+    conn.close()
+    return row[0] if row else 0
+
+def reconcile():
+    # Correct any drift (crashes, files removed by hand) with one full scan
+    total = 0
+    if os.path.exists(UPLOAD_DIR):
+        for dirpath, dirnames, filenames in os.walk(UPLOAD_DIR):
+            for filename in filenames:
+                try:
+                    total += os.path.getsize(os.path.join(dirpath, filename))
+                except FileNotFoundError:
+                    pass
+    conn = db.connect()
+    conn.execute('''INSERT OR REPLACE INTO storage_usage (name, bytes, reconciled_at)
+                    VALUES (?, ?, CURRENT_TIMESTAMP)''', (UPLOAD_DIR, total))
+    conn.commit()
+    conn.close()
+    return total
+
+def start_reconciler(interval=RECONCILE_INTERVAL):
+    def loop():
+        while True:
+            try:
+                reconcile()
+            except Exception:
+                log.exception('Storage reconciliation failed')
+            time.sleep(interval)
+    thread = threading.Thread(target=loop, name='storage-reconciler')
+    thread.daemon = True
+    thread.start()
+
+# Retention. Every file record carries expires_at (epoch seconds), pushed out
+# on upload and completion and pulled in after a download. A single sweeper
+# thread sleeps until the earliest one and then deletes that record's files.
+DOWNLOADED_RETENTION = int(os.environ.get('DOWNLOADED_RETENTION_SECONDS', 20))
+ABANDONED_RETENTION = int(os.environ.get('ABANDONED_RETENTION_SECONDS', 24 * 3600))
+SWEEP_INTERVAL = 300  # longest the sweeper sleeps without looking
+SWEEP_BATCH = 100
+
+_sweep_due = threading.Condition()
+_next_sweep = 0
+
+def expire(c, file_id, seconds, sooner_only=False):
+    # Runs in the caller's transaction; the sweeper is woken for the new time
+    global _next_sweep
+    expires_at = time.time() + seconds
+    if sooner_only:
+        c.execute('''UPDATE files SET expires_at = MIN(COALESCE(expires_at, ?), ?)
+                     WHERE id = ? AND deleted_at IS NULL''', (expires_at, expires_at, file_id))
+    else:
+        c.execute('UPDATE files SET expires_at = ? WHERE id = ? AND deleted_at IS NULL', (expires_at, file_id))
+    with _sweep_due:
+        if expires_at < _next_sweep:
+            _next_sweep = expires_at
+            _sweep_due.notify()
+
+def output_filename_for(file_id, filename, to_format):
+    base_name = os.path.splitext(filename)[0]
+    return f'{file_id}_{base_name}_converted.{to_format.lower()}'
+
+def file_paths(file_id, original_filename, to_format):
+    # The upload and the output, whatever the status: a failed or interrupted
+    # conversion can leave a partial output behind
+    if original_filename is None:
+        # Records from before original_filename was kept
+        return glob.glob(os.path.join(UPLOAD_DIR, glob.escape(f'{file_id}_') + '*'))
+    return [os.path.join(UPLOAD_DIR, f'{file_id}_{original_filename}'),
+            os.path.join(UPLOAD_DIR, output_filename_for(file_id, original_filename, to_format))]
+
+def sweep(batch=SWEEP_BATCH):
+    # Deletes the files of every expired record and returns when the next
+    # one expires. Records with a conversion queued or running wait.
+    now = time.time()
+    conn = db.connect()
+    c = conn.cursor()
+    deleted = []
+    while True:
+        c.execute('''SELECT id, original_filename, to_format FROM files
+                     WHERE expires_at <= ? AND status != 'processing'
+                     AND id NOT IN (SELECT file_id FROM jobs WHERE status IN ('queued', 'processing'))
+                     ORDER BY expires_at LIMIT ?''', (now, batch))
+        rows = c.fetchall()
+        for file_id, original_filename, to_format in rows:
+            for path in file_paths(file_id, original_filename, to_format):
+                remove_file(path, c)
+            # The record stays for history
+            c.execute('UPDATE files SET expires_at = NULL, deleted_at = CURRENT_TIMESTAMP WHERE id = ?', (file_id,))
+        conn.commit()
+        deleted += [row[0] for row in rows]
+        if len(rows) < batch:
+            break
+    c.execute('SELECT MIN(expires_at) FROM files WHERE expires_at > ?', (now,))
+    next_expiry = c.fetchone()[0]
+    conn.close()
+    for file_id in deleted:
+        events.forget(file_id)
+    if deleted:
+        log.info('Deleted the files of expired records', extra={'count': len(deleted)})
+    return next_expiry
+
+def start_sweeper():
+    def loop():
+        global _next_sweep
+        while True:
+            try:
+                next_expiry = sweep()
+            except Exception:
+                log.exception('File sweep failed')
+                next_expiry = None
+            with _sweep_due:
+                _next_sweep = min(next_expiry or float('inf'), time.time() + SWEEP_INTERVAL)
+                while time.time() < _next_sweep:
+                    _sweep_due.wait(_next_sweep - time.time())
+    thread = threading.Thread(target=loop, name='file-sweeper')
+    thread.daemon = True
+    thread.start()
@@ -0,0 +1,222 @@
+import io
+import os
+import re
+import zlib
+import random
+import struct
+import tempfile
+import unittest
+from unittest import mock
+from PIL import Image, TiffImagePlugin
+import images
+
+WIDTH, HEIGHT = 50, 75  # partial last strip and tile on both axes; banded even in L
+BUDGET = WIDTH * 4 * 4 * 8  # band_rows() gives 8 rows per band
+
+
+def pattern(mode, size=(WIDTH, HEIGHT)):
+    bands = len(Image.new(mode, (1, 1)).getbands())
+    data = random.Random(f'{mode}{size}').randbytes(size[0] * size[1] * bands)
+    return Image.frombytes(mode, size, data)
+
+
+def striped_tiff(path, img, compression='raw', rows_per_strip=7):
+    # Only Pillow's libtiff writer splits an image into strips
+    with mock.patch.object(TiffImagePlugin, 'WRITE_LIBTIFF', True):
+        img.save(path, 'TIFF', compression=compression, strip_size=rows_per_strip * img.size[0] * len(img.getbands()))
+
+
+def tiled_tiff(path, img, compression=None, tile=16):
+    # Pillow does not write tiled TIFFs; edge tiles are padded to full size
+    bands = len(img.getbands())
+    width, height = img.size
+    tiles = []
+    for top in range(0, height, tile):
+        for left in range(0, width, tile):
+            piece = Image.new(img.mode, (tile, tile))
+            piece.paste(img.crop((left, top, min(left + tile, width), min(top + tile, height))))
+            data = piece.tobytes()
+            tiles.append(zlib.compress(data) if compression else data)
+    ifd = TiffImagePlugin.ImageFileDirectory_v2(prefix=b'II')
+    ifd[256] = width
+    ifd[257] = height
+    ifd[258] = (8,) * bands
+    ifd[259] = 8 if compression else 1
+    ifd[262] = 2 if bands >= 3 else 1
+    ifd[277] = bands
+    ifd[284] = 1
+    ifd[322] = tile
+    ifd[323] = tile
+    ifd[325] = tuple(len(data) for data in tiles)
+    ifd[324] = (0,) * len(tiles)
+    start = 8 + len(ifd.tobytes(8))
+    offsets = []
+    for data in tiles:
+        offsets.append(start)
+        start += len(data)
+    ifd[324] = tuple(offsets)
+    with open(path, 'wb') as f:
+        f.write(b'II' + struct.pack('<HL', 42, 8) + ifd.tobytes(8) + b''.join(tiles))
+
+
+SOURCES = {
+    'striped': lambda path, img: striped_tiff(path, img),
+    'striped-lzw': lambda path, img: striped_tiff(path, img, 'tiff_lzw'),
+    'tiled': lambda path, img: tiled_tiff(path, img),
+    'tiled-deflate': lambda path, img: tiled_tiff(path, img, 'deflate'),
+}
+
+
+def pdf_image(path):
+    # The raw pixels of the single image XObject write_pdf produces
+    with open(path, 'rb') as f:
+        pdf = f.read()
+    length = int(re.search(rb'6 0 obj\n(\d+)\nendobj', pdf).group(1))
+    start = pdf.index(b'stream\n', pdf.index(b'/Subtype /Image')) + len(b'stream\n')
+    xref = int(re.search(rb'startxref\n(\d+)', pdf).group(1))
+    for number, offset in enumerate(re.findall(rb'(\d{10}) 00000 n', pdf[xref:]), 1):
+        assert pdf[int(offset):].startswith(b'%d 0 obj' % number)
+    return zlib.decompress(pdf[start:start + length])
+
+
+class BandConversionTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        patcher = mock.patch.object(images, 'IMAGE_MEMORY_BUDGET', BUDGET)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def path(self, name):
+        return os.path.join(self.directory.name, name)
+
+    def convert(self, source, img, to_format, kind):
+        input_path = self.path(f'in-{kind}.tif')
+        output_path = self.path(f'out-{kind}.{to_format.lower()}')
+        SOURCES[kind](input_path, img)
+        with mock.patch.object(images, 'convert_bands', wraps=images.convert_bands) as convert_bands:
+            images.convert(input_path, output_path, to_format)
+        self.assertTrue(convert_bands.called, f'{source} was not converted in bands')
+        return output_path
+
+    def test_lossless_round_trip(self):
+        for mode, targets in [('RGB', ['PNG', 'TIFF', 'BMP']), ('L', ['PNG', 'TIFF']), ('RGBA', ['PNG', 'TIFF'])]:
+            img = pattern(mode)
+            for kind in SOURCES:
+                for to_format in targets:
+                    with self.subTest(mode=mode, source=kind, to_format=to_format):
+                        output_path = self.convert(f'{mode} {kind}', img, to_format, kind)
+                        with Image.open(output_path) as result:
+                            self.assertEqual(result.size, img.size)
+                            self.assertEqual(result.convert(mode).tobytes(), img.tobytes())
+
+    def test_pdf_round_trip(self):
+        for mode in ['RGB', 'L']:
+            img = pattern(mode)
+            for kind in SOURCES:
+                with self.subTest(mode=mode, source=kind):
+                    output_path = self.convert(f'{mode} {kind}', img, 'PDF', kind)
+                    self.assertEqual(pdf_image(output_path), img.tobytes())
+
+    def test_jpeg_keeps_full_resolution(self):
+        img = Image.linear_gradient('L').resize((WIDTH, HEIGHT)).convert('RGB')
+        for kind in SOURCES:
+            with self.subTest(source=kind):
+                output_path = self.convert(kind, img, 'JPG', kind)
+                with Image.open(output_path) as result:
+                    self.assertEqual(result.size, img.size)
+                    difference = sum(abs(a - b) for a, b in zip(result.tobytes(), img.tobytes()))
+                    self.assertLess(difference / len(img.tobytes()), 2)
+
+    def test_webp_within_pillow_limit_ignores_budget(self):
+        img = pattern('RGB')
+        output_path = self.convert('RGB striped', img, 'WEBP', 'striped')
+        with Image.open(output_path) as result:
+            self.assertEqual(result.size, img.size)
+
+    def test_webp_past_pillow_limit_must_fit_budget(self):
+        input_path = self.path('in.tif')
+        output_path = self.path('out.webp')
+        striped_tiff(input_path, pattern('RGB'))
+        with mock.patch.object(Image, 'MAX_IMAGE_PIXELS', 100):
+            with self.assertRaises(ValueError):
+                images.convert(input_path, output_path, 'WEBP')
+        self.assertFalse(os.path.exists(output_path))
+
+    def test_file_size_limits_leave_nothing_behind(self):
+        input_path = self.path('in.tif')
+        striped_tiff(input_path, pattern('RGB'))
+        for to_format in ['TIFF', 'BMP']:
+            with self.subTest(to_format=to_format):
+                output_path = self.path(f'out.{to_format.lower()}')
+                with mock.patch.dict(images.MAX_FILE_BYTES, {to_format: 1000}):
+                    with self.assertRaises(ValueError):
+                        images.convert(input_path, output_path, to_format)
+                self.assertFalse(os.path.exists(output_path))
+
+    def test_failing_band_leaves_nothing_behind(self):
+        img = pattern('RGB')
+
+        def bands():
+            yield 0, img.crop((0, 0, WIDTH, 8))
+            raise OSError('truncated strip')
+
+        for to_format in ['PNG', 'TIFF', 'BMP', 'PDF', 'JPG', 'WEBP']:
+            with self.subTest(to_format=to_format):
+                output_path = self.path(f'out.{to_format.lower()}')
+                with self.assertRaises(OSError):
+                    images.write_bands(img, bands(), output_path, to_format, images.DEFAULT_QUALITY)
+                self.assertFalse(os.path.exists(output_path))
+
+    def test_max_size_scales_banded_images(self):
+        img = pattern('RGB')
+        for kind in SOURCES:
+            for to_format in ['PNG', 'JPG', 'PDF']:
+                with self.subTest(source=kind, to_format=to_format):
+                    input_path = self.path(f'in-{kind}.tif')
+                    output_path = self.path(f'out-{kind}.{to_format.lower()}')
+                    SOURCES[kind](input_path, img)
+                    with mock.patch.object(images, 'write_scaled', wraps=images.write_scaled) as write_scaled:
+                        images.convert(input_path, output_path, to_format, max_size=(20, 20))
+                    self.assertTrue(write_scaled.called)
+                    if to_format != 'PDF':
+                        with Image.open(output_path) as result:
+                            self.assertEqual(result.size, images.scaled_size(img.size, (20, 20)))
+
+
+class ScaleAndBatchTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def path(self, name):
+        return os.path.join(self.directory.name, name)
+
+    def test_max_size_keeps_aspect_and_never_enlarges(self):
+        input_path = self.path('in.jpg')
+        pattern('RGB', (200, 100)).save(input_path, 'JPEG')
+        for max_size, expected in [((50, 50), (50, 25)), ((400, 400), (200, 100)), (None, (200, 100))]:
+            with self.subTest(max_size=max_size):
+                output_path = self.path('out.png')
+                images.convert(input_path, output_path, 'PNG', max_size=max_size)
+                with Image.open(output_path) as result:
+                    self.assertEqual(result.size, expected)
+
+    def test_batch_reports_each_task(self):
+        good = self.path('good.png')
+        pattern('RGB', (30, 20)).save(good, 'PNG')
+        bad = self.path('bad.png')
+        with open(bad, 'wb') as f:
+            f.write(b'not an image')
+        tasks = [(good, self.path('good.jpg'), 'JPG', 80, (15, 15)),
+                 (bad, self.path('bad.jpg'), 'JPG', 80, None)]
+        results = images.convert_batch(tasks)
+        self.assertIsNone(results[0])
+        self.assertIsInstance(results[1], Exception)
+        with Image.open(self.path('good.jpg')) as result:
+            self.assertEqual(result.size, (15, 10))
+        self.assertFalse(os.path.exists(self.path('bad.jpg')))
+
+
+if __name__ == '__main__':
+    unittest.main()
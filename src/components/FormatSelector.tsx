@@ -63,7 +63,7 @@ const FormatSelector = ({ onFormatSelect, selectedFiles = [] }: FormatSelectorPr
     {
       name: 'Code',
       icon: Code,
-      formats: ['HTML', 'CSS', 'JS', 'JSON', 'XML', 'CSV'],
+      formats: ['HTML', 'CSS', 'JS', 'JSON', 'NDJSON', 'XML', 'CSV', 'TSV'],
       color: 'from-indigo-100 to-indigo-200',
       iconColor: 'text-indigo-600'
     }
@@ -74,14 +74,15 @@ class ApiClient {
   async uploadFiles(files: File[], fromFormat: string, toFormat: string, userEmail?: string) {
     console.log('API: Uploading files', { files: files.length, fromFormat, toFormat });
     
+    // Formats go first so the server can validate each file while it streams in
     const formData = new FormData();
+    formData.append('fromFormat', fromFormat);
+    formData.append('toFormat', toFormat);
+    if (userEmail) formData.append('userEmail', userEmail);
     files.forEach(file => {
       console.log('Adding file:', file.name, file.size);
       formData.append('files', file);
     });
-    formData.append('fromFormat', fromFormat);
-    formData.append('toFormat', toFormat);
-    if (userEmail) formData.append('userEmail', userEmail);
 
     const response = await fetch(`${this.baseURL}/files/upload`, {
       method: 'POST',
@@ -113,6 +114,14 @@ class ApiClient {
     return this.request(`/convert/progress/${fileId}`);
   }
 
+  // Server-Sent Events for a batch of files; the stream ends once all of them finish
+  subscribeToProgress(fileIds: string[], onProgress: (progress: any) => void) {
+    const params = new URLSearchParams({ ids: fileIds.join(',') });
+    const source = new EventSource(`${this.baseURL}/convert/events?${params}`);
+    source.onmessage = (event) => onProgress(JSON.parse(event.data));
+    return source;
+  }
+
   async getFiles(page = 1, perPage = 10, status?: string) {
     const params = new URLSearchParams({
       page: page.toString(),
@@ -124,7 +133,8 @@ class ApiClient {
   }
 
   async downloadFile(fileId: string) {
-    const response = await fetch(`${this.baseURL}/files/${fileId}/download?t=${Date.now()}`, {
+    // 'no-cache' revalidates with the ETag, so a repeat download can come back as a cheap 304
+    const response = await fetch(`${this.baseURL}/files/${fileId}/download`, {
       headers: this.token ? { 'Authorization': `Bearer ${this.token}` } : {},
       cache: 'no-cache'
     });
@@ -136,6 +146,13 @@ class ApiClient {
     return response.blob();
   }
 
+  // One streamed ZIP for many files; used as a plain link so the browser
+  // writes it straight to disk instead of buffering a blob
+  batchDownloadUrl(fileIds: string[]) {
+    const params = new URLSearchParams({ ids: fileIds.join(',') });
+    return `${this.baseURL}/files/download?${params}`;
+  }
+
   async deleteFile(fileId: string) {
     return this.request(`/files/${fileId}`, { method: 'DELETE' });
   }
@@ -191,13 +208,12 @@ class ApiClient {
     return this.request('/admin/dashboard');
   }
 
-  async getAdminFiles(page = 1, perPage = 20, status?: string, search?: string) {
-    const params = new URLSearchParams({
-      page: page.toString(),
-      per_page: perPage.toString(),
-    });
-    if (status) params.append('status', status);
-    if (search) params.append('search', search);
+  async getAdminFiles(cursor?: string | null, limit = 50, status?: string, fromFormat?: string, toFormat?: string) {
+    const params = new URLSearchParams({ limit: limit.toString() });
+    if (cursor) params.append('cursor', cursor);
+    if (status && status !== 'all') params.append('status', status);
+    if (fromFormat) params.append('from', fromFormat);
+    if (toFormat) params.append('to', toFormat);
 
     return this.request(`/admin/files?${params}`);
   }
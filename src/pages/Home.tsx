@@ -57,10 +57,8 @@ const Home = () => {
       const fileIds = uploadedFiles.map((file: any) => file.id);
       await api.startConversion(fileIds);
       
-      // Poll for progress updates
-      fileIds.forEach((fileId: string) => {
-        pollConversionProgress(fileId);
-      });
+      // Progress is pushed over SSE; fall back to polling if the stream fails
+      watchConversionProgress(fileIds);
       
       toast({
         title: "Conversion Started",
@@ -79,32 +77,56 @@ const Home = () => {
     }
   };
   
+  const applyProgress = (progress: any) => {
+    setConversions(current => 
+      current.map(c => 
+        c.id === progress.id 
+          ? { 
+              ...c, 
+              progress: progress.progress,
+              status: progress.status as 'pending' | 'converting' | 'completed' | 'error'
+            }
+          : c
+      )
+    );
+    
+    if (progress.status === 'completed') {
+      toast({
+        title: "Conversion Complete",
+        description: `${progress.fileName} converted successfully!`,
+      });
+    }
+    
+    return progress.status === 'completed' || progress.status === 'failed';
+  };
+
+  const watchConversionProgress = (fileIds: string[]) => {
+    if (typeof EventSource === 'undefined') {
+      fileIds.forEach(pollConversionProgress);
+      return;
+    }
+    
+    const pending = new Set(fileIds);
+    const source = api.subscribeToProgress(fileIds, (progress) => {
+      if (applyProgress(progress)) {
+        pending.delete(progress.id);
+        if (pending.size === 0) source.close();
+      }
+    });
+    source.onerror = () => {
+      // Stream dropped before everything finished: poll the rest instead
+      source.close();
+      pending.forEach(pollConversionProgress);
+    };
+  };
+  
   const pollConversionProgress = async (fileId: string) => {
     const pollInterval = setInterval(async () => {
       try {
         const progress = await api.getConversionProgress(fileId);
         
-        setConversions(current => 
-          current.map(c => 
-            c.id === fileId 
-              ? { 
-                  ...c, 
-                  progress: progress.progress,
-                  status: progress.status as 'pending' | 'converting' | 'completed' | 'error'
-                }
-              : c
-          )
-        );
-        
-        if (progress.status === 'completed' || progress.status === 'failed') {
+        if (applyProgress(progress)) {
           clearInterval(pollInterval);
-          
-          if (progress.status === 'completed') {
-            toast({
-              title: "Conversion Complete",
-              description: `${progress.fileName} converted successfully!`,
-            });
-          }
         }
         
       } catch (error) {
@@ -153,6 +175,8 @@ const Home = () => {
     }
   ];
 
+  const completedIds = conversions.filter(c => c.status === 'completed').map(c => c.id);
+
   return (
     <Layout>
       <div className="min-h-screen">
@@ -216,6 +240,14 @@ const Home = () => {
                     <div className="text-center">
                       <p className="text-green-600 font-medium mb-2">✓ Conversion Complete!</p>
                       <p className="text-sm text-gray-600">Your files are ready for download</p>
+                      {completedIds.length > 1 && (
+                        <a
+                          href={api.batchDownloadUrl(completedIds)}
+                          className="inline-block mt-3 px-4 py-2 text-sm rounded-lg font-medium bg-green-600 hover:bg-green-700 text-white"
+                        >
+                          Download all as ZIP
+                        </a>
+                      )}
                     </div>
                   )}
                 </div>
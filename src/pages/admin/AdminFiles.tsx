@@ -9,15 +9,17 @@ const AdminFiles = () => {
   const [searchTerm, setSearchTerm] = useState('');
   const [filterStatus, setFilterStatus] = useState('all');
   const [loading, setLoading] = useState(true);
+  const [nextCursor, setNextCursor] = useState(null);
 
   useEffect(() => {
     fetchFiles();
-  }, []);
+  }, [filterStatus]);
 
-  const fetchFiles = async () => {
+  const fetchFiles = async (cursor = null) => {
     try {
-      const response = await api.getAdminFiles();
-      setFiles(response.files || []);
+      const response = await api.getAdminFiles(cursor, 50, filterStatus);
+      setFiles(cursor ? [...files, ...(response.files || [])] : response.files || []);
+      setNextCursor(response.nextCursor || null);
     } catch (error) {
       console.error('Failed to fetch files:', error);
       setFiles([
@@ -30,11 +32,10 @@ const AdminFiles = () => {
     }
   };
 
-  const filteredFiles = files.filter(file => {
-    const matchesSearch = file.filename.toLowerCase().includes(searchTerm.toLowerCase());
-    const matchesFilter = filterStatus === 'all' || file.status === filterStatus;
-    return matchesSearch && matchesFilter;
-  });
+  // Status is filtered by the server; search only narrows the loaded pages
+  const filteredFiles = files.filter(file =>
+    file.filename.toLowerCase().includes(searchTerm.toLowerCase())
+  );
 
   const handleDelete = async (fileId) => {
     if (confirm('Are you sure you want to delete this file?')) {
@@ -175,6 +176,18 @@ const AdminFiles = () => {
               ))}
             </tbody>
           </table>
+          {nextCursor && (
+            <div className={`p-4 text-center border-t ${isDark ? 'border-gray-700' : 'border-gray-200'}`}>
+              <button
+                onClick={() => fetchFiles(nextCursor)}
+                className={`px-4 py-2 rounded-lg text-sm font-medium transition-colors ${
+                  isDark ? 'text-blue-400 hover:bg-blue-900/20' : 'text-blue-600 hover:bg-blue-50'
+                }`}
+              >
+                Load more
+              </button>
+            </div>
+          )}
         </div>
       </div>
     </div>